@@ -0,0 +1,183 @@
+import hashlib
+import json
+import math
+import numpy as np
+from flask import Response, abort, jsonify, request
+from cache import CACHE_EXPIRE, CACHE_VERSION, get_cache, get_dataset_info, list_datasets, load_dataframe
+from cube import get_cube, cohorts, cube_student_enrolment, cube_attendance_rate, cube_submission_rate
+from data_processing import calculate_summary_statistics, calculate_summary_statistics_by
+from delta import changes_since_previous, at_risk_changes, previous_upload
+from history import course_trend, student_records
+from ml_model import load_scored_students
+from scheduler import queue_status
+
+# Datasets are identified by the hash of their contents, so their results never change
+MAX_AGE = 24 * 3600
+
+def json_ready(value):
+    # Convert NumPy types, tuple keys and NaN into plain JSON values
+    if isinstance(value, dict):
+        return {_json_key(key): json_ready(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [json_ready(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+def _json_key(key):
+    if isinstance(key, tuple):
+        return ' / '.join(str(json_ready(part)) for part in key)
+    return str(json_ready(key))
+
+def _error(status, message):
+    response = jsonify({'error': message})
+    response.status_code = status
+    abort(response)
+
+def _load(dataset_key):
+    # Parsed dataset for an id, tagged so cached results (cube, scores) are reused
+    df = load_dataframe(dataset_key)
+    if df is None:
+        _error(404, f'Dataset {dataset_key} was not found or has expired; upload it again.')
+    df.attrs['dataset_id'] = dataset_key
+    return df
+
+def _year():
+    try:
+        return int(request.args['year'])
+    except (KeyError, ValueError):
+        _error(400, 'Query parameter "year" must be an integer.')
+
+def _level_and_year(require_year=True):
+    # The level is checked against the dataset's own levels once its cube is loaded, by _cube
+    level = request.args.get('level', '')
+    return level, _year() if require_year else None
+
+def _cube(dataset_key, level):
+    # Cube of a dataset and the requested level of study as the dataset spells it, matched regardless of case,
+    # after checking the dataset has data for that level
+    cube = get_cube(_load(dataset_key))
+    levels = cohorts(cube)
+    matching = [known for known in levels if known.lower() == level.lower()]
+    if not matching:
+        _error(400, 'Query parameter "level" must be one of {} for this dataset.'.format(', '.join(levels)))
+    return cube, matching[0]
+
+def _cached_json(dataset_key, endpoint, compute, depends_on=None):
+    # Serve a dataset result with an ETag; answer conditional GETs without computing anything
+    # and keep the rendered JSON in the shared cache for the other workers. `depends_on` is anything
+    # else the result depends on, e.g. the upload it is compared with
+    etag = hashlib.sha1(json.dumps([dataset_key, CACHE_VERSION, endpoint, sorted(request.args.items()), depends_on]).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        cache = get_cache()
+        body = cache.get(('api', etag))
+        if body is None:
+            body = json.dumps(json_ready(compute()))
+            cache.set(('api', etag), body, expire=CACHE_EXPIRE)
+        response = Response(body, mimetype='application/json')
+
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = MAX_AGE
+    return response
+
+def register_api(server):
+    # JSON endpoints for other systems, mounted on the Flask server underneath the Dash app
+    @server.route('/api/datasets')
+    def api_datasets():
+        response = jsonify(json_ready(list_datasets()))
+        response.add_etag()
+        return response.make_conditional(request)
+
+    @server.route('/api/queue')
+    def api_queue():
+        # Uploads running and waiting in the scheduler
+        return jsonify(queue_status())
+
+    @server.route('/api/datasets/<dataset_key>')
+    def api_dataset(dataset_key):
+        info = get_dataset_info(dataset_key)
+        if info is None:
+            _error(404, f'Dataset {dataset_key} was not found.')
+        return jsonify(json_ready(info))
+
+    @server.route('/api/datasets/<dataset_key>/summary')
+    def api_summary(dataset_key):
+        # Optional ?by=<column> returns the summary for every value of that column
+        by = request.args.get('by')
+        def compute():
+            df = _load(dataset_key)
+            if by:
+                try:
+                    return calculate_summary_statistics_by(df, by)
+                except ValueError as e:
+                    _error(400, str(e))
+            return calculate_summary_statistics(df)
+        return _cached_json(dataset_key, 'summary', compute)
+
+    @server.route('/api/datasets/<dataset_key>/enrolment')
+    def api_enrolment(dataset_key):
+        level, _ = _level_and_year(require_year=False)
+        return _cached_json(dataset_key, 'enrolment', lambda: cube_student_enrolment(*_cube(dataset_key, level)))
+
+    @server.route('/api/datasets/<dataset_key>/attendance')
+    def api_attendance(dataset_key):
+        level, year = _level_and_year()
+        def compute():
+            # Key by course code; the year is already fixed by the query
+            attendance_rates = cube_attendance_rate(*_cube(dataset_key, level), year)
+            return {course_code: rates for (course_code, _), rates in attendance_rates.items()}
+        return _cached_json(dataset_key, 'attendance', compute)
+
+    @server.route('/api/datasets/<dataset_key>/submission')
+    def api_submission(dataset_key):
+        level, year = _level_and_year()
+        return _cached_json(dataset_key, 'submission', lambda: cube_submission_rate(*_cube(dataset_key, level), year))
+
+    @server.route('/api/datasets/<dataset_key>/at-risk')
+    def api_at_risk(dataset_key):
+        # Optional ?level= (in any case) and ?year= narrow the list to one cohort
+        level = request.args.get('level')
+        year = _year() if 'year' in request.args else None
+        def compute():
+            scored = load_scored_students(dataset_key)
+            if scored is None:
+                _error(404, f'Dataset {dataset_key} was not found or has expired; upload it again.')
+            if level is not None:
+                scored = scored[scored['Level of Study'].astype(str).str.lower() == level.lower()]
+            if year is not None:
+                scored = scored[scored['Year of Course'] == year]
+            return scored.to_dict('records')
+        return _cached_json(dataset_key, 'at-risk', compute)
+
+    @server.route('/api/datasets/<dataset_key>/changes')
+    def api_changes(dataset_key):
+        # Rows added, removed and changed since the previous upload of the same file, and the students
+        # newly at risk or no longer at risk; null for a first upload
+        def compute():
+            df = _load(dataset_key)
+            changes = changes_since_previous(df)
+            if changes is None:
+                return None
+            return dict(changes, **(at_risk_changes(df, changes) or {}))
+        # Keyed on the upload compared with too, so a cached answer always belongs to it
+        previous = previous_upload(dataset_key)
+        return _cached_json(dataset_key, 'changes', compute, depends_on=previous and previous['id'])
+
+    @server.route('/api/history/<course_code>')
+    def api_history(course_code):
+        # Attendance, submission rate, students and at-risk count of a course in every recorded term,
+        # optionally narrowed with ?level= and ?year=
+        level = request.args.get('level', type=str)
+        year = _year() if 'year' in request.args else None
+        trend = course_trend(course_code, level.upper() if level else None, year)
+        return jsonify(json_ready(trend.to_dict('records')))
+
+    @server.route('/api/students/<user>')
+    def api_student(user):
+        # Every recorded row of a student in every processed dataset, and whether they were flagged as at risk
+        return jsonify(student_records(user))
@@ -1,19 +1,76 @@
+import argparse
+import importlib.util
+import logging
+import os
 import dash
-from dash import dcc
+import flask
+import diskcache
+from dash import DiskcacheManager
 import dash_bootstrap_components as dbc
 from upload import upload_layout
 from callbacks import register_callbacks
+from tracing import register_metrics_endpoint
+from api import register_api
+from report import register_reports
+import profiling
+from cache import CACHE_DIR
+from warmup import prewarm_in_background
+
+# Background callbacks run in separate processes and are queued through a local disk cache
+background_callback_manager = DiskcacheManager(diskcache.Cache(os.path.join(CACHE_DIR, 'jobs')))
+
+# Compress responses above a size threshold with brotli, or gzip for clients without it (needs flask-compress)
+server = flask.Flask(__name__)
+server.config.update(
+    COMPRESS_ALGORITHM=['br', 'gzip'],
+    COMPRESS_MIN_SIZE=int(os.environ.get('DASHBOARD_COMPRESS_MIN_BYTES', '1024')),
+)
+compress = os.environ.get('DASHBOARD_COMPRESS', '1') == '1'
+if compress and importlib.util.find_spec('flask_compress') is None:
+    logging.getLogger(__name__).warning('flask-compress is not installed, so responses are sent uncompressed; '
+                                        'install it with "pip install flask-compress" or set DASHBOARD_COMPRESS=0')
+    compress = False
 
 # Initialise the Dash app
-app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True)
+app = dash.Dash(__name__, server=server, compress=compress, external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True, background_callback_manager=background_callback_manager)
 
 app.layout = dbc.Container([
-    upload_layout(),
-    dcc.Store(id='stored-data')
+    upload_layout()
 ], fluid=True)
 
 register_callbacks(app)
 
+# Expose upload pipeline timings for Prometheus on /metrics
+register_metrics_endpoint(app.server)
+
+# JSON query API over processed datasets under /api
+register_api(app.server)
+
+# Static HTML and PDF reports of processed datasets under /reports
+register_reports(app.server)
+
 # Run the app
 if __name__ == '__main__':
-    app.run_server(debug=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Attendance Dashboard')
+    parser.add_argument('--profile', action='store_true', help='profile callbacks such as update_output')
+    parser.add_argument('--profile-dir', help='directory to save .pstats profiles to')
+    parser.add_argument('--profile-rate', type=float, help='fraction of callback calls to profile (0-1)')
+    args = parser.parse_args()
+
+    # The --profile flags override the DASHBOARD_PROFILE* environment variables
+    profiling.configure(
+        enabled=True if args.profile else None,
+        directory=args.profile_dir,
+        sample_rate=args.profile_rate
+    )
+
+    debug = os.environ.get('DASHBOARD_DEBUG', '1').lower() in ('1', 'true', 'yes')
+    port = int(os.environ.get('DASHBOARD_PORT', '8050'))
+
+    # Import sklearn, plotly and cryptography in the background once the server is listening
+    # (only in the process that serves requests, not in the debug reloader's parent)
+    if os.environ.get('DASHBOARD_PREWARM', '1').lower() in ('1', 'true', 'yes'):
+        if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            prewarm_in_background(port=port)
+
+    app.run_server(debug=debug, port=port)
\ No newline at end of file
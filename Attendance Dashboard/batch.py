@@ -0,0 +1,124 @@
+# Precomputes the dashboards for a directory of Excel exports without starting the app
+#
+#   python batch.py exports/ --output batch_output [--workers 4] [--at-risk-format parquet]
+#
+# Each workbook is parsed, aggregated and scored in its own worker process. The results are
+# written to <output>/<workbook name>/ as aggregates.json (summary, enrolment, attendance and
+# submission for every level and year in the data) and at_risk.parquet (or at_risk.json).
+# The parsed data, cube, scores and dashboard sections also go into the shared cache, so
+# uploading any of these workbooks in the dashboard afterwards is served from the cache.
+# With --consolidate, every workbook is also combined into one dataset (e.g. a whole faculty)
+# aggregated out of core, and its results are written to <output>/consolidated/.
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from api import json_ready
+from consolidate import consolidate, dataset_parquet
+from cube import get_cube, cohorts, cube_student_enrolment, cube_attendance_rate, cube_submission_rate
+from data_processing import calculate_summary_statistics, calculate_summary_statistics_by
+from ml_model import score_students
+from parse_contents import read_dataset, dashboard_sections
+
+def find_workbooks(directory):
+    # Excel files directly inside the directory, skipping the lock files Excel leaves behind
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.endswith(('.xls', '.xlsx')) and not name.startswith('~$')
+    )
+
+def build_aggregates(summary, summary_by_level, cube):
+    # Every view the dashboard can show for a dataset, answered from its cube
+    years_by_level = cohorts(cube)
+    return {
+        'summary': summary,
+        'summary_by_level': summary_by_level,
+        'enrolment': {level: cube_student_enrolment(cube, level, years) for level, years in years_by_level.items()},
+        'attendance': {
+            level: {year: {course_code: rates for (course_code, _), rates in cube_attendance_rate(cube, level, year).items()} for year in years}
+            for level, years in years_by_level.items()
+        },
+        'submission': {
+            level: {year: cube_submission_rate(cube, level, year) for year in years}
+            for level, years in years_by_level.items()
+        },
+    }
+
+def write_aggregates(target, aggregates):
+    os.makedirs(target, exist_ok=True)
+    with open(os.path.join(target, 'aggregates.json'), 'w') as fp:
+        json.dump(json_ready(aggregates), fp, indent=2)
+
+def process_workbook(path, output_dir, at_risk_format, consolidated):
+    # Parse one workbook, warm the shared cache with everything the dashboard needs, and write the outputs
+    start = time.perf_counter()
+    filename = os.path.basename(path)
+    with open(path, 'rb') as fp:
+        decoded = fp.read()
+
+    df = read_dataset(decoded, filename)
+    dashboard_sections(df)
+    aggregates = build_aggregates(calculate_summary_statistics(df), calculate_summary_statistics_by(df, 'Level of Study'), get_cube(df))
+    aggregates.update(dataset_id=df.attrs['dataset_id'], filename=filename, rows=len(df))
+    at_risk = score_students(df)
+    if consolidated:
+        dataset_parquet(df.attrs['dataset_id'], df)
+
+    target = os.path.join(output_dir, os.path.splitext(filename)[0])
+    write_aggregates(target, aggregates)
+    if at_risk_format == 'parquet':
+        at_risk.to_parquet(os.path.join(target, 'at_risk.parquet'), index=False)
+    else:
+        at_risk.to_json(os.path.join(target, 'at_risk.json'), orient='records', indent=2)
+
+    return {'file': filename, 'dataset_id': aggregates['dataset_id'], 'rows': len(df), 'at_risk': len(at_risk), 'seconds': time.perf_counter() - start}
+
+def run_batch(paths, output_dir, workers, at_risk_format, consolidated=False):
+    # Process the workbooks in parallel, reporting each one as it finishes; returns the results and failures
+    results, failures = [], []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_workbook, path, output_dir, at_risk_format, consolidated): path for path in paths}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                failures.append((futures[future], e))
+                print(f'FAILED  {os.path.basename(futures[future])}: {e}', file=sys.stderr)
+                continue
+            results.append(result)
+            print(f"{result['seconds']:7.2f}s  {result['rows']:>9,} rows  {result['at_risk']:>6,} at risk  {result['file']} ({result['dataset_id']})")
+    return results, failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute dashboard aggregates and at-risk lists for a directory of Excel files.')
+    parser.add_argument('directory', help='directory containing .xls/.xlsx exports')
+    parser.add_argument('--output', default='batch_output', help='directory to write the results to')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--at-risk-format', choices=['parquet', 'json'], default='parquet')
+    parser.add_argument('--consolidate', action='store_true', help='also combine every workbook into one dataset')
+    args = parser.parse_args()
+
+    paths = find_workbooks(args.directory)
+    if not paths:
+        sys.exit(f'No Excel files found in {args.directory}')
+
+    start = time.perf_counter()
+    results, failures = run_batch(paths, args.output, args.workers, args.at_risk_format, args.consolidate)
+    elapsed = time.perf_counter() - start
+
+    rows = sum(result['rows'] for result in results)
+    print(f'{len(results)} files, {rows:,} rows in {elapsed:.2f}s with {args.workers} workers: '
+          f'{len(results) / elapsed:.2f} files/s, {rows / elapsed:,.0f} rows/s')
+
+    if args.consolidate and results:
+        start = time.perf_counter()
+        dataset_keys = [result['dataset_id'] for result in results]
+        summary, summary_by_level, cube = consolidate(dataset_keys)
+        aggregates = build_aggregates(summary, summary_by_level, cube)
+        aggregates.update(files=sorted(result['file'] for result in results), rows=rows)
+        write_aggregates(os.path.join(args.output, 'consolidated'), aggregates)
+        print(f'Consolidated {len(dataset_keys)} files in {time.perf_counter() - start:.2f}s')
+    if failures:
+        sys.exit(f'{len(failures)} file(s) failed')
@@ -0,0 +1,133 @@
+import hashlib
+import os
+import time
+import diskcache
+
+# Shared on-disk cache; every worker process opens the same directory, and so do the batch tool and
+# the watcher whichever directory they are started from
+CACHE_DIR = os.environ.get('DASHBOARD_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'))
+CACHE_SIZE_LIMIT = int(os.environ.get('DASHBOARD_CACHE_SIZE_MB', '1024')) * 1024 * 1024
+CACHE_EXPIRE = int(os.environ.get('DASHBOARD_CACHE_EXPIRE', str(7 * 24 * 3600)))
+
+# Parsed datasets are kept as uncompressed Arrow IPC (Feather) files that every worker memory-maps,
+# so the OS page cache holds one copy of a sheet however many workers read it
+ARROW_DIR = os.path.join(CACHE_DIR, 'arrow')
+
+# Parquet copies of parsed datasets for out-of-core aggregation across sheets
+PARQUET_DIR = os.path.join(CACHE_DIR, 'parquet')
+
+# Bump when parsing, data_processing, ml_model or the sections change so stale results are not reused
+CACHE_VERSION = 9
+
+_caches = {}
+
+def get_cache(name='results'):
+    # Open each cache lazily, and again after a fork, so each worker gets its own connection
+    pid, store = _caches.get(name, (None, None))
+    if pid != os.getpid():
+        store = diskcache.Cache(os.path.join(CACHE_DIR, name), size_limit=CACHE_SIZE_LIMIT)
+        _caches[name] = (os.getpid(), store)
+    return store
+
+def dataset_id(decoded):
+    # Identify a dataset by the hash of its file contents
+    return hashlib.sha256(decoded).hexdigest()[:16]
+
+def load_dataframe(dataset_key):
+    # Return a previously parsed dataset, or None if it is not cached
+    entry = get_cache().get(('dataset', CACHE_VERSION, dataset_key))
+    if not isinstance(entry, str):
+        return entry
+
+    # Numeric columns are used in place from the mapped file (read-only); text columns are
+    # converted to Python strings as pandas expects
+    from pyarrow import feather
+    try:
+        return feather.read_table(os.path.join(ARROW_DIR, entry), memory_map=True).to_pandas(split_blocks=True)
+    except FileNotFoundError:
+        return None
+
+def store_dataframe(dataset_key, df):
+    # Keep the parsed dataset so other workers can skip the Excel parse; sheets Arrow cannot
+    # represent (e.g. a column mixing numbers and text) are pickled into the cache instead
+    entry = df
+    name = f'{CACHE_VERSION}-{dataset_key}.arrow'
+    temporary = os.path.join(ARROW_DIR, f'{name}.{os.getpid()}.tmp')
+    try:
+        import pyarrow as pa
+        from pyarrow import feather
+
+        # Keep NaN as a float value rather than an Arrow null, and write a single chunk,
+        # so pandas can use the mapped columns without filling or concatenating them
+        table = pa.Table.from_pandas(df)
+        for i, column in enumerate(table.column_names):
+            if column in df.columns and df[column].dtype.kind == 'f':
+                table = table.set_column(i, table.field(i), pa.array(df[column].to_numpy(), from_pandas=False))
+        os.makedirs(ARROW_DIR, exist_ok=True)
+        feather.write_feather(table, temporary, compression='uncompressed', chunksize=max(1, len(df)))
+        os.replace(temporary, os.path.join(ARROW_DIR, name))
+        entry = name
+    except (ImportError, ValueError, TypeError, NotImplementedError):
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    get_cache().set(('dataset', CACHE_VERSION, dataset_key), entry, expire=CACHE_EXPIRE)
+    prune_dataset_files()
+
+def prune_dataset_files():
+    # Remove the Arrow and Parquet copies of datasets whose cache entry has expired or been evicted
+    cache = get_cache()
+    stale = []
+    if os.path.isdir(ARROW_DIR):
+        for name in os.listdir(ARROW_DIR):
+            dataset_key = name[:-len('.arrow')].split('-')[-1]
+            if name.endswith('.arrow') and cache.get(('dataset', CACHE_VERSION, dataset_key)) != name:
+                stale.append(os.path.join(ARROW_DIR, name))
+    if os.path.isdir(PARQUET_DIR):
+        for name in os.listdir(PARQUET_DIR):
+            if name.endswith('.parquet') and ('dataset', CACHE_VERSION, name[:-len('.parquet')]) not in cache:
+                stale.append(os.path.join(PARQUET_DIR, name))
+
+    for path in stale:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def load_result(kind, dataset_key):
+    # Return a cached result for a dataset, or None if it has not been computed or has expired
+    return get_cache().get((kind, CACHE_VERSION, dataset_key))
+
+def store_result(kind, dataset_key, result):
+    get_cache().set((kind, CACHE_VERSION, dataset_key), result, expire=CACHE_EXPIRE)
+
+def cached_result(kind, df, compute):
+    # Reuse a result computed from the same dataset by any worker, computing it on a miss
+    dataset_key = df.attrs.get('dataset_id')
+    if dataset_key is None:
+        return compute()
+
+    key = (kind, CACHE_VERSION, dataset_key)
+    cache = get_cache()
+    result = cache.get(key)
+    if result is None:
+        result = compute()
+        cache.set(key, result, expire=CACHE_EXPIRE)
+    return result
+
+def register_dataset(dataset_key, filename, rows, **details):
+    # Record a processed dataset so the API and other tools can find it by id, with any details
+    # known when it was parsed (e.g. the rows and parse time of each sheet)
+    registry = get_cache('registry')
+    info = registry.get(dataset_key) or {'id': dataset_key, 'first_seen': time.time()}
+    info.update(filename=filename, rows=rows, last_seen=time.time(), **details)
+    registry.set(dataset_key, info)
+    return info
+
+def get_dataset_info(dataset_key):
+    return get_cache('registry').get(dataset_key)
+
+def list_datasets():
+    # Registered datasets, most recently seen first
+    registry = get_cache('registry')
+    datasets = [registry.get(dataset_key) for dataset_key in registry]
+    return sorted((info for info in datasets if info is not None), key=lambda info: info['last_seen'], reverse=True)
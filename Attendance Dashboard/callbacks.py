@@ -1,144 +1,257 @@
-from dash.dependencies import Input, Output, State
-from dash import html, no_update
-from sections import save_file
-from parse_contents import parse_contents
+import datetime
+import uuid
+from dash.dependencies import Input, Output, State, MATCH, ALL
+from dash import ctx, html, no_update
+from sections import save_file, year_options, default_year, create_trend_graph, create_student_records_table, create_enrolment_figure, enrolment_range_label
+from parse_contents import parse_contents, parse_consolidated, open_dataset
+from tracing import upload_trace
+from profiling import profiled
+from ml_model import load_scored_students
+from cube import level_enrolment
+from cache import list_datasets
+from history import course_trend, history_courses, student_records
+from table_query import query_table
+from scheduler import AdmissionError, admission
+
+# Most recent datasets offered in the dataset picker
+MAX_PICKER_DATASETS = 200
 
 def register_callbacks(app):
+    # Callback for giving each browser session an id, so waiting uploads are queued fairly between users
+    @app.callback(
+        Output('session-id', 'data'),
+        Input('session-id', 'modified_timestamp'),
+        State('session-id', 'data')
+    )
+    def assign_session_id(modified_timestamp, session_id):
+        return session_id or uuid.uuid4().hex
+
     # Callback for processing and displaying uploaded Excel file
+    # Runs as a background job so web workers stay free; uploading another file while
+    # a job is running makes Dash terminate the old job before starting the new one.
+    # Jobs wait for a slot in the scheduler, so only a few heavy uploads run at once
     @app.callback(
         Output('output-data-upload', 'children'),
         Output('loading-state', 'style'),  
         Output('upload-data', 'style'), 
         Input('upload-data', 'contents'),
         State('upload-data', 'filename'),
-        State('upload-data', 'last_modified')
+        State('upload-data', 'last_modified'),
+        State('consolidate-files', 'value'),
+        State('session-id', 'data'),
+        background=True,
+        progress=[Output('upload-progress', 'value'), Output('upload-progress', 'label')],
+        running=[(Output('upload-progress', 'style'), {'display': 'flex'}, {'display': 'none'})]
     )
-    def update_output(list_of_contents, list_of_names, list_of_dates):
+    @profiled('update_output')
+    def update_output(set_progress, list_of_contents, list_of_names, list_of_dates, consolidate_files, session_id):
         if list_of_contents is None:
             return [], {'display': 'none'}, {'display': 'block'}
         list_of_contents = list_of_contents if isinstance(list_of_contents, list) else [list_of_contents]
         list_of_names = list_of_names if isinstance(list_of_names, list) else [list_of_names]
         list_of_dates = list_of_dates if isinstance(list_of_dates, list) else [list_of_dates]
-        
+
+        # Show the queue position while waiting for the scheduler to let the upload start
+        def report_queue(position, memory_short):
+            set_progress((0, 'Waiting for memory to free up' if memory_short else f'Waiting for a free slot ({position} in queue)'))
+
+        # The base64 contents are about a third larger than the files, which errs on the safe side
+        payload_bytes = sum(len(content) for content in list_of_contents)
+        try:
+            with admission(session_id, payload_bytes, on_wait=report_queue):
+                return process_uploads(set_progress, list_of_contents, list_of_names, list_of_dates, consolidate_files)
+        except AdmissionError as e:
+            return [html.Div(str(e), style={'color': 'red'})], {'display': 'none'}, {'display': 'block'}
+
+    def process_uploads(set_progress, list_of_contents, list_of_names, list_of_dates, consolidate_files):
         children = []
-        for content, name, date in zip(list_of_contents, list_of_names, list_of_dates):
+        excel_files = [(content, name) for content, name in zip(list_of_contents, list_of_names) if name.endswith('.xls') or name.endswith('.xlsx')]
+        if 'combine' in (consolidate_files or []) and len(excel_files) > 1:
+            # Treat every uploaded sheet as part of one dataset
+            for name in list_of_names:
+                if not (name.endswith('.xls') or name.endswith('.xlsx')):
+                    children.append(html.Div(f'File "{name}" is not an Excel file and was not uploaded.', style={'color': 'red'}))
+            contents, names = [list(column) for column in zip(*excel_files)]
+            def report(stage, fraction):
+                set_progress((int(100 * fraction), stage))
+
+            with upload_trace(', '.join(names), payload_bytes=sum(len(content) for content in contents), files=len(names)):
+                children.append(parse_consolidated(contents, names, progress=report))
+                report('Saving', 0.95)
+                for content, name in excel_files:
+                    save_file(name, content)
+            return children, {'display': 'none'}, {'display': 'none'}
+
+        for index, (content, name, date) in enumerate(zip(list_of_contents, list_of_names, list_of_dates)):
             if not (name.endswith('.xls') or name.endswith('.xlsx')):
                 children.append(html.Div(f'File "{name}" is not an Excel file and was not uploaded.', style={'color': 'red'}))
             else:
-                child = parse_contents(content, name, date)
-                children.append(child)
-                save_file(name, content)
+                # Progress of this file's stage, scaled to its share of all uploaded files
+                def report(stage, fraction, index=index, name=name):
+                    set_progress((int(100 * (index + fraction) / len(list_of_contents)), f'{name}: {stage}'))
+
+                # Trace every stage of this upload as one structured log record
+                with upload_trace(name, payload_bytes=len(content)):
+                    child = parse_contents(content, name, date, progress=report)
+                    children.append(child)
+                    report('Saving', 0.95)
+                    save_file(name, content)
                 
         return children, {'display': 'none'}, {'display': 'none'}
     
-    # Callback for updating content based on selected student enrolment level
+    # Callback for listing the processed datasets, refreshed so exports picked up by the watcher appear
     @app.callback(
-        [Output('ug-enrolment-content', 'style'),
-         Output('pgt-enrolment-content', 'style')],
-        [Input('student-enrolment-dropdown', 'value')]
+        Output('dataset-picker', 'options'),
+        Input('dataset-refresh', 'n_intervals')
     )
-    def dropdown_student_enrolment(level_of_study):
-        # Show or hide content based on user selection in the dropdown
-        if level_of_study == 'ug':
-            return {'display': 'block'}, {'display': 'none'}
-        elif level_of_study == 'pgt':
-            return {'display': 'none'}, {'display': 'block'}
-        else:
-            return no_update, no_update # No change if the selection is unchanged
-    
-    years_of_course = {
-            'UG': range(0, 6),
-            'PGT': range(1, 3)
-        }
-    
-    # Callback for setting options in a dropdown based on level of study
+    def update_dataset_options(n_intervals):
+        return [
+            {'label': f"{info['filename']} ({info['rows']:,} rows, {datetime.datetime.fromtimestamp(info['last_seen']):%Y-%m-%d %H:%M})", 'value': info['id']}
+            for info in list_datasets()[:MAX_PICKER_DATASETS]
+        ]
+
+    # Callback for opening a processed dataset straight from the shared cache
     @app.callback(
-    Output('attendance-year-of-course-dropdown', 'options'),
-    Output('attendance-year-of-course-dropdown', 'value'),  
-    Input('attendance-level-of-study-dropdown', 'value')
+        Output('output-dataset', 'children'),
+        Input('dataset-picker', 'value'),
+        prevent_initial_call=True
     )
-    def set_year_options(level_of_study):
-        # Define dropdown options and default value based on level of study
-        if level_of_study == 'ug':
-            year_options = [{'label': f'Year {i}', 'value': str(i)} for i in years_of_course['UG']]
-            default_year = '1'
-        elif level_of_study == 'pgt':
-            year_options = [{'label': f'Year {i}', 'value': str(i)} for i in years_of_course['PGT']]
-            default_year = '1'
-
-        return year_options, default_year
-    
-    # Generates attendance graph based on available study levels and years
+    def show_dataset(dataset_key):
+        if not dataset_key:
+            return []
+        return open_dataset(dataset_key)
+
+    # Callback for listing the courses with recorded history
     @app.callback(
-    [Output(f'{level.lower()}-year-{year}-attendance', 'style') for level in ['UG', 'PGT'] for year in years_of_course[level]],
-    Input('attendance-level-of-study-dropdown', 'value'),
-    Input('attendance-year-of-course-dropdown', 'value')
+        Output('trend-course', 'options'),
+        Input('dataset-refresh', 'n_intervals')
     )
-    def show_attendance_graph(level_of_study, year_of_course):
-        visibility = {}
-        # Update visibility for each graph element based on the selected study level and year
-        for level in ['UG', 'PGT']:
-            for year in years_of_course[level]:
-                element_id = f'{level.lower()}-year-{year}-attendance'
-                if level.lower() == level_of_study and str(year) == str(year_of_course):
-                    visibility[element_id] = {'display': 'block'}
-                else:
-                    visibility[element_id] = {'display': 'none'}
-
-        return [visibility.get(f'{level.lower()}-year-{year}-attendance', {'display': 'none'}) for level in ['UG', 'PGT'] for year in years_of_course[level]]
-        
-    # Callback for setting options in a dropdown based on level of study
+    def update_trend_courses(n_intervals):
+        return [{'label': course_code, 'value': course_code} for course_code in history_courses()]
+
+    # Callback for showing a course's attendance across the recorded terms
     @app.callback(
-    Output('submission-year-of-course-dropdown', 'options'),
-    Output('submission-year-of-course-dropdown', 'value'),  
-    Input('submission-level-of-study-dropdown', 'value')
+        Output('trend-content', 'children'),
+        Input('trend-course', 'value'),
+        prevent_initial_call=True
     )
-    # Define dropdown options and default value based on level of study
-    def set_year_options(level_of_study):
-        if level_of_study == 'ug':
-            year_options = [{'label': f'Year {i}', 'value': str(i)} for i in years_of_course['UG']]
-            default_year = '1'
-        elif level_of_study == 'pgt':
-            year_options = [{'label': f'Year {i}', 'value': str(i)} for i in years_of_course['PGT']]
-            default_year = '1' 
-
-        return year_options, default_year
-    
-    # Generates attendance graph based on available study levels and years
+    def show_trend(course_code):
+        if not course_code:
+            return []
+        trend = course_trend(course_code)
+        if trend.empty:
+            return html.Div('No history has been recorded for this course yet.', className='summary-small')
+        return create_trend_graph(trend, course_code)
+
+    # Callback for looking a student up in every recorded dataset
     @app.callback(
-    [Output(f'{level.lower()}-year-{year}-submission', 'style') for level in ['UG', 'PGT'] for year in years_of_course[level]],
-    Input('submission-level-of-study-dropdown', 'value'),
-    Input('submission-year-of-course-dropdown', 'value')
+        Output('student-results', 'children'),
+        Input('student-search', 'value'),
+        prevent_initial_call=True
     )
-    def show_submission_graph(level_of_study, year_of_course):
-        visibility = {}
-        # Update visibility for each graph element based on the selected study level and year
-        for level in ['UG', 'PGT']:
-            for year in years_of_course[level]:
-                element_id = f'{level.lower()}-year-{year}-submission'
-                if level.lower() == level_of_study and str(year) == str(year_of_course):
-                    visibility[element_id] = {'display': 'block'}
-                else:
-                    visibility[element_id] = {'display': 'none'}
-
-        return [visibility.get(f'{level.lower()}-year-{year}-submission', {'display': 'none'}) for level in ['UG', 'PGT'] for year in years_of_course[level]]
-    
-    # Generates UG concerning students table based on available years
+    def search_student(user):
+        user = (user or '').strip()
+        if not user:
+            return []
+        return create_student_records_table(student_records(user))
+
+    # The sections render every level and year of course in the data, so one callback of each
+    # kind below serves all of them, in every dashboard on the page; 'instance' tells apart two
+    # renders of the same dataset
+    level_dropdown = {'type': 'level-dropdown', 'section': MATCH, 'dashboard': MATCH, 'instance': MATCH}
+    cohort_level_dropdown = {'type': 'cohort-level-dropdown', 'section': MATCH, 'dashboard': MATCH, 'instance': MATCH}
+    cohort_year_dropdown = {'type': 'cohort-year-dropdown', 'section': MATCH, 'dashboard': MATCH, 'instance': MATCH}
+    table_year_dropdown = {'type': 'table-year-dropdown', 'section': MATCH, 'dashboard': MATCH, 'instance': MATCH, 'level': MATCH}
+
+    # Callback for showing the content of the selected level of study
+    @app.callback(
+        Output({'type': 'level-content', 'section': MATCH, 'dashboard': MATCH, 'instance': MATCH, 'level': ALL}, 'style'),
+        Input(level_dropdown, 'value'),
+        prevent_initial_call=True
+    )
+    def update_level_content(level_of_study):
+        return [{'display': 'block' if output['id']['level'] == level_of_study else 'none'} for output in ctx.outputs_list]
+
+    # Callback for setting the year options to the years the selected level has
+    @app.callback(
+        Output(cohort_year_dropdown, 'options'),
+        Output(cohort_year_dropdown, 'value'),
+        Input(cohort_level_dropdown, 'value'),
+        State({'type': 'cohorts', 'section': MATCH, 'dashboard': MATCH, 'instance': MATCH}, 'data'),
+        prevent_initial_call=True
+    )
+    def update_cohort_years(level_of_study, years_by_level):
+        years = years_by_level.get(level_of_study, [])
+        return year_options(years), default_year(years) if years else None
+
+    # Callback for showing the graph of the selected level of study and year of course
+    @app.callback(
+        Output({'type': 'cohort-content', 'section': MATCH, 'dashboard': MATCH, 'instance': MATCH, 'level': ALL, 'year': ALL}, 'style'),
+        Input(cohort_level_dropdown, 'value'),
+        Input(cohort_year_dropdown, 'value'),
+        prevent_initial_call=True
+    )
+    def update_cohort_content(level_of_study, year_of_course):
+        return [
+            {'display': 'block' if (output['id']['level'], output['id']['year']) == (level_of_study, year_of_course) else 'none'}
+            for output in ctx.outputs_list
+        ]
+
+    # Callback for showing the at-risk table of the selected year within one level of study
     @app.callback(
-    [Output(f'ug-year-{year}-table', 'style') for year in range(6)],
-    [Input('ug-year-of-course-dropdown', 'value')]
+        Output({'type': 'table-content', 'section': MATCH, 'dashboard': MATCH, 'instance': MATCH, 'level': MATCH, 'year': ALL}, 'style'),
+        Input(table_year_dropdown, 'value'),
+        prevent_initial_call=True
     )
-    def show_ug_tables(selected_year):
-        # Generate a dictionary to control the visibility of each UG table
-        visibility = {f'ug-year-{year}-table': {'display': 'block' if year == selected_year else 'none'} for year in range(6)}
-        return [visibility[f'ug-year-{year}-table'] for year in range(6)]
+    def update_table_content(year_of_course):
+        return [{'display': 'block' if output['id']['year'] == year_of_course else 'none'} for output in ctx.outputs_list]
+
+    # Serves one page of a level's enrolment graph, or the courses matching a search, from the cached totals
+    enrolment = {'dashboard': MATCH, 'instance': MATCH, 'level': MATCH}
 
-    # Generates PGT concerning students table based on available years
     @app.callback(
-        [Output(f'pgt-year-{year}-table', 'style') for year in range(1, 3)],
-        [Input('pgt-year-of-course-dropdown', 'value')]
+        Output({'type': 'enrolment-graph', **enrolment}, 'figure'),
+        Output({'type': 'enrolment-range', **enrolment}, 'children'),
+        Output({'type': 'enrolment-page', **enrolment}, 'data'),
+        Input({'type': 'enrolment-search', **enrolment}, 'value'),
+        Input({'type': 'enrolment-previous', **enrolment}, 'n_clicks'),
+        Input({'type': 'enrolment-next', **enrolment}, 'n_clicks'),
+        State({'type': 'enrolment-page', **enrolment}, 'data'),
+        prevent_initial_call=True
     )
-    def show_pgt_tables(selected_year):
-        # Generate a dictionary to control the visibility of each PGT table
-        visibility = {f'pgt-year-{year}-table': {'display': 'block' if year == selected_year else 'none'} for year in range(1, 3)}
-        return [visibility[f'pgt-year-{year}-table'] for year in range(1, 3)]
\ No newline at end of file
+    def update_enrolment_page(search, previous_clicks, next_clicks, page):
+        dashboard_key, level_of_study = ctx.triggered_id['dashboard'], ctx.triggered_id['level']
+        enrolment_data = level_enrolment(dashboard_key, level_of_study) if dashboard_key else None
+        if enrolment_data is None:
+            return no_update, no_update, no_update
+
+        # A new search starts from the first page
+        step = {'enrolment-previous': -1, 'enrolment-next': 1}.get(ctx.triggered_id['type'], None)
+        page = 0 if step is None else (page or 0) + step
+        figure, page, shown, matching = create_enrolment_figure(enrolment_data, level_of_study, search, page)
+        return figure, enrolment_range_label(page, shown, matching), page
+
+    # Serves one page of an at-risk table at a time from the cached scored frame
+    at_risk_table = {'type': 'at-risk-table', 'dataset': MATCH, 'instance': MATCH, 'level': MATCH, 'year': MATCH}
+
+    @app.callback(
+        Output(at_risk_table, 'data'),
+        Output(at_risk_table, 'page_count'),
+        Input(at_risk_table, 'page_current'),
+        Input(at_risk_table, 'page_size'),
+        Input(at_risk_table, 'sort_by'),
+        Input(at_risk_table, 'filter_query'),
+        State(at_risk_table, 'id'),
+        prevent_initial_call=True
+    )
+    def update_at_risk_table(page_current, page_size, sort_by, filter_query, table_id):
+        scored = load_scored_students(table_id['dataset'])
+        if scored is None:
+            return no_update, no_update
+
+        # Restrict the scored frame to this table's level and year, then page it
+        students_list = scored[
+            (scored['Level of Study'] == table_id['level']) &
+            (scored['Year of Course'] == table_id['year'])
+        ]
+        return query_table(students_list, page_current or 0, page_size, sort_by, filter_query)
@@ -0,0 +1,187 @@
+import os
+import numpy as np
+import pandas as pd
+from cache import CACHE_DIR, CACHE_EXPIRE, CACHE_VERSION, PARQUET_DIR, dataset_id, get_cache, load_dataframe, store_result
+from cube import DIMENSIONS, MEASURES
+
+# Columns the consolidated views need; everything else in a sheet is left out of the Parquet copy
+COLUMNS = ['User', 'Level of Study', 'Year of Course', 'Course Code', 'Quarter', '% Attendance', 'Submitted', 'Assessments']
+
+# DuckDB spills to disk beyond this much memory, so many sheets can be combined on a small machine
+DUCKDB_MEMORY_LIMIT = os.environ.get('DASHBOARD_DUCKDB_MEMORY', '1GB')
+
+def dataset_parquet(dataset_key, df=None):
+    # Path of the dataset's Parquet copy, writing it from df (or the cached DataFrame) if it is missing
+    path = os.path.join(PARQUET_DIR, f'{dataset_key}.parquet')
+    if os.path.exists(path):
+        return path
+
+    if df is None:
+        df = load_dataframe(dataset_key)
+        if df is None:
+            raise ValueError(f'Dataset {dataset_key} was not found or has expired; upload it again.')
+    for column in COLUMNS:
+        if column not in df.columns:
+            raise ValueError("Missing required column: {}".format(column))
+
+    # Use one type per column in every file so the sheets can be read as a single table
+    table = pd.DataFrame({
+        'User': df['User'].astype('string'),
+        'Level of Study': df['Level of Study'].astype('string'),
+        'Year of Course': pd.to_numeric(df['Year of Course'], errors='coerce').astype(float),
+        'Course Code': df['Course Code'].astype('string'),
+        'Quarter': pd.to_numeric(df['Quarter'], errors='coerce').astype(float),
+        '% Attendance': pd.to_numeric(df['% Attendance'], errors='coerce').astype(float),
+        'Submitted': pd.to_numeric(df['Submitted'], errors='coerce').astype(float),
+        'Assessments': pd.to_numeric(df['Assessments'], errors='coerce').astype(float),
+    })
+
+    # Write to a temporary name first so other workers never read a half-written file
+    os.makedirs(PARQUET_DIR, exist_ok=True)
+    temporary = f'{path}.{os.getpid()}.tmp'
+    table.to_parquet(temporary, index=False)
+    os.replace(temporary, path)
+    return path
+
+def _connect():
+    import duckdb
+
+    connection = duckdb.connect()
+    connection.execute(f"SET memory_limit = '{DUCKDB_MEMORY_LIMIT}'")
+    connection.execute(f"SET temp_directory = '{os.path.join(CACHE_DIR, 'duckdb')}'")
+    return connection
+
+def _labels(values):
+    # Sorted labels of a dimension, as integers when the values are whole numbers
+    labels = np.sort(values.unique())
+    if labels.dtype.kind == 'f' and np.all(labels == np.round(labels)):
+        labels = labels.astype(np.int64)
+    return labels
+
+def _build_cube(connection):
+    # Same structure as cube.build_cube, with the grouping done by DuckDB over the Parquet files
+    dims = ', '.join(f'"{dim}"' for dim in DIMENSIONS)
+    cells = connection.execute(f"""
+        SELECT {dims},
+            count(*) AS rows,
+            coalesce(sum("% Attendance"), 0) AS attendance_sum,
+            count("% Attendance") AS attendance_count,
+            coalesce(sum("Submitted") FILTER (WHERE "Assessments" IS NOT NULL), 0) AS submitted_sum,
+            coalesce(sum("Assessments") FILTER (WHERE "Submitted" IS NOT NULL), 0) AS assessments_sum,
+            count(*) FILTER (WHERE "Submitted" IS NOT NULL AND "Assessments" IS NOT NULL) AS submission_count
+        FROM sheets
+        WHERE {' AND '.join(f'"{dim}" IS NOT NULL' for dim in DIMENSIONS)}
+        GROUP BY ALL
+    """).df()
+
+    labels = {dim: _labels(cells[dim]) for dim in DIMENSIONS}
+    shape = tuple(len(labels[dim]) for dim in DIMENSIONS)
+    size = int(np.prod(shape))
+    positions = [np.searchsorted(labels[dim], cells[dim].to_numpy()) for dim in DIMENSIONS]
+    flat = np.ravel_multi_index(positions, shape)
+
+    measures = {}
+    for name in MEASURES:
+        values = np.zeros(size, dtype=float if name.endswith('_sum') else np.int64)
+        values[flat] = cells[name].to_numpy()
+        measures[name] = values.reshape(shape)
+
+    # Distinct students per cell, as sorted student codes with an offset per cell
+    pairs = connection.execute(f"""
+        SELECT DISTINCT {dims}, "User" FROM sheets
+        WHERE "User" IS NOT NULL AND {' AND '.join(f'"{dim}" IS NOT NULL' for dim in DIMENSIONS)}
+    """).df()
+    pair_cells = np.ravel_multi_index([np.searchsorted(labels[dim], pairs[dim].to_numpy()) for dim in DIMENSIONS], shape)
+    user_codes, users = pd.factorize(pairs['User'])
+    order = np.lexsort((user_codes, pair_cells))
+    user_ptr = np.concatenate([[0], np.cumsum(np.bincount(pair_cells, minlength=size))])
+
+    return {
+        'labels': labels,
+        'shape': shape,
+        'measures': measures,
+        'user_ptr': user_ptr,
+        'user_codes': user_codes[order].astype(np.int32),
+        'users': np.asarray(users),
+    }
+
+def _summaries(connection, by=()):
+    # Same cards as data_processing.calculate_summary_statistics(_by), computed over every sheet at once
+    groups = ', '.join(f'"{column}"' for column in by)
+    select = f'{groups}, ' if by else ''
+    partition = f'PARTITION BY {groups} ' if by else ''
+    not_missing = ''.join(f' AND "{column}" IS NOT NULL' for column in by)
+
+    # Students are counted the way pandas.factorize does, where a missing User counts as one more student
+    rows = connection.execute(f"""
+        WITH clean AS (
+            SELECT * FROM sheets
+            WHERE "% Attendance" IS NOT NULL AND "Submitted" IS NOT NULL AND "Assessments" IS NOT NULL
+                AND "Quarter" IS NOT NULL{not_missing}
+        ),
+        totals AS (
+            SELECT {select}
+                count(DISTINCT "User") FILTER (WHERE "Quarter" = 4) AS total_students,
+                count(DISTINCT "User") + max(("User" IS NULL)::INT) AS enrolled,
+                count(DISTINCT "User") FILTER (WHERE "% Attendance" > 0)
+                    + coalesce(max(("User" IS NULL)::INT) FILTER (WHERE "% Attendance" > 0), 0) AS active,
+                avg("% Attendance") * 100 AS average_attendance,
+                sum("Submitted") AS total_submissions,
+                sum("Assessments") AS total_assessments
+            FROM clean GROUP BY ALL
+        ),
+        courses AS (
+            SELECT {select}"Course Code", avg("% Attendance") * 100 AS attendance
+            FROM clean WHERE "Course Code" IS NOT NULL GROUP BY ALL
+        ),
+        ranked AS (
+            SELECT *,
+                row_number() OVER ({partition}ORDER BY attendance DESC, "Course Code") AS highest,
+                row_number() OVER ({partition}ORDER BY attendance, "Course Code") AS lowest
+            FROM courses
+        )
+        SELECT totals.*,
+            h."Course Code" AS highest_course, h.attendance AS highest_attendance,
+            l."Course Code" AS lowest_course, l.attendance AS lowest_attendance
+        FROM totals
+        JOIN ranked h ON h.highest = 1{''.join(f' AND h."{column}" = totals."{column}"' for column in by)}
+        JOIN ranked l ON l.lowest = 1{''.join(f' AND l."{column}" = totals."{column}"' for column in by)}
+        {f'ORDER BY {groups}' if by else ''}
+    """).df()
+
+    summaries = []
+    for row in rows.to_dict('records'):
+        summaries.append((tuple(row[column] for column in by), {
+            'total_students': int(row['total_students']),
+            'dropout_rate': 100 * (1 - (row['active'] / row['enrolled'])),
+            'average_attendance': row['average_attendance'],
+            'average_submission_rate': (row['total_submissions'] / row['total_assessments']) * 100 if row['total_assessments'] > 0 else 0,
+            'course_with_highest_attendance': (row['highest_course'], row['highest_attendance']),
+            'course_with_lowest_attendance': (row['lowest_course'], row['lowest_attendance']),
+        }))
+    return summaries
+
+def consolidated_id(dataset_keys):
+    # One id for a set of datasets, whatever order they were uploaded in
+    return dataset_id('\n'.join(sorted(set(dataset_keys))).encode())
+
+def consolidate(dataset_keys, by='Level of Study'):
+    # Summary, summary per value of `by` and aggregate cube of several datasets treated as one,
+    # aggregated out of core by DuckDB so the combined rows never have to fit in memory
+    key = ('consolidated', CACHE_VERSION, consolidated_id(dataset_keys), by)
+    cache = get_cache()
+    result = cache.get(key)
+    if result is None:
+        paths = [dataset_parquet(dataset_key) for dataset_key in sorted(set(dataset_keys))]
+        connection = _connect()
+        try:
+            connection.read_parquet(paths).create_view('sheets')
+            summary = _summaries(connection)[0][1]
+            summary_by = {group[0]: values for group, values in _summaries(connection, [by])}
+            result = summary, summary_by, _build_cube(connection)
+        finally:
+            connection.close()
+        cache.set(key, result, expire=CACHE_EXPIRE)
+        # Also keep the cube under the combined id, so the dashboard's callbacks can query it like a single dataset's
+        store_result('cube', consolidated_id(dataset_keys), result[2])
+    return result
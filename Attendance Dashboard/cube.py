@@ -0,0 +1,240 @@
+import numpy as np
+import pandas as pd
+from cache import cached_result, load_dataframe, load_result, store_result
+
+# Finest grain of the cube; every view in the dashboard is a roll-up over these
+DIMENSIONS = ['Level of Study', 'Year of Course', 'Course Code', 'Quarter']
+
+# Additive measures stored for every cell
+MEASURES = ['rows', 'attendance_sum', 'attendance_count', 'submitted_sum', 'assessments_sum', 'submission_count']
+
+# Levels of study shown first on the dashboard; any other level in the data follows alphabetically
+LEVEL_ORDER = ['UG', 'PGT']
+
+def build_cube(df):
+    # Check if necessary columns exist
+    required_columns = DIMENSIONS + ['User', '% Attendance', 'Submitted', 'Assessments']
+    for column in required_columns:
+        if column not in df.columns:
+            raise ValueError("Missing required column: {}".format(column))
+
+    # Coerce the numeric columns the same way data_processing does, without modifying df
+    attendance = pd.to_numeric(df['% Attendance'], errors='coerce').to_numpy(dtype=float)
+    submitted = pd.to_numeric(df['Submitted'], errors='coerce').to_numpy(dtype=float)
+    assessments = pd.to_numeric(df['Assessments'], errors='coerce').to_numpy(dtype=float)
+    columns = {
+        'Level of Study': df['Level of Study'],
+        'Year of Course': pd.to_numeric(df['Year of Course'], errors='coerce'),
+        'Course Code': df['Course Code'],
+        'Quarter': pd.to_numeric(df['Quarter'], errors='coerce'),
+    }
+
+    # Factorise each dimension; rows missing any dimension are left out, as the groupbys would
+    codes, labels = [], {}
+    keep = np.ones(len(df), dtype=bool)
+    for dim in DIMENSIONS:
+        dim_codes, dim_labels = pd.factorize(columns[dim], sort=True)
+        codes.append(dim_codes)
+        labels[dim] = np.asarray(dim_labels)
+        keep &= dim_codes >= 0
+
+    shape = tuple(len(labels[dim]) for dim in DIMENSIONS)
+    size = int(np.prod(shape))
+    cells = np.ravel_multi_index([dim_codes[keep] for dim_codes in codes], shape)
+    attendance, submitted, assessments = attendance[keep], submitted[keep], assessments[keep]
+
+    # Attendance and submission measures only count rows where those values are present
+    has_attendance = ~np.isnan(attendance)
+    has_submission = ~np.isnan(submitted) & ~np.isnan(assessments)
+    measures = {
+        'rows': np.bincount(cells, minlength=size),
+        'attendance_sum': np.bincount(cells[has_attendance], weights=attendance[has_attendance], minlength=size),
+        'attendance_count': np.bincount(cells[has_attendance], minlength=size),
+        'submitted_sum': np.bincount(cells[has_submission], weights=submitted[has_submission], minlength=size),
+        'assessments_sum': np.bincount(cells[has_submission], weights=assessments[has_submission], minlength=size),
+        'submission_count': np.bincount(cells[has_submission], minlength=size),
+    }
+
+    # Distinct students per cell, stored as sorted student codes with an offset per cell
+    user_codes, users = pd.factorize(df['User'])
+    user_codes = user_codes[keep]
+    has_user = user_codes >= 0
+    pairs = np.unique(cells[has_user].astype(np.int64) * len(users) + user_codes[has_user])
+    user_ptr = np.concatenate([[0], np.cumsum(np.bincount(pairs // len(users), minlength=size))])
+
+    return {
+        'labels': labels,
+        'shape': shape,
+        'measures': {name: values.reshape(shape) for name, values in measures.items()},
+        'user_ptr': user_ptr,
+        'user_codes': (pairs % len(users)).astype(np.int32),
+        'users': np.asarray(users),
+    }
+
+def get_cube(df):
+    # Build the cube once per dataset and share it through the result cache
+    return cached_result('cube', df, lambda: build_cube(df))
+
+def load_cube(dataset_key):
+    # Cube of a stored dataset (or of combined uploads) for callbacks that query it again,
+    # rebuilt from the cached sheet if it has expired; None if the dataset is gone
+    cube = load_result('cube', dataset_key)
+    if cube is None:
+        df = load_dataframe(dataset_key)
+        if df is None:
+            return None
+        df.attrs['dataset_id'] = dataset_key
+        cube = get_cube(df)
+    return cube
+
+def _select(cube, where):
+    # Positions along each dimension that match the filter (every position when unfiltered)
+    index = []
+    for dim in DIMENSIONS:
+        labels = cube['labels'][dim]
+        if where and dim in where:
+            wanted = where[dim] if isinstance(where[dim], (list, tuple, set)) else [where[dim]]
+            index.append(np.flatnonzero(np.isin(labels, list(wanted))))
+        else:
+            index.append(np.arange(len(labels)))
+    return index
+
+def rollup(cube, measure, by=(), where=None):
+    # Sum an additive measure over every dimension not in `by`, after filtering with `where`
+    # Returns the array (axes in the order of `by`) and the labels along each axis
+    index = _select(cube, where)
+    values = cube['measures'][measure][np.ix_(*index)]
+    result = values.sum(axis=tuple(i for i, dim in enumerate(DIMENSIONS) if dim not in by))
+
+    kept = [dim for dim in DIMENSIONS if dim in by]
+    result = result.transpose([kept.index(dim) for dim in by])
+    return result, [cube['labels'][dim][index[DIMENSIONS.index(dim)]] for dim in by]
+
+def distinct_users(cube, by=(), where=None):
+    # Count distinct students for each combination of `by`, after filtering with `where`
+    index = _select(cube, where)
+    out_shape = [len(index[DIMENSIONS.index(dim)]) for dim in by]
+    out_size = int(np.prod(out_shape))
+
+    # Every selected cell, and the output position it rolls up into
+    grid = np.meshgrid(*index, indexing='ij')
+    cells = np.ravel_multi_index(grid, cube['shape']).ravel()
+    positions = np.meshgrid(*[np.arange(len(i)) for i in index], indexing='ij')
+    owners = np.ravel_multi_index([positions[DIMENSIONS.index(dim)] for dim in by], out_shape).ravel() if by else np.zeros(len(cells), dtype=np.intp)
+
+    # Gather the students of every selected cell without a Python loop
+    starts = cube['user_ptr'][cells]
+    lengths = cube['user_ptr'][cells + 1] - starts
+    offsets = np.cumsum(lengths) - lengths
+    gather = np.arange(lengths.sum()) - np.repeat(offsets, lengths) + np.repeat(starts, lengths)
+    students = cube['user_codes'][gather]
+    owners = np.repeat(owners, lengths)
+
+    # Count each student once per output position, using a position x student presence table
+    # (or a sort when that table would be too large, e.g. every course and year of a big export)
+    n_users = len(cube['users'])
+    pairs = owners.astype(np.int64) * n_users + students
+    if out_size * n_users <= 10_000_000:
+        seen = np.zeros(out_size * n_users, dtype=bool)
+        seen[pairs] = True
+        counts = seen.reshape(out_size, n_users).sum(axis=1)
+    else:
+        counts = np.bincount(np.unique(pairs) // n_users, minlength=out_size)
+    result = counts.reshape(out_shape)
+    return result, [cube['labels'][dim][index[DIMENSIONS.index(dim)]] for dim in by]
+
+def _position(cube, dim, value):
+    # Position of a label along a dimension, or None if the dataset does not contain it
+    matches = np.flatnonzero(cube['labels'][dim] == value)
+    return matches[0] if len(matches) else None
+
+def cohorts(cube):
+    # Years of course that have data, for each level of study in display order
+    rows, (levels, years) = rollup(cube, 'rows', by=['Level of Study', 'Year of Course'])
+    result = {str(level): [year.item() for year in years[np.flatnonzero(rows[i])]] for i, level in enumerate(levels)}
+    order = sorted(result, key=lambda level: (LEVEL_ORDER.index(level) if level in LEVEL_ORDER else len(LEVEL_ORDER), level))
+    return {level: result[level] for level in order if result[level]}
+
+def cube_student_enrolment(cube, level_of_study, years=None):
+    # Same result as data_processing.calculate_student_enrolment, answered from the cube;
+    # pass `years` to count only those years of course instead of the fixed ones (any level
+    # other than UG and PGT has no fixed years, so the years it has data for are counted)
+    if years is None:
+        fixed_years = {'UG': range(0, 6), 'PGT': range(1, 3)}
+        years = fixed_years.get(level_of_study) or cohorts(cube).get(level_of_study, [])
+    where = {'Level of Study': level_of_study, 'Quarter': 4}
+
+    per_course, (courses,) = distinct_users(cube, by=['Course Code'], where=where)
+    per_course_year, (_, year_labels) = distinct_users(cube, by=['Course Code', 'Year of Course'], where=where)
+    enrolled = np.flatnonzero(per_course)
+
+    total_students_per_year_by_course = {}
+    for year in years:
+        column = np.flatnonzero(year_labels == year)
+        counts = per_course_year[enrolled, column[0]] if len(column) else np.zeros(len(enrolled), dtype=int)
+        total_students_per_year_by_course[f'Year {year}'] = list(counts)
+
+    enrolment_result = {
+        'total_students_per_course': dict(zip(courses[enrolled], per_course[enrolled])),
+        'total_students_per_year_by_course': total_students_per_year_by_course
+    }
+    return enrolment_result
+
+def level_enrolment(dataset_key, level_of_study, cube=None):
+    # cube_student_enrolment for the years of course that have data, with those years. It is a few
+    # numbers per course, so it is counted once per dataset and level and kept in the result cache,
+    # and paging or searching the enrolment graph only slices it; None if the dataset is gone
+    kind = ('enrolment', level_of_study)
+    result = load_result(kind, dataset_key) if dataset_key else None
+    if result is None:
+        cube = load_cube(dataset_key) if cube is None else cube
+        if cube is None:
+            return None
+        years = cohorts(cube).get(level_of_study, [])
+        result = dict(cube_student_enrolment(cube, level_of_study, years), years=years)
+        if dataset_key:
+            store_result(kind, dataset_key, result)
+    return result
+
+def cube_attendance_rate(cube, level_of_study, year_of_course):
+    # Same result as data_processing.calculate_attendance_rate, answered from the cube
+    position = _position(cube, 'Year of Course', year_of_course)
+    if position is None:
+        return {}
+    year_label = cube['labels']['Year of Course'][position]
+
+    where = {'Level of Study': level_of_study, 'Year of Course': year_of_course}
+    sums, (courses, quarters) = rollup(cube, 'attendance_sum', by=['Course Code', 'Quarter'], where=where)
+    counts, _ = rollup(cube, 'attendance_count', by=['Course Code', 'Quarter'], where=where)
+
+    attendance_result = {}
+    for i, course_code in enumerate(courses):
+        present = np.flatnonzero(counts[i])
+        if len(present):
+            # Mean attendance per quarter, converted to a percentage
+            course_attendance = {quarters[j]: sums[i, j] / counts[i, j] * 100 for j in present}
+            attendance_result[(course_code, year_label)] = {
+                'attendance_by_quarter': course_attendance,
+                'average_attendance': sum(course_attendance.values()) / len(course_attendance)
+            }
+
+    return attendance_result
+
+def cube_submission_rate(cube, level_of_study, year_of_course):
+    # Same result as data_processing.calculate_submission_rate, answered from the cube
+    where = {'Level of Study': level_of_study, 'Year of Course': year_of_course}
+    submitted, (courses,) = rollup(cube, 'submitted_sum', by=['Course Code'], where=where)
+    assessments, _ = rollup(cube, 'assessments_sum', by=['Course Code'], where=where)
+    counts, _ = rollup(cube, 'submission_count', by=['Course Code'], where=where)
+
+    submission_result = {}
+    for i in np.flatnonzero(counts):
+        course_code = courses[i]
+        average_submission_rate = (submitted[i] / assessments[i] * 100) if assessments[i] > 0 else 0
+        submission_result[course_code] = {
+            'Course Code': course_code,
+            'Year of Course': year_of_course,
+            'Average Submission Rate': round(average_submission_rate, 2)  # rounding to 2 decimal places for neatness
+        }
+
+    return submission_result
@@ -1,8 +1,9 @@
+import numpy as np
 import pandas as pd
 
-def calculate_summary_statistics(df):
+def _coerce_summary_columns(df, by=()):
     # Check if necessary columns exist
-    required_columns = ['User', '% Attendance', 'Submitted', 'Assessments', 'Course Code', 'Quarter']
+    required_columns = ['User', '% Attendance', 'Submitted', 'Assessments', 'Course Code', 'Quarter'] + list(by)
     for column in required_columns:
         if column not in df.columns:
             raise ValueError("Missing required column: {}".format(column))
@@ -14,41 +15,92 @@ def calculate_summary_statistics(df):
     df['Quarter'] = pd.to_numeric(df['Quarter'], errors='coerce')
     
     # Drop rows with NaN values that were created due to coercion errors
-    df = df.dropna(subset=['% Attendance', 'Submitted', 'Assessments', 'Quarter'])
-
-    # Total Students
-    current_students = df[df['Quarter'] == 4]
-    total_students = current_students['User'].nunique()
-
-    # Average Attendance
-    average_attendance = df['% Attendance'].mean() * 100  # Convert to percentage
-    
-    # Dropout Rate
-    total_enrolled = len(df['User'].unique())
-    total_active = len(df.loc[df['% Attendance'] > 0, 'User'].unique())
-    dropout_rate = 100 * (1 - (total_active / total_enrolled))
-    
-    # Average Submission Rate
-    total_submissions = df['Submitted'].sum()
-    total_assessments = df['Assessments'].sum()
-    average_submission_rate = (total_submissions / total_assessments) * 100 if total_assessments > 0 else 0
-    
-    # Course Attendance
-    course_attendance = df.groupby('Course Code')['% Attendance'].mean() * 100
-    course_with_highest_attendance = course_attendance.idxmax(), course_attendance.max()
-    course_with_lowest_attendance = course_attendance.idxmin(), course_attendance.min()
-
-    # Prepare the result dictionary
-    summary_result = {
-        'total_students': total_students,
-        'dropout_rate': dropout_rate,
-        'average_attendance': average_attendance,
-        'average_submission_rate': average_submission_rate,
-        'course_with_highest_attendance': course_with_highest_attendance,
-        'course_with_lowest_attendance': course_with_lowest_attendance,
-    }
+    return df.dropna(subset=['% Attendance', 'Submitted', 'Assessments', 'Quarter'])
+
+def _summary_kernel(df, by=()):
+    # Factorise the keys once, then derive every card value with weighted bincounts
+    # over the codes, so the rows are scanned a single time for all groups at once
+    user_codes, users = pd.factorize(df['User'], use_na_sentinel=False)
+    course_codes, courses = pd.factorize(df['Course Code'], sort=True)
+    n_users, n_courses = len(users), len(courses)
+    attendance = df['% Attendance'].to_numpy(dtype=float)
+    submitted = df['Submitted'].to_numpy(dtype=float)
+    assessments = df['Assessments'].to_numpy(dtype=float)
+    current_rows = (df['Quarter'].to_numpy() == 4) & df['User'].notna().to_numpy()
+
+    if by:
+        # Combine the codes of each column into one code per existing combination,
+        # leaving out rows with a missing value as groupby would
+        level_codes, level_values = zip(*(pd.factorize(df[column], sort=True) for column in by))
+        keep = np.logical_and.reduce([codes >= 0 for codes in level_codes])
+        shape = [len(values) for values in level_values]
+        combined = np.ravel_multi_index([codes[keep] for codes in level_codes], shape)
+        present, group_codes = np.unique(combined, return_inverse=True)
+        groups = list(zip(*(values[codes] for values, codes in zip(level_values, np.unravel_index(present, shape)))))
+        if len(by) == 1:
+            groups = [group[0] for group in groups]
+
+        user_codes, course_codes, attendance = user_codes[keep], course_codes[keep], attendance[keep]
+        submitted, assessments, current_rows = submitted[keep], assessments[keep], current_rows[keep]
+    else:
+        group_codes, groups = np.zeros(len(df), dtype=np.intp), [None]
+    n_groups = len(groups)
+
+    # Row counts and sums per group
+    row_count = np.bincount(group_codes, minlength=n_groups)
+    attendance_sum = np.bincount(group_codes, weights=attendance, minlength=n_groups)
+    submitted_sum = np.bincount(group_codes, weights=submitted, minlength=n_groups)
+    assessments_sum = np.bincount(group_codes, weights=assessments, minlength=n_groups)
+
+    # Attendance sums and counts per group and course
+    has_course = course_codes >= 0
+    cells = group_codes[has_course] * n_courses + course_codes[has_course]
+    course_sum = np.bincount(cells, weights=attendance[has_course], minlength=n_groups * n_courses).reshape(n_groups, n_courses)
+    course_count = np.bincount(cells, minlength=n_groups * n_courses).reshape(n_groups, n_courses)
+
+    # Distinct students per group among the rows selected by a mask, using a
+    # group x student presence table (or a sort when that table would be too large)
+    def distinct_users(mask):
+        pairs = group_codes[mask].astype(np.int64) * n_users + user_codes[mask]
+        if n_groups * n_users <= 10_000_000:
+            seen = np.zeros(n_groups * n_users, dtype=bool)
+            seen[pairs] = True
+            return seen.reshape(n_groups, n_users).sum(axis=1)
+        return np.bincount(np.unique(pairs) // n_users, minlength=n_groups)
+
+    enrolled = distinct_users(np.ones(len(group_codes), dtype=bool))
+    active = distinct_users(attendance > 0)
+    current = distinct_users(current_rows)
+
+    summaries = []
+    for g, group in enumerate(groups):
+        # Course Attendance
+        offered = np.flatnonzero(course_count[g])
+        course_attendance = course_sum[g, offered] / course_count[g, offered] * 100
+        highest, lowest = offered[np.argmax(course_attendance)], offered[np.argmin(course_attendance)]
+
+        total_submissions, total_assessments = submitted_sum[g], assessments_sum[g]
+        summaries.append((group, {
+            'total_students': int(current[g]),
+            'dropout_rate': 100 * (1 - (active[g] / enrolled[g])),
+            'average_attendance': attendance_sum[g] / row_count[g] * 100,  # Convert to percentage
+            'average_submission_rate': (total_submissions / total_assessments) * 100 if total_assessments > 0 else 0,
+            'course_with_highest_attendance': (courses[highest], course_attendance.max()),
+            'course_with_lowest_attendance': (courses[lowest], course_attendance.min()),
+        }))
+
+    return summaries
 
-    return summary_result
+def calculate_summary_statistics(df):
+    df = _coerce_summary_columns(df)
+    return _summary_kernel(df)[0][1]
+
+def calculate_summary_statistics_by(df, by):
+    # Summary cards per value of one or more columns (e.g. 'Level of Study') for drill-down,
+    # computed in the same single pass as the overall summary
+    by = [by] if isinstance(by, str) else list(by)
+    df = _coerce_summary_columns(df, by)
+    return dict(_summary_kernel(df, by))
 
 def calculate_student_enrolment(df, level_of_study):
     # Check if necessary columns exist
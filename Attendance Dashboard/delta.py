@@ -0,0 +1,104 @@
+import pandas as pd
+from cache import cached_result, get_dataset_info, list_datasets, load_dataframe, load_result, store_result
+from history import user_key
+from ml_model import score_students
+from schema import REQUIRED_COLUMNS
+
+# Columns identifying a row across uploads of the same export
+KEY_COLUMNS = ['User', 'Course Code', 'Quarter']
+
+# Results that depend only on the rows, so an upload with the same rows as the previous one can reuse them
+REUSABLE_RESULTS = ['cube', 'at_risk']
+
+def _hashable(df, columns):
+    # Columns in a form that hashes the same whichever way the export stored them, e.g. a year read
+    # as 2 in one file and 2.0 in another (a column with gaps), or a student code read as text
+    frame = {}
+    for column in columns:
+        values = df[column]
+        numeric = pd.to_numeric(values, errors='coerce')
+        if REQUIRED_COLUMNS.get(column) or numeric.notna().sum() == values.notna().sum():
+            frame[column] = numeric.astype('float64')
+        else:
+            frame[column] = values.astype(str)
+    return pd.DataFrame(frame)
+
+def fingerprint(df):
+    # A 64-bit hash of every row's key and of its values in the columns the dashboard reads, computed
+    # in one vectorised pass and cached per dataset, so the previous upload's fingerprint is free to load
+    def compute():
+        keys = pd.util.hash_pandas_object(_hashable(df, KEY_COLUMNS), index=False).to_numpy()
+        values = pd.util.hash_pandas_object(_hashable(df, list(REQUIRED_COLUMNS)), index=False).to_numpy()
+        return pd.DataFrame({
+            'key': keys,
+            # Number repeated keys (e.g. a student listed on two sheets) so every row can be matched
+            'occurrence': pd.Series(keys).groupby(keys).cumcount().to_numpy(),
+            'values': values,
+            'user': df['User'].map(user_key).to_numpy(),
+            'course': df['Course Code'].astype(str).to_numpy(),
+        })
+    return cached_result('fingerprint', df, compute)
+
+def previous_upload(dataset_key):
+    # The most recent dataset first uploaded before this one under the same file name, taken to be
+    # the previous export of the same course list; a later upload is never compared against, even
+    # when an older dataset is opened again
+    info = get_dataset_info(dataset_key)
+    if info is None:
+        return None
+    earlier = [other for other in list_datasets() if other['filename'] == info['filename'] and other['first_seen'] < info['first_seen']]
+    return max(earlier, key=lambda other: other['first_seen'], default=None)
+
+def compare_rows(before, after):
+    # Rows added, removed and changed between two fingerprints, matched on their keys
+    merged = before.merge(after, on=['key', 'occurrence'], how='outer', suffixes=('_before', '_after'), indicator=True)
+    added = merged['_merge'] == 'right_only'
+    removed = merged['_merge'] == 'left_only'
+    changed = (merged['_merge'] == 'both') & (merged['values_before'] != merged['values_after'])
+    affected = merged[added | removed | changed]
+    return {
+        'rows_added': int(added.sum()),
+        'rows_removed': int(removed.sum()),
+        'rows_changed': int(changed.sum()),
+        'rows_unchanged': int((merged['_merge'] == 'both').sum() - changed.sum()),
+        'users': sorted(set(affected['user_after'].dropna()) | set(affected['user_before'].dropna())),
+        'courses': sorted(set(affected['course_after'].dropna()) | set(affected['course_before'].dropna())),
+    }
+
+def changes_since_previous(df):
+    # What changed since the previous upload of the same export, or None for a first upload. When the
+    # rows are the same, the previous upload's cube and at-risk scores are reused instead of recomputed
+    dataset_key = df.attrs.get('dataset_id')
+    previous = previous_upload(dataset_key)
+    if previous is None:
+        return None
+
+    def compute():
+        before = load_result('fingerprint', previous['id'])
+        if before is None:
+            previous_df = load_dataframe(previous['id'])
+            if previous_df is None:
+                return None
+            previous_df.attrs['dataset_id'] = previous['id']
+            before = fingerprint(previous_df)
+
+        changes = compare_rows(before, fingerprint(df))
+        changes.update(previous_id=previous['id'], previous_seen=previous['first_seen'])
+        if not (changes['rows_added'] or changes['rows_removed'] or changes['rows_changed']):
+            for kind in REUSABLE_RESULTS:
+                result = load_result(kind, previous['id'])
+                if result is not None and load_result(kind, dataset_key) is None:
+                    store_result(kind, dataset_key, result)
+        return changes
+    # Cached against the previous upload too, so the comparison is made again if that is no longer the same dataset
+    return cached_result(('changes', previous['id']), df, compute)
+
+def at_risk_changes(df, changes):
+    # Students flagged now but not in the previous upload, and the other way round; None when the
+    # previous upload's scores are no longer cached
+    previous = load_result('at_risk', changes['previous_id']) if changes else None
+    if previous is None:
+        return None
+    before = set(previous['User'].map(user_key))
+    after = set(score_students(df)['User'].map(user_key))
+    return {'newly_at_risk': sorted(after - before), 'no_longer_at_risk': sorted(before - after)}
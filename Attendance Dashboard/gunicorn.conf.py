@@ -0,0 +1,26 @@
+import multiprocessing
+import os
+
+# Run from the dashboard directory so relative paths such as uploaded_files/ resolve
+chdir = os.path.dirname(os.path.abspath(__file__))
+
+bind = os.environ.get('DASHBOARD_BIND', '0.0.0.0:8050')
+
+# Worker and thread counts; each worker handles one upload per thread
+workers = int(os.environ.get('DASHBOARD_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('DASHBOARD_THREADS', '2'))
+worker_class = 'gthread' if threads > 1 else 'sync'
+
+# Load the app (and sklearn, plotly and pandas) in the master before forking workers
+preload_app = True
+
+# Uploads of large workbooks can take a while to parse and score
+timeout = int(os.environ.get('DASHBOARD_TIMEOUT', '120'))
+graceful_timeout = 30
+
+# Recycle workers periodically to bound memory growth
+max_requests = int(os.environ.get('DASHBOARD_MAX_REQUESTS', '500'))
+max_requests_jitter = 50
+
+accesslog = '-'
+errorlog = '-'
@@ -0,0 +1,275 @@
+# Term-over-term store of course aggregates and at-risk students, and an index of every student's rows
+#
+#   python history.py --backfill    record every file saved in uploaded_files/
+#
+# Every processed dataset is recorded when its dashboard sections are built; the backfill adds the
+# files uploaded before the store existed by decrypting the saved copies, so they need not be uploaded again.
+import argparse
+import logging
+import os
+import sqlite3
+import time
+import numpy as np
+import pandas as pd
+from cache import get_dataset_info
+from cube import DIMENSIONS, get_cube
+from ml_model import score_students
+
+logger = logging.getLogger(__name__)
+
+# Kept outside the cache directory so the history never expires; SQLite lets several worker
+# processes write at once (in WAL mode), which DuckDB does not
+HISTORY_DB = os.environ.get('DASHBOARD_HISTORY_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history.sqlite'))
+
+# Date columns of the export used to work out which academic year a dataset covers
+DATE_COLUMNS = ['Last Attendence', 'Last Submitted', 'Last Attended (AA)']
+
+# Month the academic year starts in
+TERM_START_MONTH = 9
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    dataset_id TEXT PRIMARY KEY,
+    filename TEXT,
+    term TEXT NOT NULL,
+    recorded_at REAL NOT NULL,
+    rows INTEGER
+);
+CREATE TABLE IF NOT EXISTS course_quarters (
+    dataset_id TEXT NOT NULL REFERENCES datasets(dataset_id),
+    course_code TEXT NOT NULL,
+    level TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    quarter INTEGER NOT NULL,
+    rows INTEGER,
+    students INTEGER,
+    attendance_sum REAL,
+    attendance_count INTEGER,
+    submitted_sum REAL,
+    assessments_sum REAL,
+    submission_count INTEGER,
+    PRIMARY KEY (dataset_id, course_code, level, year, quarter)
+);
+CREATE TABLE IF NOT EXISTS at_risk (
+    dataset_id TEXT NOT NULL REFERENCES datasets(dataset_id),
+    user TEXT NOT NULL,
+    course_code TEXT,
+    level TEXT,
+    year INTEGER,
+    attendance REAL,
+    submission_rate REAL,
+    anomaly_score REAL,
+    cohort_rank INTEGER,
+    PRIMARY KEY (dataset_id, user)
+);
+CREATE TABLE IF NOT EXISTS student_records (
+    dataset_id TEXT NOT NULL REFERENCES datasets(dataset_id),
+    user TEXT NOT NULL,
+    course_code TEXT,
+    level TEXT,
+    year INTEGER,
+    quarter INTEGER,
+    attendance REAL,
+    submission_rate REAL
+);
+CREATE INDEX IF NOT EXISTS course_quarters_trend ON course_quarters (course_code, level, year, quarter);
+CREATE INDEX IF NOT EXISTS at_risk_course ON at_risk (course_code, level, year);
+CREATE INDEX IF NOT EXISTS at_risk_user ON at_risk (user);
+CREATE INDEX IF NOT EXISTS student_records_user ON student_records (user, dataset_id);
+CREATE INDEX IF NOT EXISTS datasets_term ON datasets (term, recorded_at);
+"""
+
+# Databases whose schema this process has already created
+_ready = set()
+
+def connect():
+    connection = sqlite3.connect(HISTORY_DB, timeout=30)
+    if HISTORY_DB not in _ready:
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(SCHEMA)
+        _ready.add(HISTORY_DB)
+    return connection
+
+def academic_term(df, recorded_at):
+    # Academic year a dataset covers (e.g. '2017/18'), from the median of its date columns,
+    # or from when it was recorded if the export has no dates
+    dates = [pd.to_datetime(df[column], errors='coerce') for column in DATE_COLUMNS if column in df.columns]
+    dates = pd.concat(dates).dropna() if dates else pd.Series(dtype='datetime64[ns]')
+    when = dates.median() if len(dates) else pd.Timestamp(recorded_at, unit='s')
+    start = when.year if when.month >= TERM_START_MONTH else when.year - 1
+    return f'{start}/{(start + 1) % 100:02d}'
+
+def user_key(value):
+    # Student code as stored in the history, so 43437412 and 43437412.0 (from a column with gaps) match
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        value = int(value)
+    return str(value)
+
+def _optional_int(value):
+    return None if pd.isna(value) else int(float(value))
+
+def _number(value):
+    return None if pd.isna(value) else float(value)
+
+def _student_rows(dataset_key, df):
+    # Every row of the export, keyed by student, for looking a student up across datasets
+    attendance = pd.to_numeric(df['% Attendance'], errors='coerce') * 100
+    submission_rate = pd.to_numeric(df['Submitted'], errors='coerce') / pd.to_numeric(df['Assessments'], errors='coerce').replace(0, np.nan) * 100
+    columns = zip(
+        df['User'].map(user_key), df['Course Code'].astype(str), df['Level of Study'].astype(str),
+        pd.to_numeric(df['Year of Course'], errors='coerce'), pd.to_numeric(df['Quarter'], errors='coerce'),
+        attendance, submission_rate,
+    )
+    for user, course_code, level, year, quarter, attendance, submission_rate in columns:
+        yield dataset_key, user, course_code, level, _optional_int(year), _optional_int(quarter), _number(attendance), _number(submission_rate)
+
+def _course_quarter_rows(dataset_key, cube):
+    # One row per non-empty cube cell, keeping the additive measures so any roll-up can be recomputed
+    rows = cube['measures']['rows']
+    students = np.diff(cube['user_ptr']).reshape(cube['shape'])
+    cells = np.argwhere(rows > 0)
+    labels = [cube['labels'][dim] for dim in DIMENSIONS]
+    measures = cube['measures']
+    for cell in map(tuple, cells):
+        level, year, course_code, quarter = (labels[axis][position] for axis, position in enumerate(cell))
+        yield (
+            dataset_key, str(course_code), str(level), int(year), int(quarter),
+            int(rows[cell]), int(students[cell]),
+            float(measures['attendance_sum'][cell]), int(measures['attendance_count'][cell]),
+            float(measures['submitted_sum'][cell]), float(measures['assessments_sum'][cell]), int(measures['submission_count'][cell]),
+        )
+
+def record_dataset(df, filename=None, term=None):
+    # Save a dataset's per-(course, level, year, quarter) aggregates, its rows by student and its at-risk students; recording
+    # the same dataset again replaces its rows, so it is safe to call on every upload
+    dataset_key = df.attrs['dataset_id']
+    recorded_at = time.time()
+    term = term or academic_term(df, recorded_at)
+    filename = filename or (get_dataset_info(dataset_key) or {}).get('filename')
+    scored = score_students(df)
+
+    connection = connect()
+    try:
+        with connection:
+            connection.execute('DELETE FROM course_quarters WHERE dataset_id = ?', (dataset_key,))
+            connection.execute('DELETE FROM at_risk WHERE dataset_id = ?', (dataset_key,))
+            connection.execute('DELETE FROM student_records WHERE dataset_id = ?', (dataset_key,))
+            connection.execute('INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?, ?)', (dataset_key, filename, term, recorded_at, len(df)))
+            connection.executemany('INSERT INTO course_quarters VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', _course_quarter_rows(dataset_key, get_cube(df)))
+            connection.executemany('INSERT OR REPLACE INTO at_risk VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                (dataset_key, user_key(row['User']), str(row['Course Code']), str(row['Level of Study']), _optional_int(row['Year of Course']),
+                 float(row['% Attendance']), float(row['Submission Rate']), float(row['Anomaly Score']), int(row['Cohort Rank']))
+                for row in scored.to_dict('records')
+            ))
+            connection.executemany('INSERT INTO student_records VALUES (?, ?, ?, ?, ?, ?, ?, ?)', _student_rows(dataset_key, df))
+    finally:
+        connection.close()
+    return term
+
+# Latest dataset of each term holding the course, so a re-uploaded export is not counted twice
+_LATEST_PER_TERM = """
+    SELECT dataset_id, term FROM (
+        SELECT d.dataset_id, d.term, row_number() OVER (PARTITION BY d.term ORDER BY d.recorded_at DESC) AS newest
+        FROM datasets d
+        WHERE EXISTS (SELECT 1 FROM course_quarters c WHERE c.dataset_id = d.dataset_id AND c.course_code = :course_code)
+    ) WHERE newest = 1
+"""
+
+def _filters(table, level, year):
+    return ''.join(f' AND {table}.{column} = :{column}' for column, value in (('level', level), ('year', year)) if value is not None)
+
+def course_trend(course_code, level=None, year=None):
+    # Attendance, submission rate and students of a course for each term and quarter, and its at-risk
+    # students in each term, optionally for one level and year of course; answered from the indexes
+    connection = connect()
+    try:
+        trend = pd.read_sql_query(f"""
+            WITH latest AS ({_LATEST_PER_TERM})
+            SELECT latest.term, c.quarter,
+                sum(c.attendance_sum) / nullif(sum(c.attendance_count), 0) * 100 AS attendance,
+                sum(c.submitted_sum) / nullif(sum(c.assessments_sum), 0) * 100 AS submission_rate,
+                sum(c.students) AS students
+            FROM course_quarters c JOIN latest ON latest.dataset_id = c.dataset_id
+            WHERE c.course_code = :course_code{_filters('c', level, year)}
+            GROUP BY latest.term, c.quarter
+            ORDER BY latest.term, c.quarter
+        """, connection, params={'course_code': course_code, 'level': level, 'year': year})
+        at_risk = pd.read_sql_query(f"""
+            WITH latest AS ({_LATEST_PER_TERM})
+            SELECT latest.term, count(a.user) AS at_risk
+            FROM latest LEFT JOIN at_risk a ON a.dataset_id = latest.dataset_id AND a.course_code = :course_code{_filters('a', level, year)}
+            GROUP BY latest.term
+        """, connection, params={'course_code': course_code, 'level': level, 'year': year})
+    finally:
+        connection.close()
+    return trend.merge(at_risk, on='term', how='left')
+
+def student_records(user):
+    # Every recorded row of a student in every dataset, newest dataset first, and whether the
+    # student was flagged as at risk in that dataset; a lookup on the student index
+    # Read with the plain cursor rather than pandas, which would take longer than the query itself
+    connection = connect()
+    connection.row_factory = sqlite3.Row
+    try:
+        rows = connection.execute("""
+            SELECT r.dataset_id, d.filename, d.term, d.recorded_at, r.course_code, r.level, r.year, r.quarter,
+                r.attendance, r.submission_rate, a.user IS NOT NULL AS flagged, a.anomaly_score
+            FROM student_records r
+            JOIN datasets d ON d.dataset_id = r.dataset_id
+            LEFT JOIN at_risk a ON a.dataset_id = r.dataset_id AND a.user = r.user
+            WHERE r.user = :user
+            ORDER BY d.recorded_at DESC, r.course_code, r.quarter
+        """, {'user': user_key(user)})
+        return [dict(row, flagged=bool(row['flagged'])) for row in rows]
+    finally:
+        connection.close()
+
+def history_courses():
+    # Course codes with at least one recorded term, for choosing a trend
+    connection = connect()
+    try:
+        return [row[0] for row in connection.execute('SELECT DISTINCT course_code FROM course_quarters ORDER BY course_code')]
+    finally:
+        connection.close()
+
+def is_recorded(dataset_key):
+    connection = connect()
+    try:
+        return connection.execute('SELECT 1 FROM datasets WHERE dataset_id = ?', (dataset_key,)).fetchone() is not None
+    finally:
+        connection.close()
+
+def record_history(df):
+    # Record a dataset the first time it is parsed, without letting a problem with the history store fail the upload;
+    # called on every parse, so a dataset that could not be recorded is tried again the next time it is opened
+    try:
+        if not is_recorded(df.attrs['dataset_id']):
+            return record_dataset(df)
+    except sqlite3.Error as e:
+        logger.warning('Could not record dataset %s in the history: %s', df.attrs.get('dataset_id'), e)
+
+def backfill(directory):
+    # Record every saved upload, decrypting each copy and reusing the cached parse where there is one
+    from parse_contents import read_dataset
+    from sections import load_saved_file
+
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(('.xls', '.xlsx')):
+            continue
+        try:
+            df = read_dataset(load_saved_file(name), name)
+            term = record_dataset(df, filename=name)
+        except Exception as e:
+            print(f'FAILED  {name}: {e}')
+            continue
+        print(f'{term}  {len(df):>9,} rows  {name} ({df.attrs["dataset_id"]})')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Term-over-term history of the processed datasets.')
+    parser.add_argument('--backfill', action='store_true', help='record every file saved in uploaded_files/')
+    args = parser.parse_args()
+
+    if args.backfill:
+        from sections import UPLOAD_DIR
+        backfill(UPLOAD_DIR)
+    print(f'{len(history_courses())} courses recorded in {HISTORY_DB}')
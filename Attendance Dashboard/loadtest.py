@@ -0,0 +1,172 @@
+# Load test for concurrent uploads
+#
+# Sends the same request the browser sends when a file is dropped on the upload box,
+# at increasing levels of concurrency, and reports throughput and latency for each level.
+# update_output is a background callback, so each upload is polled until its job finishes.
+#
+# Usage:
+#   1. Start the server, either the dev server (python app.py) or the production server:
+#        DASHBOARD_WORKERS=4 DASHBOARD_THREADS=2 gunicorn -c gunicorn.conf.py wsgi:server
+#   2. Run the load test against it:
+#        python loadtest.py exports/sheet.xlsx --url http://localhost:8050 --concurrency 1 2 4 8 --requests 16
+#
+# Reading the results:
+#   - Uploads run as background jobs in their own processes, so throughput should grow with
+#     concurrency until it reaches the number of CPU cores, with p95 latency staying close to
+#     the single-upload latency up to that point and rising linearly beyond it.
+#   - At most DASHBOARD_MAX_HEAVY_JOBS uploads (the number of cores by default) are processed at
+#     once; the rest wait in the scheduler's queue, which is included in their latency. Each
+#     simulated upload comes from its own browser session, so they are queued first come, first served.
+#   - The web workers only answer the short polling requests, so the gunicorn worker count
+#     mostly affects how many users can poll at once rather than upload throughput.
+#   - Repeated uploads of the same file are served from the shared cache after the first one,
+#     so pass --unique to make every payload distinct and measure the uncached path.
+#   - KB/upload is what the server sent for one upload including its polling requests, as
+#     received (gzip-compressed when the server compresses) and as JSON once decompressed.
+#     Start the server with DASHBOARD_COMPRESS=0 to measure it without compression.
+#   - An upload counts as an error when the server answers with a message instead of a dashboard
+#     (e.g. it was turned away after waiting DASHBOARD_MAX_QUEUE_SECONDS), a request fails, or no
+#     result arrives within --timeout.
+#
+# Measured on one CPU core with 6 GB of memory, against the dev server (DASHBOARD_DEBUG=0; gunicorn
+# was not available), uploading a generated 11,405-row sheet (480 KB) with --unique and --requests 32:
+#
+#   concurrency  uploads/s  p50 (s)  p95 (s)  errors
+#             1       0.33     2.99     3.93       0
+#             2       0.30     6.62     8.01       0
+#             4       0.34    11.81    14.08       0
+#             8       0.29    25.70    33.06       0
+#            16       0.24    65.31    72.59       0
+#            32       0.20   108.60   154.51       0
+#
+#   - It saturates at one upload at a time (the single core's slot): latency grows with the queue,
+#     and throughput falls from about 0.33 to 0.20 uploads/s as the waiting jobs and the polling
+#     requests take CPU time from the running one.
+#   - It breaks where the queue wait passes DASHBOARD_MAX_QUEUE_SECONDS (600 s by default, so about
+#     120 uploads in flight at 0.2 uploads/s): with the limit set to 60 s, 25 of 32 concurrent
+#     uploads were turned away after 61 s.
+import argparse
+import base64
+import gzip
+import io
+import json
+import os
+import statistics
+import time
+import urllib.parse
+import urllib.request
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+def make_unique(filename, content):
+    # Give the workbook a random zip comment (.xlsx) or trailing bytes (.xls) so its hash changes
+    if zipfile.is_zipfile(io.BytesIO(content)):
+        buffer = io.BytesIO(content)
+        with zipfile.ZipFile(buffer, 'a') as workbook:
+            workbook.comment = os.urandom(8).hex().encode()
+        return buffer.getvalue()
+    return content + os.urandom(512)
+
+def build_payload(filename, content, session_id=None):
+    # Body of the update_output callback request, as sent by the Dash front end
+    contents = 'data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,' + base64.b64encode(content).decode()
+    return {
+        'output': '..output-data-upload.children...loading-state.style...upload-data.style..',
+        'outputs': [
+            {'id': 'output-data-upload', 'property': 'children'},
+            {'id': 'loading-state', 'property': 'style'},
+            {'id': 'upload-data', 'property': 'style'},
+        ],
+        'inputs': [{'id': 'upload-data', 'property': 'contents', 'value': contents}],
+        'changedPropIds': ['upload-data.contents'],
+        'state': [
+            {'id': 'upload-data', 'property': 'filename', 'value': os.path.basename(filename)},
+            {'id': 'upload-data', 'property': 'last_modified', 'value': time.time()},
+            {'id': 'consolidate-files', 'property': 'value', 'value': []},
+            {'id': 'session-id', 'property': 'data', 'value': session_id or uuid.uuid4().hex},
+        ],
+    }
+
+def post(url, body, transferred):
+    # Send a request accepting gzip like a browser does, and count the bytes received and decoded
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json', 'Accept-Encoding': 'gzip'})
+    with urllib.request.urlopen(request, timeout=600) as response:
+        data = response.read()
+        transferred['wire'] += len(data)
+        if response.headers.get('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        transferred['json'] += len(data)
+        return json.loads(data or b'{}')
+
+def failed(result):
+    # An upload the server turned away (e.g. the queue wait ran out) or could not process is
+    # answered with a message in place of the dashboard
+    for child in result['response']['output-data-upload']['children'] or []:
+        props = child.get('props', {}) if isinstance(child, dict) else {}
+        text = props.get('children')
+        text = text[0] if isinstance(text, list) and text else text
+        if (props.get('style') or {}).get('color') == 'red' or (isinstance(text, str) and text.startswith('There was an error')):
+            return True
+    return False
+
+def upload(url, filename, content, timeout, poll_interval=0.2):
+    # Send one upload, poll its background job until the result arrives, and return the latency
+    # in seconds, the bytes transferred and whether the upload failed. A job that dies without a
+    # result is reported by Dash as still running, so polling gives up after `timeout` seconds
+    body = json.dumps(build_payload(filename, content)).encode()
+    transferred = {'wire': 0, 'json': 0}
+    start = time.perf_counter()
+    result = post(url + '/_dash-update-component', body, transferred)
+    while 'response' not in result:
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError(f'No result after {timeout} s')
+        time.sleep(poll_interval)
+        query = urllib.parse.urlencode({'cacheKey': result['cacheKey'], 'job': result['job']})
+        result = dict(post(url + '/_dash-update-component?' + query, body, transferred), cacheKey=result['cacheKey'], job=result['job'])
+    return time.perf_counter() - start, transferred, failed(result)
+
+def try_upload(url, filename, content, timeout):
+    # A request that errors or times out counts as a failed upload
+    start = time.perf_counter()
+    try:
+        return upload(url, filename, content, timeout)
+    except (OSError, ValueError, KeyError):
+        return time.perf_counter() - start, {'wire': 0, 'json': 0}, True
+
+def run_level(url, filename, content, concurrency, requests, unique, timeout):
+    # Run a fixed number of uploads with the given number in flight at once
+    payloads = [make_unique(filename, content) if unique else content for _ in range(requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda payload: try_upload(url, filename, payload, timeout), payloads))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for latency, _, _ in results)
+
+    return {
+        'concurrency': concurrency,
+        'throughput': requests / elapsed,
+        'p50': statistics.median(latencies),
+        'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        'errors': sum(error for _, _, error in results),
+        'wire_kb': sum(transferred['wire'] for _, transferred, _ in results) / requests / 1024,
+        'json_kb': sum(transferred['json'] for _, transferred, _ in results) / requests / 1024,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure how concurrent uploads scale.')
+    parser.add_argument('file', help='Excel file to upload')
+    parser.add_argument('--url', default='http://localhost:8050')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--requests', type=int, default=16, help='uploads per concurrency level')
+    parser.add_argument('--unique', action='store_true', help='make every upload distinct to bypass the cache')
+    parser.add_argument('--timeout', type=float, default=900, help='seconds after which an upload counts as failed')
+    args = parser.parse_args()
+
+    with open(args.file, 'rb') as fp:
+        content = fp.read()
+
+    print(f"{'concurrency':>11} {'uploads/s':>10} {'p50 (s)':>8} {'p95 (s)':>8} {'errors':>7} {'KB/upload':>10} {'(JSON)':>8}")
+    for concurrency in args.concurrency:
+        result = run_level(args.url, args.file, content, concurrency, args.requests, args.unique, args.timeout)
+        print(f"{result['concurrency']:>11} {result['throughput']:>10.2f} {result['p50']:>8.2f} {result['p95']:>8.2f} {result['errors']:>7} {result['wire_kb']:>10.1f} {result['json_kb']:>8.1f}")
@@ -0,0 +1,65 @@
+# Measures how long the app takes to start
+#
+#   python measure_startup.py [--top 15] [--port 8051]
+#
+# Reports the import time of app.py from `python -X importtime`, the slowest modules it
+# imports, and the time from launching `python app.py` until it answers its first request.
+import argparse
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def measure_imports(top):
+    # Run `python -X importtime -c "import app"` and parse its report from stderr
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=HERE, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # Top-level imports are the ones that are not indented under another module
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), int(self_us), int(cumulative_us), depth))
+
+    total_us = sum(cumulative for _, _, cumulative, depth in modules if depth == 0)
+    print(f'Import time of app.py: {total_us / 1e6:.3f}s')
+    print(f'Slowest {top} imports (cumulative):')
+    for name, _, cumulative, _ in sorted(modules, key=lambda module: module[2], reverse=True)[:top]:
+        print(f'  {cumulative / 1e6:8.3f}s  {name}')
+
+def measure_first_response(port, timeout):
+    # Start the app and poll it until it answers its first request
+    env = dict(os.environ, DASHBOARD_DEBUG='0', DASHBOARD_PORT=str(port))
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'app.py'], cwd=HERE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=1) as response:
+                    if response.status == 200:
+                        print(f'Time to first response: {time.perf_counter() - start:.3f}s')
+                        return
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.05)
+        print(f'No response within {timeout}s')
+    finally:
+        process.terminate()
+        process.wait()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure app import time and time to first response.')
+    parser.add_argument('--top', type=int, default=15, help='number of slowest imports to list')
+    parser.add_argument('--port', type=int, default=8051, help='port to start the app on')
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    measure_imports(args.top)
+    measure_first_response(args.port, args.timeout)
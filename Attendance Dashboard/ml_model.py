@@ -1,11 +1,19 @@
-from sklearn.ensemble import IsolationForest
-from sklearn.preprocessing import StandardScaler
-from sklearn.experimental import enable_iterative_imputer
-from sklearn.impute import IterativeImputer
-from sklearn.linear_model import LinearRegression
 import numpy as np
+from tracing import traced, trace_stage
+from cache import cached_result, load_result, load_dataframe
 
+# Columns of the scored frame: one row per at-risk student, with the anomaly score and its
+# rank within the student's level and year (1 is the most anomalous)
+AT_RISK_COLUMNS = ['User', 'Course Code', 'Level of Study', 'Year of Course', '% Attendance', 'Submission Rate', 'Anomaly Score', 'Cohort Rank']
+
+@traced('ml_preprocess')
 def preprocess_data(df):
+    # sklearn is imported on first use to keep app start-up fast
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.experimental import enable_iterative_imputer
+    from sklearn.impute import IterativeImputer
+    from sklearn.linear_model import LinearRegression
+
    # Check if necessary columns exist
     required_columns = [
         'User', '% Attendance', 'Submitted', 'Assessments',
@@ -35,7 +43,8 @@ def preprocess_data(df):
         random_state=42
     )
     columns_to_impute = ['% Attendance', 'Submitted', 'Assessments']
-    df[columns_to_impute] = imputer.fit_transform(df[columns_to_impute])
+    with trace_stage('ml_impute', rows=len(df)):
+        df[columns_to_impute] = imputer.fit_transform(df[columns_to_impute])
     
     # Calculate Submission Rate
     df['Submission Rate'] = (df['Submitted'] / df['Assessments']) * 100
@@ -65,26 +74,50 @@ def preprocess_data(df):
     
     return df_aggregated
 
+@traced('ml_fit')
 def perform_model(df):
+    from sklearn.ensemble import IsolationForest
+
     model = IsolationForest(n_estimators=100, contamination=0.20, random_state=42)
-    df = df[df['% Attendance Scaled'] != "Data not provided"]  # Exclude records without valid scaled data
-    model.fit(df[['% Attendance Scaled', 'Submission Rate Scaled']])
+    features = df[['% Attendance Scaled', 'Submission Rate Scaled']].to_numpy()
+    model.fit(features)
 
-    df['Anomaly'] = model.predict(df[['% Attendance Scaled', 'Submission Rate Scaled']])
-    thresholds = df[['% Attendance', 'Submission Rate']].mean()
+    # score_samples scores every student in one pass; predict() is that score compared with the
+    # fitted offset, so anomalies are read off the same array instead of predicting again
+    scores = model.score_samples(features)
+    attendance = df['% Attendance'].to_numpy()
+    submission_rate = df['Submission Rate'].to_numpy()
 
-    df_filtered = df[(df['Anomaly'] == -1) &
-                     (df['% Attendance'] < thresholds['% Attendance']) &
-                     (df['Submission Rate'] < thresholds['Submission Rate'])]
+    # At risk: anomalous, with attendance and submission both below the mean, in a single mask
+    at_risk = (scores < model.offset_) & (attendance < np.nanmean(attendance)) & (submission_rate < np.nanmean(submission_rate))
+
+    df_filtered = df.loc[at_risk, AT_RISK_COLUMNS[:-2]]
+    df_filtered['Anomaly Score'] = np.round(-scores[at_risk], 4)  # Higher is more anomalous
+    df_filtered['Cohort Rank'] = df_filtered.groupby(['Level of Study', 'Year of Course'])['Anomaly Score'] \
+        .rank(method='first', ascending=False).astype(int)
 
     return df_filtered
 
-def detect_concerning_students(df, level_of_study, year_of_course):
-    preprocessed_data = preprocess_data(df)
-    anomalised_data = perform_model(preprocessed_data)
-    at_risk_students = anomalised_data[
-        (anomalised_data['Level of Study'] == level_of_study) &
-        (anomalised_data['Year of Course'] == year_of_course)
-    ]
+def score_students(df):
+    # Preprocess and run the model once per dataset, sharing the result between workers;
+    # preprocessing rescales columns in place, so it works on a copy of the caller's data
+    return cached_result('at_risk', df, lambda: perform_model(preprocess_data(df.copy())))
+
+def load_scored_students(dataset_key):
+    # Scored frame for a stored dataset, recomputed from the cached sheet if it has expired
+    scored = load_result('at_risk', dataset_key)
+    if scored is None:
+        df = load_dataframe(dataset_key)
+        if df is None:
+            return None
+        df.attrs['dataset_id'] = dataset_key
+        scored = score_students(df)
+    return scored
 
-    return at_risk_students
\ No newline at end of file
+def at_risk_tables(scored):
+    # Split the scored students into one table per (level of study, year of course) in a single groupby
+    return dict(tuple(scored.groupby(['Level of Study', 'Year of Course'], sort=False)))
+
+def detect_concerning_students(df, level_of_study, year_of_course):
+    anomalised_data = score_students(df)
+    return at_risk_tables(anomalised_data).get((level_of_study, year_of_course), anomalised_data.iloc[:0])
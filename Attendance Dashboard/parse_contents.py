@@ -3,18 +3,158 @@ import dash_bootstrap_components as dbc
 import base64
 import io
 import os
+import time
+import uuid
 import pandas as pd
 import datetime
-from sections import create_summary_section, create_enrolment_section, create_attendance_section, create_submission_section, create_concerning_students_section
+from concurrent.futures import ProcessPoolExecutor
+from sections import create_summary_section, create_changes_summary, create_enrolment_section, create_attendance_section, create_submission_section, create_concerning_students_section
+from tracing import trace_stage, mark_failed
+from data_processing import calculate_summary_statistics
+from cube import get_cube
+from consolidate import consolidate, consolidated_id, dataset_parquet
+from cache import dataset_id, load_dataframe, store_dataframe, register_dataset, get_dataset_info, cached_result
+from schema import REQUIRED_COLUMNS, SchemaError, check_workbook
+from history import record_history
+from report import pdf_available
+from delta import changes_since_previous, at_risk_changes
 
-def parse_contents(contents, filename, date, decrypt=True):
+# Processes parsing the sheets of a multi-sheet workbook at once; openpyxl holds the GIL while it parses,
+# so the sheets are parsed in separate processes. Kept small because every upload running at once
+# (up to MAX_HEAVY_JOBS of them) starts its own pool, so the pools together stay near the core count
+SHEET_WORKERS = int(os.environ.get('DASHBOARD_SHEET_WORKERS', 2))
+
+def _read_sheet(decoded, sheet_name, header):
+    start = time.perf_counter()
+    df = pd.read_excel(io.BytesIO(decoded), sheet_name=sheet_name, header=header)
+    return df, time.perf_counter() - start
+
+def read_sheets(decoded, layouts):
+    # Parse each (sheet, header row) and combine them into one DataFrame with a Sheet column when there are
+    # several; returns the DataFrame and the rows and parse time of each sheet
+    workers = min(SHEET_WORKERS, len(layouts))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_read_sheet, *zip(*[(decoded, sheet_name, header) for sheet_name, header in layouts])))
+    else:
+        results = [_read_sheet(decoded, sheet_name, header) for sheet_name, header in layouts]
+    timings = [{'sheet': sheet_name, 'rows': len(frame), 'seconds': round(seconds, 3)} for (sheet_name, _), (frame, seconds) in zip(layouts, results)]
+
+    frames = [frame for frame, _ in results]
+    if len(frames) == 1:
+        return frames[0], timings
+    df = pd.concat([frame.assign(Sheet=sheet_name) for (sheet_name, _), frame in zip(layouts, frames)], ignore_index=True)
+    df['Sheet'] = pd.Categorical(df['Sheet'], categories=[sheet_name for sheet_name, _ in layouts])
+
+    # Give a numeric column one type when the sheets disagree (e.g. years stored as text in one of them)
+    for column, numeric in REQUIRED_COLUMNS.items():
+        if numeric and len({frame[column].dtype for frame in frames}) > 1:
+            df[column] = pd.to_numeric(df[column], errors='coerce')
+    return df, timings
+
+def read_dataset(decoded, filename):
+    # Reuse the parsed DataFrame if any worker has already read this file
+    dataset_key = dataset_id(decoded)
+    df = load_dataframe(dataset_key)
+    details = {}
+    if df is None:
+        # Check the columns from the first rows before paying for the full parse, and find every sheet holding data
+        with trace_stage('check_schema', bytes=len(decoded)):
+            layouts = check_workbook(decoded) or [(0, 0)]
+
+        # Read the Excel sheets into one pandas DataFrame
+        with trace_stage('read_excel', bytes=len(decoded)) as span:
+            df, details['sheets'] = read_sheets(decoded, layouts)
+            span['rows'] = len(df)
+            span['sheets'] = details['sheets']
+        store_dataframe(dataset_key, df)
+    df.attrs['dataset_id'] = dataset_key
+    register_dataset(dataset_key, filename, len(df), **details)
+    return df
+
+def create_dashboard_sections(df, report=None):
+    # Create the sections of the dashboard that only depend on the data, and its summary statistics
+    report = report or (lambda stage, fraction: None)
+    report('Summary', 0.25)
+    summary = calculate_summary_statistics(df)
+    report('Charts', 0.35)
+    cube = get_cube(df)
+    dashboard_key = df.attrs.get('dataset_id', '')
+    enrolment_section = create_enrolment_section(cube, dashboard_key)
+    attendance_section = create_attendance_section(cube, dashboard_key)
+    submission_section = create_submission_section(cube, dashboard_key)
+    report('Machine learning', 0.6)
+    concerning_students_section = create_concerning_students_section(df)
+    return summary, enrolment_section, attendance_section, submission_section, concerning_students_section
+
+def dashboard_sections(df, report=None):
+    # The sections only depend on the data, so they are shared by every upload of the same file; the changes since
+    # the previous upload depend on what else has been uploaded, so they are compared again on every request, and
+    # the history is recorded outside the cache, on every parse
+    report = report or (lambda stage, fraction: None)
+    # Compared first, so an upload with the same rows as the previous one reuses its cube and scores
+    report('Comparing with the previous upload', 0.2)
+    with trace_stage('compare_rows', rows=len(df)):
+        changes = changes_since_previous(df)
+    summary, enrolment_section, attendance_section, submission_section, concerning_students_section = \
+        cached_result('sections', df, lambda: create_dashboard_sections(df, report))
+    summary_section = create_summary_section(summary, create_changes_summary(changes, at_risk_changes(df, changes)))
+    report('Recording history', 0.9)
+    record_history(df)
+    return summary_section, enrolment_section, attendance_section, submission_section, concerning_students_section
+
+def report_links(dataset_key):
+    # Links to the static reports of a stored dataset, built on first request
+    if not dataset_key:
+        return None
+    links = [html.A('HTML report', href=f'/reports/{dataset_key}.html', target='_blank')]
+    if pdf_available():
+        links.append(html.A('PDF report', href=f'/reports/{dataset_key}.pdf', target='_blank'))
+    return html.Div(links, className='report-links')
+
+def stamp_instance(layout):
+    # The pattern ids are keyed by dataset, and one dataset can be on the page more than once (uploaded twice, or
+    # also opened from the dataset picker), so every rendered dashboard adds its own key to keep its ids unique
+    instance = uuid.uuid4().hex
+    for component in [layout, *layout._traverse()]:
+        if isinstance(getattr(component, 'id', None), dict):
+            component.id = {**component.id, 'instance': instance}
+    return layout
+
+def dashboard_layout(title, subtitle, summary_section, enrolment_section, attendance_section, submission_section, concerning_students_section, dataset_key=None):
+    # Organise the created sections into a responsive layout
+    return stamp_instance(html.Div([
+        html.H5(title),
+        html.H6(subtitle),
+        report_links(dataset_key),
+        dbc.Row([
+            dbc.Col([
+                summary_section, 
+                dbc.Row([
+                    dbc.Col(enrolment_section, width=4),  
+                    dbc.Col([
+                        dbc.Row(attendance_section),
+                        dbc.Row(submission_section), 
+                    ], width=4),
+                ]), 
+            ], width=8),
+            dbc.Col(concerning_students_section, width=4),
+        ]),
+    ], style={'padding-left': '1em', 'padding-right': '1em', 'padding-top': '1.5em'}))
+
+def parse_contents(contents, filename, date, decrypt=True, progress=None):
     # Check if any of the parameters are None, return None if any are missing
     if contents is None or filename is None or date is None:
         return None
 
+    # Report which stage is running, if the caller wants progress updates
+    report = progress or (lambda stage, fraction: None)
+    report('Parsing', 0.05)
+
     # Split the content into type and data parts, then decode the base64 encoded data
-    content_type, content_string = contents.split(',')
-    decoded = base64.b64decode(content_string)
+    with trace_stage('decode', bytes=len(contents)):
+        content_type, content_string = contents.split(',')
+        decoded = base64.b64decode(content_string)
 
     # Check if the file extension is for Excel files, return an error message if not
     if not (filename.endswith('.xls') or filename.endswith('.xlsx')):
@@ -22,35 +162,80 @@ def parse_contents(contents, filename, date, decrypt=True):
 
     try:
         if 'xls' in filename:
-            # Read the Excel file into a pandas DataFrame
-            df = pd.read_excel(io.BytesIO(decoded))
-            
-            # Create various sections of the dashboard
-            summary_section = create_summary_section(df)
-            enrolment_section = create_enrolment_section(df)
-            attendance_section = create_attendance_section(df)
-            submission_section = create_submission_section(df)
-            concerning_students_section = create_concerning_students_section(df)
+            df = read_dataset(decoded, filename)
+
+            summary_section, enrolment_section, attendance_section, submission_section, concerning_students_section = \
+                dashboard_sections(df, report)
             
-            # Organise the created sections into a responsive layout
-            return html.Div([
-            html.H5(filename), # Display the file name
-            html.H6(datetime.datetime.fromtimestamp(date).strftime('%Y-%m-%d %H:%M:%S')), # Display the upload time formatted
-            dbc.Row([
-                dbc.Col([
-                    summary_section, 
-                    dbc.Row([
-                        dbc.Col(enrolment_section, width=4),  
-                        dbc.Col([
-                            dbc.Row(attendance_section),
-                            dbc.Row(submission_section), 
-                        ], width=4),
-                    ]), 
-                ], width=8),
-                dbc.Col(concerning_students_section, width=4),
-            ]),
-        ], style={'padding-left': '1em', 'padding-right': '1em', 'padding-top': '1.5em'})
+            # Display the file name and the upload time formatted
+            return dashboard_layout(filename, datetime.datetime.fromtimestamp(date).strftime('%Y-%m-%d %H:%M:%S'),
+                summary_section, enrolment_section, attendance_section, submission_section, concerning_students_section, df.attrs['dataset_id'])
     
+    except SchemaError as e:
+        # List everything that is wrong with the file's layout so it can be fixed in one go
+        mark_failed(e)
+        return html.Div([
+            'This file does not match the attendance export format{}:'.format(f' ({e.location})' if e.location else ''),
+            html.Ul([html.Li(problem) for problem in e.problems])
+        ], style={'color': 'red'})
+
     except Exception as e:
         # Return an error message if there was a problem processing the file
-        return html.Div(['There was an error processing this file: {}'.format(e)])
\ No newline at end of file
+        mark_failed(e)
+        return html.Div(['There was an error processing this file: {}'.format(e)])
+
+def open_dataset(dataset_key):
+    # Dashboard of a dataset that was already processed (uploaded, batch-processed or picked up from the
+    # watched folder), served from the shared cache without the file being sent again
+    info = get_dataset_info(dataset_key)
+    df = load_dataframe(dataset_key) if info is not None else None
+    if df is None:
+        return html.Div(['This dataset is no longer in the cache. Please upload the file again.'])
+
+    try:
+        df.attrs['dataset_id'] = dataset_key
+        summary_section, enrolment_section, attendance_section, submission_section, concerning_students_section = \
+            dashboard_sections(df)
+        return dashboard_layout(info['filename'], datetime.datetime.fromtimestamp(info['last_seen']).strftime('%Y-%m-%d %H:%M:%S'),
+            summary_section, enrolment_section, attendance_section, submission_section, concerning_students_section, dataset_key)
+
+    except Exception as e:
+        mark_failed(e)
+        return html.Div(['There was an error opening this dataset: {}'.format(e)])
+
+def parse_consolidated(list_of_contents, list_of_names, progress=None):
+    # Combine several uploaded sheets (e.g. a whole faculty) into one dashboard
+    report = progress or (lambda stage, fraction: None)
+
+    try:
+        # Parse the sheets one at a time, keeping only a Parquet copy of each for the combined views
+        dataset_keys = []
+        for index, (contents, filename) in enumerate(zip(list_of_contents, list_of_names)):
+            report(f'Parsing {filename}', 0.5 * index / len(list_of_contents))
+            with trace_stage('decode', bytes=len(contents)):
+                content_type, content_string = contents.split(',')
+                decoded = base64.b64decode(content_string)
+            df = read_dataset(decoded, filename)
+            with trace_stage('write_parquet', rows=len(df)):
+                dataset_parquet(df.attrs['dataset_id'], df)
+            dataset_keys.append(df.attrs['dataset_id'])
+            del df
+
+        # Aggregate every sheet together out of core, then build the same sections from the results
+        report('Combining', 0.5)
+        with trace_stage('consolidate', files=len(dataset_keys)):
+            summary, _, cube = consolidate(dataset_keys)
+        report('Charts', 0.8)
+        concerning_students_section = html.Div(
+            html.Div('At-risk students are listed on the dashboard of each individual file.', className='summary-small'),
+            className='risk-container'
+        )
+        dashboard_key = consolidated_id(dataset_keys)
+        return dashboard_layout(f'{len(dataset_keys)} files combined', ', '.join(list_of_names),
+            create_summary_section(summary), create_enrolment_section(cube, dashboard_key), create_attendance_section(cube, dashboard_key),
+            create_submission_section(cube, dashboard_key), concerning_students_section)
+
+    except Exception as e:
+        # Return an error message if there was a problem combining the files
+        mark_failed(e)
+        return html.Div(['There was an error combining these files: {}'.format(e)])
@@ -0,0 +1,74 @@
+import argparse
+import cProfile
+import functools
+import glob
+import os
+import pstats
+import random
+import time
+import uuid
+
+# Profiling settings, taken from the environment and overridable from the command line
+settings = {
+    'enabled': os.environ.get('DASHBOARD_PROFILE', '0').lower() in ('1', 'true', 'yes'),
+    'directory': os.environ.get('DASHBOARD_PROFILE_DIR', 'profiles'),
+    'sample_rate': float(os.environ.get('DASHBOARD_PROFILE_RATE', '1.0')),
+}
+
+def configure(enabled=None, directory=None, sample_rate=None):
+    # Update the profiling settings (used by the --profile flags in app.py)
+    if enabled is not None:
+        settings['enabled'] = enabled
+    if directory is not None:
+        settings['directory'] = directory
+    if sample_rate is not None:
+        settings['sample_rate'] = sample_rate
+
+def profiled(name):
+    # Wrap a callback so that a sample of its calls is profiled and saved as a .pstats file
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # Settings are checked per call so that profiling can be switched on after registration
+            if not settings['enabled'] or random.random() >= settings['sample_rate']:
+                return func(*args, **kwargs)
+
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is already active in this thread, run the callback unprofiled
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.disable()
+                os.makedirs(settings['directory'], exist_ok=True)
+                filename = '{}-{}-{}.pstats'.format(name, time.strftime('%Y%m%d-%H%M%S'), uuid.uuid4().hex[:8])
+                profiler.dump_stats(os.path.join(settings['directory'], filename))
+        return wrapper
+    return decorator
+
+def summarise(directory, callback=None, top=20, sort='cumulative'):
+    # Merge every saved profile (optionally for one callback only) and print the hottest functions
+    pattern = '{}-*.pstats'.format(callback) if callback else '*.pstats'
+    files = sorted(glob.glob(os.path.join(directory, pattern)))
+    if not files:
+        print(f'No profiles found in {directory}')
+        return None
+
+    stats = pstats.Stats(*files)
+    print(f'Merged {len(files)} profile(s) from {directory}')
+    stats.strip_dirs().sort_stats(sort).print_stats(top)
+    return stats
+
+if __name__ == '__main__':
+    # Command line interface for summarising saved profiles
+    parser = argparse.ArgumentParser(description='Summarise the hottest functions across saved dashboard profiles.')
+    parser.add_argument('directory', nargs='?', default=settings['directory'], help='directory containing .pstats files')
+    parser.add_argument('--callback', help='only include profiles of this callback, e.g. update_output')
+    parser.add_argument('--top', type=int, default=20, help='number of functions to show')
+    parser.add_argument('--sort', default='cumulative', choices=['cumulative', 'tottime', 'ncalls'], help='sort order')
+    args = parser.parse_args()
+
+    summarise(args.directory, callback=args.callback, top=args.top, sort=args.sort)
@@ -0,0 +1,235 @@
+# Regression fixtures for the dashboard's calculations, figures and at-risk tables
+#
+#   python -m pytest                                 compare with the golden snapshot (test_regression.py)
+#   DASHBOARD_CHECK_BUDGETS=1 python -m pytest       also check the time and memory budgets
+#   python regression_check.py                       print each function's time and memory against its budget
+#   python regression_check.py --update              rewrite the snapshot after an intended change in output
+#
+# Two fixture sheets are generated from fixed seeds: a small one whose outputs (every calculator's
+# dict, every figure's data arrays and every at-risk table) are compared with snapshots/regression.json,
+# and a larger one on which each function must stay within its time and peak-memory (tracemalloc)
+# budget. The budgets depend on the machine, so the test suite only checks them when asked to.
+import argparse
+import json
+import math
+import os
+import sys
+import time
+import tracemalloc
+import warnings
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SNAPSHOT_PATH = os.path.join(HERE, 'snapshots', 'regression.json')
+
+# Relative tolerance when comparing floats with the snapshot
+TOLERANCE = 1e-9
+
+# Time (seconds) and peak traced memory (MB) allowed for each function on the budget fixture
+BUDGETS = {
+    'calculate_summary_statistics': (0.1, 35),
+    'calculate_summary_statistics_by': (0.1, 40),
+    'calculate_student_enrolment': (0.2, 40),
+    'calculate_attendance_rate': (1.5, 30),
+    'calculate_submission_rate': (0.6, 30),
+    'build_cube': (0.2, 25),
+    'cube_queries': (0.1, 10),
+    'preprocess_data': (1.5, 90),
+    'perform_model': (2.0, 15),
+    'figures': (1.5, 10),
+}
+
+LEVELS = {'UG': range(0, 6), 'PGT': range(1, 3)}
+
+def generate_sheet(students, seed):
+    # Synthetic export with the columns the dashboard reads, one row per student, course and quarter
+    rng = np.random.default_rng(seed)
+    courses = {'UG': [f'U{n:02d}0U' for n in range(12)], 'PGT': [f'P{n:02d}0P' for n in range(4)]}
+
+    levels = rng.choice(['UG', 'PGT'], size=students, p=[0.8, 0.2])
+    rows = []
+    for student, level in enumerate(levels):
+        year = int(rng.choice(LEVELS[level]))
+        course = rng.choice(courses[level])
+        engagement = rng.beta(5, 2)
+        # Some students leave part-way through the year
+        quarters = 4 if rng.random() > 0.1 else int(rng.integers(1, 4))
+        for quarter in range(1, quarters + 1):
+            assessments = int(rng.integers(1, 6))
+            rows.append({
+                'User': 40000000 + student,
+                'Level of Study': level,
+                'Year of Course': year,
+                'Course Code': course,
+                'Quarter': quarter,
+                '% Attendance': float(np.clip(rng.normal(engagement, 0.1), 0, 1)),
+                'Assessments': assessments,
+                'Submitted': int(rng.binomial(assessments, engagement)),
+            })
+
+    df = pd.DataFrame(rows)
+    # Gaps like the ones in real exports
+    df.loc[rng.random(len(df)) < 0.03, '% Attendance'] = np.nan
+    gaps = rng.random(len(df)) < 0.05
+    df.loc[gaps, 'Assessments'] = np.nan
+    df.loc[gaps, 'Submitted'] = np.nan
+    return df
+
+def figure_data(graph):
+    # The data arrays of every trace in a dcc.Graph
+    return [{key: list(trace[key]) for key in ('x', 'y', 'text') if trace[key] is not None} for trace in graph.figure.data]
+
+def collect_outputs(df):
+    # Every output the dashboard shows for a sheet, keyed by a readable name
+    import data_processing as dp
+    import ml_model
+    import sections
+    from cube import build_cube
+
+    outputs = {
+        'summary': dp.calculate_summary_statistics(df.copy()),
+        'summary_by_level': dp.calculate_summary_statistics_by(df.copy(), 'Level of Study'),
+    }
+    cube = build_cube(df)
+    for level, years in LEVELS.items():
+        outputs[f'enrolment {level}'] = dp.calculate_student_enrolment(df.copy(), level)
+        outputs[f'figure enrolment {level}'] = figure_data(sections.create_enrolment_graph(cube, level)[0])
+        for year in years:
+            outputs[f'attendance {level} {year}'] = dp.calculate_attendance_rate(df.copy(), level, year)
+            outputs[f'submission {level} {year}'] = dp.calculate_submission_rate(df.copy(), level, year)
+            outputs[f'figure attendance {level} {year}'] = figure_data(sections.create_attendance_graph(cube, level, year))
+            outputs[f'figure submission {level} {year}'] = figure_data(sections.create_submission_graph(cube, level, year))
+
+    tables = ml_model.at_risk_tables(ml_model.perform_model(ml_model.preprocess_data(df.copy())))
+    for level, years in LEVELS.items():
+        for year in years:
+            table = tables.get((level, year))
+            outputs[f'at risk {level} {year}'] = [] if table is None else table.to_dict('records')
+    return outputs
+
+def normalise(value):
+    # The JSON form of an output, so fresh results compare like the stored snapshot
+    from api import json_ready
+    return json.loads(json.dumps(json_ready(value)))
+
+def compare(expected, actual, path, problems):
+    # Record every difference between two JSON values, allowing for float rounding
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        for key in sorted(set(expected) | set(actual)):
+            if key not in actual:
+                problems.append(f'{path}/{key}: missing')
+            elif key not in expected:
+                problems.append(f'{path}/{key}: unexpected')
+            else:
+                compare(expected[key], actual[key], f'{path}/{key}', problems)
+    elif isinstance(expected, list) and isinstance(actual, list):
+        if len(expected) != len(actual):
+            problems.append(f'{path}: length {len(actual)}, expected {len(expected)}')
+        for i, (a, b) in enumerate(zip(expected, actual)):
+            compare(a, b, f'{path}[{i}]', problems)
+    elif isinstance(expected, float) and isinstance(actual, (int, float)):
+        if not math.isclose(expected, actual, rel_tol=TOLERANCE, abs_tol=TOLERANCE):
+            problems.append(f'{path}: {actual!r}, expected {expected!r}')
+    elif expected != actual:
+        problems.append(f'{path}: {actual!r}, expected {expected!r}')
+
+def snapshot_outputs():
+    # Outputs of the snapshot fixture sheet, in their JSON form
+    return normalise(collect_outputs(generate_sheet(students=400, seed=1)))
+
+def load_snapshot():
+    with open(SNAPSHOT_PATH) as fp:
+        return json.load(fp)
+
+def update_snapshot():
+    outputs = snapshot_outputs()
+    os.makedirs(os.path.dirname(SNAPSHOT_PATH), exist_ok=True)
+    with open(SNAPSHOT_PATH, 'w') as fp:
+        json.dump(outputs, fp, indent=1, sort_keys=True)
+    print(f'Wrote {len(outputs)} snapshots to {os.path.relpath(SNAPSHOT_PATH, HERE)}')
+
+def measure(func):
+    # Best of three timings, then one traced run for the peak memory
+    seconds = min(_timed(func) for _ in range(3))
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return seconds, peak / 1e6
+
+def _timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+def budget_functions():
+    # The budget fixture's row count, and each budgeted function run on it
+    import data_processing as dp
+    import ml_model
+    import sections
+    from cube import build_cube, cube_student_enrolment, cube_attendance_rate, cube_submission_rate
+
+    df = generate_sheet(students=20000, seed=2)
+    cube = build_cube(df)
+    preprocessed = ml_model.preprocess_data(df.copy())
+
+    def cube_queries():
+        for level, years in LEVELS.items():
+            cube_student_enrolment(cube, level)
+            for year in years:
+                cube_attendance_rate(cube, level, year)
+                cube_submission_rate(cube, level, year)
+
+    def figures():
+        sections.create_enrolment_section(cube)
+        sections.create_attendance_section(cube)
+        sections.create_submission_section(cube)
+
+    # The model functions change their input, so they are timed on a copy (included in the time)
+    functions = {
+        'calculate_summary_statistics': lambda: dp.calculate_summary_statistics(df),
+        'calculate_summary_statistics_by': lambda: dp.calculate_summary_statistics_by(df, 'Level of Study'),
+        'calculate_student_enrolment': lambda: [dp.calculate_student_enrolment(df, level) for level in LEVELS],
+        'calculate_attendance_rate': lambda: [dp.calculate_attendance_rate(df, level, year) for level, years in LEVELS.items() for year in years],
+        'calculate_submission_rate': lambda: [dp.calculate_submission_rate(df, level, year) for level, years in LEVELS.items() for year in years],
+        'build_cube': lambda: build_cube(df),
+        'cube_queries': cube_queries,
+        'preprocess_data': lambda: ml_model.preprocess_data(df.copy()),
+        'perform_model': lambda: ml_model.perform_model(preprocessed.copy()),
+        'figures': figures,
+    }
+    return len(df), functions
+
+def within_budget(name, func):
+    # The time and peak memory of a function, and whether both are within its budget
+    seconds, megabytes = measure(func)
+    time_budget, memory_budget = BUDGETS[name]
+    return seconds, megabytes, seconds <= time_budget and megabytes <= memory_budget
+
+def check_budgets():
+    rows, functions = budget_functions()
+    print(f'Budgets on {rows:,} rows:')
+    print(f"  {'function':<32} {'time (s)':>9} {'budget':>7} {'peak (MB)':>10} {'budget':>7}")
+    ok = True
+    for name, func in functions.items():
+        seconds, megabytes, within = within_budget(name, func)
+        time_budget, memory_budget = BUDGETS[name]
+        ok &= within
+        print(f"  {name:<32} {seconds:>9.3f} {time_budget:>7.1f} {megabytes:>10.1f} {memory_budget:>7.0f}{'' if within else '  OVER BUDGET'}")
+    return ok
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check performance budgets, or rewrite the golden snapshots.')
+    parser.add_argument('--update', action='store_true', help='rewrite the snapshots from the current code')
+    args = parser.parse_args()
+
+    # preprocess_data's known chained-assignment warnings would drown out the report
+    warnings.simplefilter('ignore', pd.errors.SettingWithCopyWarning)
+    sys.path.insert(0, HERE)
+    if args.update:
+        update_snapshot()
+        sys.exit(0)
+    sys.exit(0 if check_budgets() else 1)
@@ -0,0 +1,271 @@
+# Static reports of processed datasets, for sending as attachments instead of screenshots
+#
+#   python report.py <dataset id> [<dataset id> ...] [--pdf]
+#   python report.py --all [--pdf] [--workers 4]       e.g. nightly from cron
+#
+# A report has the dataset's summary, every enrolment, attendance and submission figure and the
+# at-risk table of each cohort, built from its cached results. The HTML report is one self-contained
+# file (plotly.js is inlined, so the figures stay interactive offline). The PDF has the same content
+# as static pages rendered by kaleido and joined with pypdf, which must both be installed for it.
+#   - Reports are kept in <cache>/reports/ under the dataset id, the cache version and REPORT_VERSION,
+#     so each is built once; bump REPORT_VERSION when the content of the report changes.
+#   - The dashboard links to /reports/<dataset id>.html (and .pdf); a missing report is built in a
+#     background process pool while the page asks the browser to check back.
+#   - --all builds the missing reports of every dataset in the registry whose data is still cached.
+import argparse
+import datetime
+import html
+import importlib.util
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from cache import CACHE_DIR, CACHE_VERSION, get_cache, get_dataset_info, list_datasets, load_dataframe
+from cube import cohorts, get_cube
+from data_processing import calculate_summary_statistics
+from ml_model import AT_RISK_COLUMNS, at_risk_tables, score_students
+
+logger = logging.getLogger(__name__)
+
+# Bump when the content or layout of the reports changes so they are built again
+REPORT_VERSION = 1
+
+REPORT_DIR = os.path.join(CACHE_DIR, 'reports')
+
+# Processes building reports for the web server
+REPORT_WORKERS = int(os.environ.get('DASHBOARD_REPORT_WORKERS', '2'))
+
+# Size of a PDF page in pixels (A4 landscape at 96 dpi)
+PDF_WIDTH, PDF_HEIGHT = 1123, 794
+
+REPORT_KINDS = ('html', 'pdf')
+
+def pdf_available():
+    return importlib.util.find_spec('kaleido') is not None and importlib.util.find_spec('pypdf') is not None
+
+def report_path(dataset_key, kind):
+    return os.path.join(REPORT_DIR, f'{dataset_key}-{CACHE_VERSION}.{REPORT_VERSION}.{kind}')
+
+def _load(dataset_key):
+    df = load_dataframe(dataset_key)
+    if df is None:
+        raise LookupError(f'Dataset {dataset_key} was not found or has expired; upload it again.')
+    df.attrs['dataset_id'] = dataset_key
+    return df
+
+def report_contents(df):
+    # Headline numbers, figures and at-risk tables of a dataset, in the order they are shown
+    import sections
+
+    summary = calculate_summary_statistics(df)
+    highest, lowest = summary['course_with_highest_attendance'], summary['course_with_lowest_attendance']
+    headline = [
+        ('Total students', f"{summary['total_students']:,}"),
+        ('Dropout rate', f"{summary['dropout_rate']:.2f}%"),
+        ('Average attendance rate', f"{summary['average_attendance']:.2f}%"),
+        ('Average submission rate', f"{summary['average_submission_rate']:.2f}%"),
+        ('Highest attendance', f'{highest[0]} ({highest[1]:.2f}%)'),
+        ('Lowest attendance', f'{lowest[0]} ({lowest[1]:.2f}%)'),
+    ]
+
+    cube = get_cube(df)
+    tables = at_risk_tables(score_students(df))
+    figures, risk_tables = [], []
+    for level, years in cohorts(cube).items():
+        level_name = sections.LEVEL_NAMES.get(level, level)
+        # Every course, rather than the dashboard's page of them
+        graph = sections.create_enrolment_graph(cube, level, df.attrs['dataset_id'], page_size=None)[0]
+        figures.append((f'{level_name} enrolment', graph.figure))
+        for year in years:
+            figures.append((f'{level_name} year {year} attendance', sections.create_attendance_graph(cube, level, year).figure))
+            figures.append((f'{level_name} year {year} submission', sections.create_submission_graph(cube, level, year).figure))
+            table = tables.get((level, year))
+            if table is not None:
+                risk_tables.append((f'{level_name} year {year} at-risk students', table.sort_values('Cohort Rank')[AT_RISK_COLUMNS]))
+    return headline, figures, risk_tables
+
+def _title(dataset_key):
+    info = get_dataset_info(dataset_key) or {}
+    return info.get('filename', dataset_key), f"{info.get('rows', 0):,} rows, generated {datetime.datetime.now():%Y-%m-%d %H:%M}"
+
+def build_html(df):
+    import plotly.io as pio
+
+    title, subtitle = _title(df.attrs['dataset_id'])
+    headline, figures, risk_tables = report_contents(df)
+    parts = [
+        f'<h1>{html.escape(title)}</h1><p class="subtitle">{html.escape(subtitle)}</p>',
+        '<table class="summary">' + ''.join(f'<tr><th>{html.escape(name)}</th><td>{html.escape(value)}</td></tr>' for name, value in headline) + '</table>',
+    ]
+    for index, (heading, figure) in enumerate(figures):
+        # plotly.js is inlined once, with the first figure
+        parts.append(f'<h2>{html.escape(heading)}</h2>')
+        parts.append(pio.to_html(figure, full_html=False, include_plotlyjs=index == 0, config={'displayModeBar': False}))
+    for heading, table in risk_tables:
+        parts.append(f'<h2>{html.escape(heading)}</h2>')
+        parts.append(table.to_html(index=False, classes='at-risk', float_format=lambda value: f'{value:.2f}', na_rep=''))
+
+    return f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{html.escape(title)}</title>
+<style>
+body {{ font-family: sans-serif; max-width: 1000px; margin: 2em auto; color: #333; }}
+.subtitle {{ color: #666; }}
+h2 {{ font-size: 1.1em; margin-top: 2em; }}
+table {{ border-collapse: collapse; font-size: 0.85em; }}
+th, td {{ padding: 4px 10px; text-align: left; border-bottom: 1px solid #eee; }}
+table.at-risk tr:nth-child(odd) td {{ background: #f9f9f9; }}
+</style></head><body>
+{''.join(parts)}
+</body></html>
+""".encode()
+
+def _table_figure(heading, header, rows, width):
+    import plotly.graph_objs as go
+
+    figure = go.Figure(go.Table(
+        header=dict(values=header, fill_color='#f4f4f4', align='left', font=dict(family='sans-serif', size=12)),
+        cells=dict(values=list(zip(*rows)) if rows else [[] for _ in header], align='left', font=dict(family='sans-serif', size=11)),
+    ))
+    figure.update_layout(title=heading, width=width, height=min(PDF_HEIGHT, 120 + 24 * len(rows)), margin=dict(l=30, r=30, t=60, b=20))
+    return figure
+
+def build_pdf(df):
+    # One page per figure and table, rendered by kaleido and joined with pypdf
+    import io
+    import plotly.io as pio
+    from pypdf import PdfReader, PdfWriter
+
+    title, subtitle = _title(df.attrs['dataset_id'])
+    headline, figures, risk_tables = report_contents(df)
+    pages = [_table_figure(f'{title}<br><sub>{subtitle}</sub>', ['', ''], headline, PDF_WIDTH)]
+    for heading, figure in figures:
+        pages.append(figure.update_layout(title=heading, width=PDF_WIDTH, height=max(figure.layout.height or 0, 400), margin_t=60))
+    for heading, table in risk_tables:
+        # Long tables continue over as many pages as they need
+        rows = [[f'{value:.2f}' if isinstance(value, float) else value for value in row] for row in table.itertuples(index=False)]
+        per_page = (PDF_HEIGHT - 120) // 24
+        for start in range(0, len(rows), per_page):
+            pages.append(_table_figure(heading, list(table.columns), rows[start:start + per_page], PDF_WIDTH))
+
+    writer = PdfWriter()
+    for page in pages:
+        for pdf_page in PdfReader(io.BytesIO(pio.to_image(page, format='pdf'))).pages:
+            writer.add_page(pdf_page)
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+def generate_report(dataset_key, kind):
+    # Build a report unless it is already stored; returns its path
+    path = report_path(dataset_key, kind)
+    if os.path.exists(path):
+        return path
+    if kind == 'pdf' and not pdf_available():
+        raise RuntimeError('PDF reports need the kaleido and pypdf packages.')
+
+    start = time.perf_counter()
+    df = _load(dataset_key)
+    content = build_pdf(df) if kind == 'pdf' else build_html(df)
+
+    # Write under a temporary name first, so a report being written is never served
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as fp:
+        fp.write(content)
+    os.replace(temporary, path)
+    logger.info('Built %s report of %s in %.2fs', kind, dataset_key, time.perf_counter() - start)
+    return path
+
+_executor = None
+_pending = {}  # path -> future of the report being built by this process
+_failed = {}   # path -> error of the last failed build
+_lock = threading.Lock()
+
+def request_report(dataset_key, kind):
+    # Path of a stored report, or None while it is built in the background; raises the error of a
+    # failed build once, so the next request tries again
+    global _executor
+    path = report_path(dataset_key, kind)
+    if os.path.exists(path):
+        return path
+    with _lock:
+        if path in _failed:
+            raise RuntimeError(_failed.pop(path))
+        if path not in _pending:
+            if _executor is None:
+                _executor = ProcessPoolExecutor(max_workers=REPORT_WORKERS)
+            future = _executor.submit(generate_report, dataset_key, kind)
+            _pending[path] = future
+            future.add_done_callback(lambda future: _finished(path, future))
+    return None
+
+def _finished(path, future):
+    with _lock:
+        _pending.pop(path, None)
+        if future.exception() is not None:
+            _failed[path] = str(future.exception())
+
+def register_reports(server):
+    # Reports linked from each dashboard, built on first request
+    from flask import Response, abort, send_file
+
+    @server.route('/reports/<dataset_key>.<kind>')
+    def download_report(dataset_key, kind):
+        if kind not in REPORT_KINDS or get_dataset_info(dataset_key) is None:
+            abort(404)
+        if kind == 'pdf' and not pdf_available():
+            return Response('PDF reports need the kaleido and pypdf packages.', status=501, mimetype='text/plain')
+        try:
+            path = request_report(dataset_key, kind)
+        except (LookupError, RuntimeError) as e:
+            return Response(html.escape(str(e)), status=500, mimetype='text/plain')
+        if path is None:
+            # Accepted: the browser reloads the page until the report is ready
+            page = '<html><head><meta http-equiv="refresh" content="3"></head><body style="font-family: sans-serif">The report is being generated; this page will refresh when it is ready.</body></html>'
+            return Response(page, status=202, mimetype='text/html', headers={'Retry-After': '3'})
+        info = get_dataset_info(dataset_key)
+        name = f"{os.path.splitext(info['filename'])[0]} report.{kind}"
+        return send_file(path, as_attachment=kind == 'pdf', download_name=name, max_age=24 * 3600)
+
+def generate_all(dataset_keys, kinds, workers):
+    # Build the missing reports of many datasets in parallel, reporting each one as it finishes
+    failures = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(generate_report, dataset_key, kind): (dataset_key, kind)
+                   for dataset_key in dataset_keys for kind in kinds if not os.path.exists(report_path(dataset_key, kind))}
+        for future in as_completed(futures):
+            dataset_key, kind = futures[future]
+            try:
+                path = future.result()
+            except Exception as e:
+                failures += 1
+                print(f'FAILED  {dataset_key} {kind}: {e}', file=sys.stderr)
+                continue
+            print(f'{dataset_key} {kind:<4}  {os.path.getsize(path) / 1024:>8,.0f} KB  {path}')
+    return len(futures), failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build static HTML and PDF reports of processed datasets.')
+    parser.add_argument('datasets', nargs='*', help='dataset ids to build reports for')
+    parser.add_argument('--all', action='store_true', help='build reports for every stored dataset')
+    parser.add_argument('--pdf', action='store_true', help='also build PDF reports (needs kaleido and pypdf)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    args = parser.parse_args()
+
+    if args.pdf and not pdf_available():
+        sys.exit('PDF reports need the kaleido and pypdf packages.')
+    dataset_keys = args.datasets
+    if args.all:
+        # Datasets whose parsed data has expired from the cache cannot be reported on without the file
+        cache = get_cache()
+        dataset_keys = [info['id'] for info in list_datasets() if ('dataset', CACHE_VERSION, info['id']) in cache]
+    if not dataset_keys:
+        sys.exit('No datasets to build reports for.')
+
+    start = time.perf_counter()
+    built, failures = generate_all(dataset_keys, ['html', 'pdf'] if args.pdf else ['html'], args.workers)
+    print(f'{built} reports built for {len(dataset_keys)} datasets in {time.perf_counter() - start:.2f}s')
+    if failures:
+        sys.exit(f'{failures} report(s) failed')
@@ -0,0 +1,136 @@
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from cache import get_cache
+from tracing import trace_stage
+
+# Heavy jobs (parsing, aggregating and scoring an upload) allowed to run at once across every worker process
+MAX_HEAVY_JOBS = int(os.environ.get('DASHBOARD_MAX_HEAVY_JOBS', os.cpu_count() or 1))
+
+# Longest a job waits for a slot before it is turned away, so waits stay bounded under load
+MAX_QUEUE_SECONDS = float(os.environ.get('DASHBOARD_MAX_QUEUE_SECONDS', '600'))
+
+# Memory that must stay free after a job starts, and the memory a job is expected to need per
+# byte of uploaded file (an .xlsx is compressed XML, so the parsed sheet is many times larger)
+MIN_FREE_MEMORY = int(os.environ.get('DASHBOARD_MIN_FREE_MEMORY_MB', '512')) * 1024 * 1024
+MEMORY_PER_UPLOAD_BYTE = int(os.environ.get('DASHBOARD_MEMORY_PER_UPLOAD_BYTE', '40'))
+
+# How often a waiting job checks whether it can start
+POLL_SECONDS = 0.5
+
+class AdmissionError(Exception):
+    # A job that was turned away; the message is shown to the user
+    pass
+
+def available_memory():
+    # Memory available to new work in bytes, or None when it cannot be read
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        with open('/proc/meminfo') as fp:
+            for line in fp:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def _alive(pid):
+    # Dash terminates a background job when the same upload box starts another one, so jobs of
+    # processes that have gone are dropped rather than holding their slot forever
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _fair_order(jobs, last_started):
+    # Waiting jobs in the order they will start: users take turns, counting the jobs they already
+    # have running, so one user uploading many files cannot hold up everyone else; within a turn
+    # the user whose last job started longest ago goes first, then the job that has waited longest
+    running = {}
+    for job in jobs.values():
+        if job['running']:
+            running[job['user']] = running.get(job['user'], 0) + 1
+
+    turns, order = {}, []
+    for job_id, job in sorted(jobs.items(), key=lambda item: item[1]['enqueued']):
+        if job['running']:
+            continue
+        turn = running.get(job['user'], 0) + turns.get(job['user'], 0)
+        turns[job['user']] = turns.get(job['user'], 0) + 1
+        order.append((turn, last_started.get(job['user'], 0), job['enqueued'], job_id))
+    return [job_id for _, _, _, job_id in sorted(order)]
+
+def _try_start(job_id, user, memory):
+    # Add the job to the shared queue if it is new and start it if it is next, a slot is free and
+    # there is enough memory; returns (started, position in the queue, running jobs, memory short)
+    cache = get_cache('scheduler')
+    with cache.transact():
+        jobs = {key: job for key, job in cache.get('jobs', {}).items() if _alive(job['pid'])}
+        jobs.setdefault(job_id, {'user': user, 'pid': os.getpid(), 'enqueued': time.time(), 'running': False})
+        last_started = cache.get('last_started', {})
+        order = _fair_order(jobs, last_started)
+        running = sum(job['running'] for job in jobs.values())
+
+        available = available_memory()
+        memory_short = available is not None and available - memory < MIN_FREE_MEMORY
+        started = order[0] == job_id and running < MAX_HEAVY_JOBS and not memory_short
+        if started:
+            jobs[job_id]['running'] = True
+            # Forget users who have not started a job for a while; they are at the front of the next turn anyway
+            now = time.time()
+            last_started = {key: when for key, when in last_started.items() if now - when < MAX_QUEUE_SECONDS}
+            last_started[user] = now
+            cache.set('last_started', last_started)
+        cache.set('jobs', jobs)
+    return started, order.index(job_id) + 1 if not started else 0, running, memory_short
+
+def _finish(job_id):
+    cache = get_cache('scheduler')
+    with cache.transact():
+        jobs = cache.get('jobs', {})
+        jobs.pop(job_id, None)
+        cache.set('jobs', jobs)
+
+def queue_status():
+    # Running and waiting jobs, for monitoring
+    jobs = [job for job in get_cache('scheduler').get('jobs', {}).values() if _alive(job['pid'])]
+    return {'running': sum(job['running'] for job in jobs), 'waiting': sum(not job['running'] for job in jobs), 'limit': MAX_HEAVY_JOBS}
+
+@contextmanager
+def admission(user, payload_bytes=0, on_wait=None):
+    # Hold a heavy job until it may start; on_wait(position, memory_short) is called whenever its wait changes.
+    # Raises AdmissionError when the job waits too long, or when there is not enough memory for it
+    # and no running job would free any
+    job_id = uuid.uuid4().hex
+    memory = payload_bytes * MEMORY_PER_UPLOAD_BYTE
+    start = time.monotonic()
+    reported = None
+    try:
+        with trace_stage('queue_wait'):
+            while True:
+                started, position, running, memory_short = _try_start(job_id, user or 'anonymous', memory)
+                if started:
+                    break
+                if memory_short and running == 0:
+                    raise AdmissionError('The server does not have enough free memory to process this upload right now; try again later or upload a smaller file.')
+                if time.monotonic() - start > MAX_QUEUE_SECONDS:
+                    raise AdmissionError('The server is busy processing other uploads; try again in a few minutes.')
+                # Only when the wait changes, as every waiting job reporting each poll adds up
+                # to enough writes to Dash's job cache to time out under load
+                if on_wait is not None and (position, memory_short) != reported:
+                    on_wait(position, memory_short)
+                    reported = position, memory_short
+                time.sleep(POLL_SECONDS)
+        yield
+    finally:
+        _finish(job_id)
@@ -0,0 +1,123 @@
+import difflib
+import io
+import numbers
+
+# Columns the dashboard reads, and whether their values must be numbers
+REQUIRED_COLUMNS = {
+    'User': False,
+    'Level of Study': False,
+    'Year of Course': True,
+    'Course Code': False,
+    'Quarter': True,
+    '% Attendance': True,
+    'Submitted': True,
+    'Assessments': True,
+}
+
+# Rows searched for the header row, and data rows below it sampled to check the values
+HEADER_SEARCH_ROWS = 20
+SAMPLE_ROWS = 50
+
+class SchemaError(ValueError):
+    # Every problem found in a workbook, so they can all be reported at once, and where they were found
+    def __init__(self, problems, location=None):
+        super().__init__(('In {}: '.format(location) if location else '') + '; '.join(problems))
+        self.problems = problems
+        self.location = location
+
+    def __reduce__(self):
+        # Keep the problems intact when the error is raised in a worker process
+        return SchemaError, (self.problems, self.location)
+
+def _is_number(value):
+    # Numbers, and text that pandas.to_numeric would read as one (e.g. a year stored as '1')
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, numbers.Number):
+        return True
+    try:
+        float(str(value).strip())
+        return True
+    except ValueError:
+        return False
+
+def _header_problems(header, sample):
+    # Problems with one candidate header row and the data rows below it
+    names = [str(cell).strip() if cell is not None else '' for cell in header]
+    problems = []
+    for column, numeric in REQUIRED_COLUMNS.items():
+        positions = [i for i, cell in enumerate(header) if cell == column]
+        if not positions:
+            # Suggest the column the user probably meant, e.g. a different case or extra spaces
+            unused = [name for name in names if name and name not in REQUIRED_COLUMNS]
+            close = [name for name in unused if name.lower() == column.lower()] or difflib.get_close_matches(column, unused, n=1, cutoff=0.75)
+            hint = f' (found "{close[0]}"; rename it to "{column}")' if close else ''
+            problems.append(f'Missing required column: {column}{hint}')
+            continue
+        if len(positions) > 1:
+            problems.append(f'Column "{column}" appears {len(positions)} times')
+        if numeric:
+            values = [row[positions[0]] for row in sample if positions[0] < len(row) and row[positions[0]] not in (None, '')]
+            bad = [value for value in values if not _is_number(value)]
+            if bad:
+                problems.append(f'Column "{column}" should hold numbers but has {len(bad)} other value(s) in the first {len(sample)} rows, e.g. "{bad[0]}"')
+    if not any(any(value not in (None, '') for value in row) for row in sample):
+        problems.append('There are no data rows below the header')
+    return problems
+
+def check_workbook(decoded):
+    # Find every sheet holding an attendance export and its header row, reading only the first rows
+    # of each sheet in openpyxl's streaming mode; raises SchemaError listing every problem when a sheet
+    # that looks like an export does not fit, or when no sheet does.
+    # Returns [(sheet name, header row), ...], or None for .xls files, which openpyxl cannot read
+    if not decoded.startswith(b'PK'):
+        return None
+
+    from openpyxl import load_workbook
+    try:
+        workbook = load_workbook(io.BytesIO(decoded), read_only=True, data_only=True)
+    except Exception as e:
+        raise SchemaError([f'The file could not be opened as an Excel workbook ({e})'])
+
+    layouts, failures, best = [], [], None
+    try:
+        for worksheet in workbook.worksheets:
+            rows = list(worksheet.iter_rows(max_row=HEADER_SEARCH_ROWS + SAMPLE_ROWS, values_only=True))
+            candidate = None
+            for index, header in enumerate(rows[:HEADER_SEARCH_ROWS]):
+                # Score each row by the required columns it names, ignoring case and spaces so misnamed columns are explained
+                found = len({str(cell).strip().lower() for cell in header if cell is not None} & {column.lower() for column in REQUIRED_COLUMNS})
+                if found == 0:
+                    continue
+                problems = _header_problems(header, rows[index + 1:index + 1 + SAMPLE_ROWS])
+                if not problems:
+                    candidate = (found, index, problems)
+                    break
+                # Keep the row closest to the expected layout to explain what is wrong
+                if candidate is None or found > candidate[0]:
+                    candidate = (found, index, problems)
+            if candidate is None:
+                continue
+
+            found, index, problems = candidate
+            if not problems:
+                layouts.append((worksheet.title, index))
+            elif 2 * found >= len(REQUIRED_COLUMNS):
+                # Most of the columns are there, so this sheet is meant to be an export and must not be skipped
+                failures.append((worksheet.title, index, problems))
+            elif best is None or found > best[0]:
+                best = (found, worksheet.title, index, problems)
+    finally:
+        workbook.close()
+
+    if len(failures) == 1:
+        title, index, problems = failures[0]
+        raise SchemaError(problems, f'sheet "{title}", header on row {index + 1}')
+    if failures:
+        raise SchemaError([f'Sheet "{title}" (header on row {index + 1}): {problem}' for title, index, problems in failures for problem in problems])
+    if layouts:
+        return layouts
+    if best is None:
+        raise SchemaError(['No sheet has a header row with the attendance export columns: ' + ', '.join(REQUIRED_COLUMNS)])
+    _, title, index, problems = best
+    raise SchemaError(problems, f'sheet "{title}", header on row {index + 1}')
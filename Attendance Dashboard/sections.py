@@ -1,37 +1,72 @@
 import os
 import base64
+import datetime
 from dash import dcc, html, dash_table
 import dash_bootstrap_components as dbc
-import plotly.graph_objs as go
-from cryptography.fernet import Fernet
-from data_processing import calculate_summary_statistics, calculate_student_enrolment, calculate_attendance_rate, calculate_submission_rate
-from ml_model import detect_concerning_students
+from cube import get_cube, cohorts, level_enrolment, cube_attendance_rate, cube_submission_rate
+from ml_model import score_students, at_risk_tables
+from tracing import trace_stage, traced
+from table_query import query_table
 
 # Fernet key
 key = 'UjtHK2fF0D0kySPvLvheflVt010YeDMSoHhVlim6LPg='
 if key is None:
     raise ValueError("Encryption key not found.")
-cipher = Fernet(key.encode())
+_cipher = {}
+
+def get_cipher():
+    # cryptography is imported on first use to keep app start-up fast
+    if 'fernet' not in _cipher:
+        from cryptography.fernet import Fernet
+        _cipher['fernet'] = Fernet(key.encode())
+    return _cipher['fernet']
+
+# Encrypted copies of the uploaded files, next to this module whatever the working directory
+UPLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploaded_files')
 
 def save_file(name, content):
     # Decode the base64-encoded content
     content_type, content_string = content.split(',')
-    decoded_content = base64.b64decode(content_string)
+    save_decoded_file(name, base64.b64decode(content_string))
 
+@traced('save_file')
+def save_decoded_file(name, decoded_content):
     # Encrypt the content
-    encrypted_content = cipher.encrypt(decoded_content)
+    with trace_stage('encrypt', bytes=len(decoded_content)):
+        encrypted_content = get_cipher().encrypt(decoded_content)
 
     # Encode the encrypted content as base64
     encrypted_base64_content = base64.b64encode(encrypted_content).decode('utf-8')
 
     # Save the encrypted content
-    with open(os.path.join('uploaded_files', name), "wb") as fp:
-        fp.write(f'data:application/octet-stream;base64,{encrypted_base64_content}'.encode())
-
-def create_summary_cards(df):
-    # Call the summary data processing function
-    summary_data = calculate_summary_statistics(df)
-
+    with trace_stage('write_file', bytes=len(encrypted_base64_content)):
+        with open(os.path.join(UPLOAD_DIR, name), "wb") as fp:
+            fp.write(f'data:application/octet-stream;base64,{encrypted_base64_content}'.encode())
+
+def load_saved_file(name):
+    # Decrypted contents of a file saved by save_file
+    with open(os.path.join(UPLOAD_DIR, name), 'rb') as fp:
+        content_type, content_string = fp.read().decode().split(',')
+    return get_cipher().decrypt(base64.b64decode(content_string))
+
+_templates = {}
+
+def figure_template():
+    # The default plotly template is sent inside every figure, so keep only the trace defaults
+    # of the types drawn here (bar and scatter); the figures look the same at a fraction of the size
+    if 'compact' not in _templates:
+        import plotly.io as pio
+        import plotly.graph_objs as go
+        template = go.layout.Template(pio.templates['plotly'])
+        template.data = {'bar': template.data.bar, 'scatter': template.data.scatter}
+        _templates['compact'] = template
+    return _templates['compact']
+
+def round_values(values):
+    # Two decimal places are all the figures display, and shorten the numbers sent to the browser
+    return [None if value is None else round(value, 2) for value in values]
+
+def create_summary_cards(summary_data):
     # Create a layout to display summary data
     summary_content = dbc.Row([
         # Total students card
@@ -128,8 +163,28 @@ def create_summary_cards(df):
 
     return summary_content
 
-def create_summary_section(df):
-    summary_content = create_summary_cards(df)
+def create_changes_summary(changes, at_risk):
+    # One line on what changed since the previous upload of the same export, and which students
+    # are newly at risk or no longer at risk
+    if changes is None:
+        return None
+    when = datetime.datetime.fromtimestamp(changes['previous_seen']).strftime('%Y-%m-%d %H:%M')
+    if not (changes['rows_added'] or changes['rows_removed'] or changes['rows_changed']):
+        text = f'No rows have changed since the previous upload of this file ({when}).'
+    else:
+        text = (f"Since the previous upload of this file ({when}): {changes['rows_added']:,} rows added, "
+                f"{changes['rows_removed']:,} removed and {changes['rows_changed']:,} changed, "
+                f"for {len(changes['users']):,} students in {len(changes['courses']):,} courses.")
+    details = []
+    if at_risk is not None:
+        for label, users in (('Newly at risk', at_risk['newly_at_risk']), ('No longer at risk', at_risk['no_longer_at_risk'])):
+            if users:
+                details.append(html.Div(f"{label} ({len(users)}): {', '.join(users[:20])}{' ...' if len(users) > 20 else ''}"))
+    return html.Div([html.Div(text)] + details, className='changes-summary')
+
+@traced('summary_section')
+def create_summary_section(summary_data, changes_summary=None):
+    summary_content = create_summary_cards(summary_data)
     
     summary_section = dbc.Container([
         # Summary title
@@ -143,95 +198,113 @@ def create_summary_section(df):
         dbc.Row(
             summary_content,
             justify="center",
-            )
+            ),
+        # What changed since the previous upload of the same file, if there was one
+        changes_summary
         ], fluid=True, className="summary-container")       
     
     return summary_section
 
-def create_enrolment_graph(df, level_of_study):
-    # Determine parameters based on the level of study
-    if level_of_study == 'UG':
-        colors = ['#FF899E', '#FFBD55', '#E9E16A', '#4ECFA5', '#59BAEF', '#857BB8']
-        xaxis_range = [-8, 200]
-        bar_height = 29
-        enrolment_id = 'ug-enrolment-graph'
-        year_level = 'Year'
-        year_levels = [f'Year {i}' for i in range(len(colors))]
-        
-    elif level_of_study == 'PGT':
-        colors = ['#FFBD55', '#E9E16A']
-        xaxis_range = [-2, 50]
-        bar_height = 33
-        enrolment_id = 'pgt-enrolment-graph'
-        year_level = 'Year'
-        year_levels = [f'Year {i+1}' for i in range(len(colors))]
-
-    # Call the student enrolemnt data processing function
-    enrolment_data = calculate_student_enrolment(df, level_of_study)
-    
-    # Determine graph height
-    num_courses = len(enrolment_data['total_students_per_course'])
-    graph_height = num_courses * (bar_height)
-    
-    # Prepare data for plotting
+# Colour of each year of course in the enrolment graphs
+YEAR_COLORS = ['#FF899E', '#FFBD55', '#E9E16A', '#4ECFA5', '#59BAEF', '#857BB8']
+
+# Full names of the levels of study; any other level is shown by its code
+LEVEL_NAMES = {'UG': 'Undergraduate', 'PGT': 'Postgraduate'}
+
+def default_year(years):
+    # Year 1 is shown first when the level has it, otherwise its first year
+    return 1 if 1 in years else years[0]
+
+# Courses shown on one page of an enrolment graph, so its size does not grow with the number of courses
+ENROLMENT_PAGE_SIZE = 15
+
+def enrolment_page(totals, search='', page=0, page_size=ENROLMENT_PAGE_SIZE):
+    # Courses on one page of the enrolment graph, largest first, keeping only the course codes that
+    # contain `search`; returns the courses, the page shown and the number of matching courses
+    search = (search or '').strip().lower()
+    matching = sorted((course_code for course_code in totals if search in str(course_code).lower()), key=lambda course_code: (-totals[course_code], str(course_code)))
+    if page_size is None:
+        return matching, 0, len(matching)
+    page = min(max(page, 0), max(0, (len(matching) - 1) // page_size))
+    return matching[page * page_size:(page + 1) * page_size], page, len(matching)
+
+def enrolment_range_label(page, shown, total, page_size=ENROLMENT_PAGE_SIZE):
+    if total == 0:
+        return 'No matching courses'
+    first = page * (page_size or 0) + 1
+    return f'Courses {first}-{first + shown - 1} of {total}'
+
+def create_enrolment_figure(enrolment_data, level_of_study, search='', page=0, page_size=ENROLMENT_PAGE_SIZE):
+    # Stacked enrolment bars of one page of courses, from the totals of level_enrolment; returns the
+    # figure, the page shown, the courses on it and the number of matching courses
+    import plotly.graph_objs as go
+
+    bar_height = 33 if level_of_study == 'PGT' else 29
+    colors = [YEAR_COLORS[year] if 0 <= year < len(YEAR_COLORS) else '#000000' for year in enrolment_data['years']]
+
+    # Keep the courses on this page
+    totals = enrolment_data['total_students_per_course']
+    positions = {course_code: i for i, course_code in enumerate(totals)}
+    courses, page, matching = enrolment_page(totals, search, page, page_size)
+
+    # Iterate over years to create one trace per year, labelling the last with each course's total
     data = []
-    cumulative_sums = {key: 0 for key in enrolment_data['total_students_per_course'].keys()}
-    color_iterator = iter(colors)
-    
-    # Iterate over years and courses to create traces for the graph
-    for year in enrolment_data['total_students_per_year_by_course']:
+    year_names = list(enrolment_data['total_students_per_year_by_course'])
+    for year, color in zip(year_names, colors + ['#000000'] * len(year_names)):
         year_data = enrolment_data['total_students_per_year_by_course'][year]
-        for i, key in enumerate(enrolment_data['total_students_per_course'].keys()):
-            cumulative_sums[key] += year_data[i]
-
-        text_labels = [''] * len(year_data)
-        if year == list(enrolment_data['total_students_per_year_by_course'].keys())[-1]:
-            text_labels = [str(cumulative_sums[key]) for key in enrolment_data['total_students_per_course'].keys()]
-        
         trace = go.Bar(
             name=year,
-            x=year_data,
-            y=list(enrolment_data['total_students_per_course'].keys()),
+            x=[year_data[positions[course_code]] for course_code in courses],
+            y=list(courses),
             orientation='h',
-            text=text_labels,
-            textposition='outside', 
+            text=[str(totals[course_code]) for course_code in courses] if year == year_names[-1] else [''] * len(courses),
+            textposition='outside',
             textfont=dict(family='sans-serif'),
             hoverinfo='none',
-            hovertemplate=f'<b>{year_level}:</b> ' + year + '<br><b>Enrolment:</b> %{x}<extra></extra>',
-            marker=dict(color=next(color_iterator, '#000000'))  # Default to black if colors run out
+            hovertemplate='<b>Year:</b> ' + year + '<br><b>Enrolment:</b> %{x}<extra></extra>',
+            marker=dict(color=color)
         )
         data.append(trace)
 
+    # The x axis fits the largest course on the page, leaving room for its total
+    largest = max((totals[course_code] for course_code in courses), default=0)
+
     # Layout configuration
     layout = go.Layout(
+        template=figure_template(),
         barmode='stack',
         yaxis={
             'automargin': True,
             'autorange': 'reversed',
         },
         xaxis={
-            'range': xaxis_range,
+            'range': [0, max(largest, 5) * 1.15],
         },
         bargap=0.30,
         bargroupgap=0.25,
-        height=graph_height,
+        height=max(len(courses), 3) * bar_height + 30,
         showlegend=False,
         plot_bgcolor='rgba(0,0,0,0)',
         margin=dict(l=50, r=30, t=15, b=15),
         font=dict(family='sans-serif', size=12)
     )
 
-    # Figure configuration
-    enrolment_figure = go.Figure(data=data, layout=layout)
-    
-    # Graph configuration
+    return go.Figure(data=data, layout=layout), page, len(courses), matching
+
+def create_enrolment_graph(cube, level_of_study, dashboard_key='', page_size=ENROLMENT_PAGE_SIZE):
+    # Only the years of course that have data get a bar and a legend entry
+    enrolment_data = level_enrolment(dashboard_key, level_of_study, cube)
+    years = enrolment_data['years']
+    colors = [YEAR_COLORS[year] if 0 <= year < len(YEAR_COLORS) else '#000000' for year in years]
+    year_levels = [f'Year {year}' for year in years]
+
+    # Graph configuration; update_enrolment_page replaces the figure when the page or search changes
+    enrolment_figure, page, shown, matching = create_enrolment_figure(enrolment_data, level_of_study, page_size=page_size)
     enrolment_graph = dcc.Graph(
-        id=enrolment_id, 
-        figure=enrolment_figure, 
+        id={'type': 'enrolment-graph', 'dashboard': dashboard_key, 'level': level_of_study},
+        figure=enrolment_figure,
         style={
-            'maxHeight': '390px', 
-            'border-radius': '15px', 
-            'overflowY': 'scroll', 
+            'border-radius': '15px',
             'width': '100%'
             }
         )
@@ -247,14 +320,34 @@ def create_enrolment_graph(df, level_of_study):
     # Arrange entries into columns of two
     columns = [dbc.Col(legend_entries[i:i + 2], className='legend-column', width="auto") for i in range(0, len(legend_entries), 2)]
     enrolment_legend = html.Div(dbc.Row(columns, className='row'), style={'marginTop': '20px', 'marginLeft': '0'})
-    
-    return enrolment_graph, enrolment_legend
 
-def create_enrolment_section(df):
-    # Create graphs and legends for UG and PGT levels
-    ug_enrolment_graph, ug_enrolment_legend = create_enrolment_graph(df, 'UG')
-    pgt_enrolment_graph, pgt_enrolment_legend = create_enrolment_graph(df, 'PGT')
-    
+    # Search box and page buttons for the courses
+    ids = {'dashboard': dashboard_key, 'level': level_of_study}
+    enrolment_controls = html.Div([
+        dcc.Input(id={'type': 'enrolment-search', **ids}, type='text', placeholder='Search course code', debounce=True, className='enrolment-search'),
+        html.Button('<', id={'type': 'enrolment-previous', **ids}, n_clicks=0, className='enrolment-page-button'),
+        html.Span(enrolment_range_label(page, shown, matching, page_size), id={'type': 'enrolment-range', **ids}, className='enrolment-range'),
+        html.Button('>', id={'type': 'enrolment-next', **ids}, n_clicks=0, className='enrolment-page-button'),
+        dcc.Store(id={'type': 'enrolment-page', **ids}, data=page),
+    ], className='enrolment-controls')
+
+    return enrolment_graph, enrolment_legend, enrolment_controls
+
+@traced('enrolment_section')
+def create_enrolment_section(cube, dashboard_key=''):
+    # Create a graph and legend for every level of study in the data
+    years_by_level = cohorts(cube)
+    first_level = next(iter(years_by_level), None)
+    level_contents = []
+    for level in years_by_level:
+        graph, legend, controls = create_enrolment_graph(cube, level, dashboard_key)
+        # Only the selected level is shown; update_level_content switches between them
+        level_contents.append(html.Div(
+            [controls, graph, legend],
+            id={'type': 'level-content', 'section': 'enrolment', 'dashboard': dashboard_key, 'level': level},
+            style={'display': 'block' if level == first_level else 'none'}
+        ))
+
     # Create the enrolment section layout
     enrolment_section = html.Div(
         [
@@ -269,14 +362,11 @@ def create_enrolment_section(df):
                 align="center"
             ),
             dbc.Row(
-                # Dropdown menu to switch between UG and PGT
+                # Dropdown menu to switch between the levels of study
                 dcc.Dropdown(
-                    id='student-enrolment-dropdown',
-                    options=[
-                        {'label': 'UG', 'value': 'ug'},
-                        {'label': 'PGT', 'value': 'pgt'}
-                    ],
-                    value='ug',
+                    id={'type': 'level-dropdown', 'section': 'enrolment', 'dashboard': dashboard_key},
+                    options=[{'label': level, 'value': level} for level in years_by_level],
+                    value=first_level,
                     clearable=False, 
                     searchable=False,
                     className='custom-dropdown', 
@@ -287,39 +377,26 @@ def create_enrolment_section(df):
                     'margin-bottom': '1em'
                 }
             ),
-            # UG Enrolment Graph and Legend
-            html.Div(
-                [
-                    ug_enrolment_graph,
-                    ug_enrolment_legend, 
-                ],
-                id='ug-enrolment-content', 
-                style={'display': 'block'} 
-            ),
-            # PGT Enrolment Graph and Legend
-            html.Div(
-                [
-                    pgt_enrolment_graph,
-                    pgt_enrolment_legend
-                ],
-                id='pgt-enrolment-content', 
-                style={'display': 'none'} 
-            )
+            # Enrolment graph and legend of each level
+            *level_contents
         ],
         className='enrolment-container'
     )
     return enrolment_section
 
-def create_attendance_graph(df, level_of_study, year_of_course):
-    # Call the attendance rate data processing function
-    attendance_rates = calculate_attendance_rate(df, level_of_study, year_of_course)
+def create_attendance_graph(cube, level_of_study, year_of_course):
+    import plotly.graph_objs as go
+
+    # Query the aggregate cube for attendance rates
+    attendance_rates = cube_attendance_rate(cube, level_of_study, year_of_course)
     
     # Determine parameters
     courses = [course_code[0] for course_code in attendance_rates.keys()]
     quarters = ['Week 1-3', 'Week 4-6', 'Week 6-9', 'Week 9-12']
     num_quarters = len(quarters)
-    y_data = [list(course_data['attendance_by_quarter'].values()) for course_data in attendance_rates.values()]
-    average_attendance = [course_data['average_attendance'] for course_data in attendance_rates.values()]
+    # Look each quarter up by number, so a course missing a quarter's data leaves a gap instead of shifting the bars
+    y_data = [round_values(course_data['attendance_by_quarter'].get(quarter) for quarter in range(1, num_quarters + 1)) for course_data in attendance_rates.values()]
+    average_attendance = round_values(course_data['average_attendance'] for course_data in attendance_rates.values())
     colors = ['#7252A7', '#9099FF', '#6EB1FF', '#9CDBFF']
 
     # Constants for bar dimensions and spacing
@@ -334,7 +411,7 @@ def create_attendance_graph(df, level_of_study, year_of_course):
         group_positions = []
         for j in range(num_quarters):
             group_positions.append(current_x + j * (bar_width + space_between_bars))
-        x_positions.append(group_positions)
+        x_positions.append(round_values(group_positions))
         current_x += (num_quarters * (bar_width + space_between_bars) - space_between_bars) + space_between_groups
 
     # Calculate dynamic width of the graph
@@ -350,12 +427,12 @@ def create_attendance_graph(df, level_of_study, year_of_course):
                 name=quarter,
                 marker_color=colors[j],
                 width=bar_width,
-                hovertemplate=f'<b>Week:</b> {quarter}<br><b>Attendance Rate:</b> {y_data[i][j]:.2f}%<extra></extra>', 
+                hovertemplate=f'<b>Week:</b> {quarter}<br><b>Attendance Rate:</b> ' + (f'{y_data[i][j]:.2f}%' if y_data[i][j] is not None else 'No data') + '<extra></extra>', 
             ))
 
     # Add markers for average attendance (the lollipop heads)
     traces.append(go.Scatter(
-        x=[sum(pos) / len(pos) for pos in x_positions],
+        x=round_values(sum(pos) / len(pos) for pos in x_positions),
         y=average_attendance,
         name= '',
         mode='markers',
@@ -367,7 +444,7 @@ def create_attendance_graph(df, level_of_study, year_of_course):
     # Add sticks for the lollipop chart (vertical lines)
     for i, avg in enumerate(average_attendance):
         # Calculate the start and end x-positions for the stick
-        x_pos = sum(x_positions[i]) / len(x_positions[i])
+        x_pos = round(sum(x_positions[i]) / len(x_positions[i]), 2)
         traces.append(go.Scatter(
             x=[x_pos, x_pos],
             y=[0, avg],
@@ -379,10 +456,11 @@ def create_attendance_graph(df, level_of_study, year_of_course):
         ))
     
     # Calculate dynamic range for x-axis
-    x_axis_range = [min(x_positions[0]) - bar_width - 0.1, max(x_positions[-1]) + bar_width]
+    x_axis_range = round_values([min(x_positions[0]) - bar_width - 0.1, max(x_positions[-1]) + bar_width])
 
     # Layout configuration
     layout = go.Layout(
+        template=figure_template(),
         yaxis=dict(
             title='Attendance (%)',
             titlefont=dict(
@@ -400,7 +478,7 @@ def create_attendance_graph(df, level_of_study, year_of_course):
                 family='sans-serif',
                 size=12,             
             ),
-            tickvals=[sum(pos) / len(pos) for pos in x_positions],
+            tickvals=round_values(sum(pos) / len(pos) for pos in x_positions),
             ticktext=courses,
             range=x_axis_range,
         ),
@@ -416,9 +494,8 @@ def create_attendance_graph(df, level_of_study, year_of_course):
     # Figure configuration
     attendance_figure = go.Figure(data=traces, layout=layout)
 
-    # Graph configuration
+    # Graph configuration; no id, as one is rendered for every cohort
     attendance_graph = dcc.Graph(
-        id='attendance-graph',
         figure=attendance_figure,
         style={
             'border-radius': '15px',
@@ -430,41 +507,54 @@ def create_attendance_graph(df, level_of_study, year_of_course):
 
     return attendance_graph
 
-def create_attendance_section(df):
-    # Define levels of study and corresponding years of courses
-    levels_of_study = ['UG', 'PGT']
-    years_of_course = {
-        'UG': range(0, 6),
-        'PGT': range(1, 3) 
-    }
-
-    # Prepare graph containers by level and year
-    graph_containers = {}
-    for level in levels_of_study:
-        for year in years_of_course[level]:
-            graph_id = f'{level.lower()}-year-{year}-attendance'
-            attendance_graph = create_attendance_graph(df, level, year)
-            graph_containers[graph_id] = html.Div(attendance_graph, id=graph_id, style={'display': 'none'})
-    
-    # Dropdowns for selecting level of study
-    level_of_study_dropdown = dcc.Dropdown(
-        id='attendance-level-of-study-dropdown',
-        options=[{'label': level, 'value': level.lower()} for level in levels_of_study],
-        value='ug',
-        clearable=False,
-        searchable=False,
-        className='custom-dropdown',
-    )
-    
-    # Dropdowns for selecting year of course
-    year_of_course_dropdown = dcc.Dropdown(
-        id='attendance-year-of-course-dropdown',
-        options=[],
-        clearable=False,
-        searchable=False,
-        className='year-dropdown'
-    )
-   
+def year_options(years):
+    return [{'label': f'Year {year}', 'value': year} for year in years]
+
+def create_cohort_graphs(cube, section, dashboard_key, create_graph):
+    # One graph for each level and year of course in the data, and the dropdowns choosing which is shown;
+    # update_cohort_years and update_cohort_content in callbacks.py switch between them
+    years_by_level = cohorts(cube)
+    level = next(iter(years_by_level), None)
+    year = default_year(years_by_level[level]) if level is not None else None
+
+    # Prepare graph containers by level and year, showing the default one
+    graph_containers = [
+        html.Div(
+            create_graph(cube, graph_level, graph_year),
+            id={'type': 'cohort-content', 'section': section, 'dashboard': dashboard_key, 'level': graph_level, 'year': graph_year},
+            style={'display': 'block' if (graph_level, graph_year) == (level, year) else 'none'}
+        )
+        for graph_level, years in years_by_level.items() for graph_year in years
+    ]
+
+    # Dropdowns for selecting level of study and year of course, and the years each level has
+    dropdowns = html.Div([
+        dcc.Dropdown(
+            id={'type': 'cohort-level-dropdown', 'section': section, 'dashboard': dashboard_key},
+            options=[{'label': level_of_study, 'value': level_of_study} for level_of_study in years_by_level],
+            value=level,
+            clearable=False,
+            searchable=False,
+            className='custom-dropdown',
+        ),
+        dcc.Dropdown(
+            id={'type': 'cohort-year-dropdown', 'section': section, 'dashboard': dashboard_key},
+            options=year_options(years_by_level.get(level, [])),
+            value=year,
+            clearable=False,
+            searchable=False,
+            className='year-dropdown'
+        ),
+        dcc.Store(id={'type': 'cohorts', 'section': section, 'dashboard': dashboard_key}, data=years_by_level),
+    ], className='dropdown-row')
+
+    return dropdowns, graph_containers
+
+@traced('attendance_section')
+def create_attendance_section(cube, dashboard_key=''):
+    # Graphs for every level and year of course in the data
+    dropdowns, graph_containers = create_cohort_graphs(cube, 'attendance', dashboard_key, create_attendance_graph)
+
     # Define parameters
     colors = ['#7252A7', '#9099FF', '#6EB1FF', '#9CDBFF']
     num_quarters = 4
@@ -483,17 +573,14 @@ def create_attendance_section(df):
     
     # Combining all components into the content section
     attendance_content = html.Div([
-        html.Div([
-            level_of_study_dropdown,
-            year_of_course_dropdown
-        ], className='dropdown-row'),
+        dropdowns,
         html.Div(
             attendance_legend,
             className='attendance-legend'
         ),
         dbc.Col(
             html.Div(
-                list(graph_containers.values()),
+                graph_containers,
                 className='attendance-submission-graph-wrapper'
             ),
             width=12
@@ -513,9 +600,11 @@ def create_attendance_section(df):
 
     return attendance_section
 
-def create_submission_graph(df, level_of_study, year_of_course):
-    # Call the submission rate data processing function
-    submission_rates = calculate_submission_rate(df, level_of_study, year_of_course)
+def create_submission_graph(cube, level_of_study, year_of_course):
+    import plotly.graph_objs as go
+
+    # Query the aggregate cube for submission rates
+    submission_rates = cube_submission_rate(cube, level_of_study, year_of_course)
     
     # Determine parameters
     courses = [course_code for course_code in submission_rates.keys()]
@@ -545,6 +634,7 @@ def create_submission_graph(df, level_of_study, year_of_course):
 
     # Layout configuration
     layout = go.Layout(
+        template=figure_template(),
         yaxis=dict(
             title='Submission (%)',
             titlefont=dict(
@@ -577,9 +667,8 @@ def create_submission_graph(df, level_of_study, year_of_course):
     # Figure configuration
     submission_figure = go.Figure(data=traces, layout=layout)
 
-    # Graph configuration
+    # Graph configuration; no id, as one is rendered for every cohort
     submission_graph = dcc.Graph(
-        id='submission-graph',
         figure=submission_figure,
         style={
             'border-radius': '15px',
@@ -591,52 +680,17 @@ def create_submission_graph(df, level_of_study, year_of_course):
 
     return submission_graph
 
-def create_submission_section(df):
-     # Define levels of study and corresponding years of courses
-    levels_of_study = ['UG', 'PGT']
-    years_of_course = {
-        'UG': range(0, 6),  
-        'PGT': range(1, 3) 
-    }
-
-    # Prepare graph containers by level and year
-    graph_containers = {}
-    for level in levels_of_study:
-        for year in years_of_course[level]:
-            graph_id = f'{level.lower()}-year-{year}-submission'
-            submission_graph = create_submission_graph(df, level, year)
-            # Each graph is placed in separate columns
-            graph_containers[graph_id] = html.Div(submission_graph, id=graph_id, style={'display': 'none'})
-    
-    # Dropdowns for selecting level of study
-    level_of_study_dropdown = dcc.Dropdown(
-        id='submission-level-of-study-dropdown',
-        options=[{'label': level, 'value': level.lower()} for level in levels_of_study],
-        value='ug',
-        clearable=False,
-        searchable=False,
-        className='custom-dropdown'
-    )
-
-    # Dropdowns for selecting year of course
-    year_of_course_dropdown = dcc.Dropdown(
-        id='submission-year-of-course-dropdown',
-        options=[],  # Options will be set by callback based on selected level of study
-        value='1',
-        clearable=False,
-        searchable=False,
-        className='year-dropdown'
-    )
+@traced('submission_section')
+def create_submission_section(cube, dashboard_key=''):
+    # Graphs for every level and year of course in the data
+    dropdowns, graph_containers = create_cohort_graphs(cube, 'submission', dashboard_key, create_submission_graph)
     
     # Combining all components into the content section
     submission_content = html.Div([
-        html.Div([
-            level_of_study_dropdown,
-            year_of_course_dropdown
-        ], className='dropdown-row'),
+        dropdowns,
         dbc.Col(
             html.Div(
-                list(graph_containers.values()),
+                graph_containers,
                 className='attendance-submission-graph-wrapper'
             ),
             width=12
@@ -656,127 +710,175 @@ def create_submission_section(df):
         
     return submission_section
 
-def create_ug_table(df, year_of_course):
-    level_of_study = 'UG'
-    ug_students_list = detect_concerning_students(df, level_of_study, year_of_course)
-    
-    if not ug_students_list.empty:
-        return html.Div(
-            dash_table.DataTable(
-                id='ug-students-table',
-                data=ug_students_list.to_dict('records'),
-                columns=[
-                    {'name': 'Student', 'id': 'User'},
-                    {'name': 'Course Code', 'id': 'Course Code'},
-                    {'name': 'Attendance Rate (%)', 'id': '% Attendance'},
-                    {'name': 'Submission Rate (%)', 'id': 'Submission Rate'},
-                ],
-                # Inline styles for the table cells
-                style_cell={
-                    'textAlign': 'center',
-                    'padding': '10px',
-                    'backgroundColor': '#FFF',
-                    'border': 'none',
-                    'font-family': 'sans-serif',
-                    'font-size': '12.5px'
-                },
-                # Inline styles for the table header
-                style_header={
-                    'fontWeight': 'bold',
-                    'backgroundColor': '#f4f4f4',
-                    'fontFamily': 'sans-serif',
-                    'fontSize': '12.5px'
-                },
-                # Conditional styling for odd rows
-                style_data_conditional=[
-                    {'if': {'row_index': 'odd'}, 'backgroundColor': '#f9f9f9'}
-                ],
-                style_as_list_view=True,
-            ),
-            className='at-risk-table'
-        )
-    else:
+def create_trend_graph(trend, course_code):
+    import plotly.graph_objs as go
+
+    # One line per term, so the same quarter can be compared year on year
+    quarters = ['Week 1-3', 'Week 4-6', 'Week 6-9', 'Week 9-12']
+    traces = []
+    for term, term_data in trend.groupby('term', sort=True):
+        at_risk = term_data['at_risk'].iloc[0]
+        attendance = dict(zip(term_data['quarter'], term_data['attendance']))
+        traces.append(go.Scatter(
+            x=quarters,
+            y=round_values(attendance.get(quarter) for quarter in range(1, len(quarters) + 1)),
+            name=f'{term} ({at_risk:.0f} at risk)',
+            mode='lines+markers',
+            hovertemplate=f'<b>{term}</b><br><b>Attendance Rate:</b> ' + '%{y:.2f}%<extra></extra>',
+        ))
+
+    # Layout configuration
+    layout = go.Layout(
+        template=figure_template(),
+        title=dict(text=f'{course_code} attendance by term', font=dict(family='sans-serif', size=14)),
+        yaxis=dict(title='Attendance (%)', range=[0, 100], dtick=25),
+        height=300,
+        plot_bgcolor='#F7F7F7',
+        margin=dict(l=60, r=20, t=45, b=35),
+        font=dict(family='sans-serif', size=12),
+        legend=dict(orientation='h', y=-0.15)
+    )
+
+    return dcc.Graph(figure=go.Figure(data=traces, layout=layout), style={'border-radius': '15px'})
+
+# Number of at-risk students shipped per table page
+AT_RISK_PAGE_SIZE = 10
+
+def create_student_records_table(records):
+    if not records:
+        return html.Div('This student is not in any recorded dataset.', className='summary-small')
+
+    data = [
+        dict(record, flagged='Yes' if record['flagged'] else '', attendance=attendance, submission_rate=submission_rate)
+        for record, attendance, submission_rate in zip(
+            records, round_values(record['attendance'] for record in records), round_values(record['submission_rate'] for record in records))
+    ]
+    return html.Div(
+        dash_table.DataTable(
+            data=data,
+            columns=[
+                {'name': 'Term', 'id': 'term'},
+                {'name': 'File', 'id': 'filename'},
+                {'name': 'Course Code', 'id': 'course_code'},
+                {'name': 'Year', 'id': 'year', 'type': 'numeric'},
+                {'name': 'Quarter', 'id': 'quarter', 'type': 'numeric'},
+                {'name': 'Attendance Rate (%)', 'id': 'attendance', 'type': 'numeric'},
+                {'name': 'Submission Rate (%)', 'id': 'submission_rate', 'type': 'numeric'},
+                {'name': 'At Risk', 'id': 'flagged'},
+            ],
+            page_action='native',
+            page_size=AT_RISK_PAGE_SIZE,
+            style_cell={'textAlign': 'center', 'padding': '8px', 'border': 'none', 'font-family': 'sans-serif', 'font-size': '12.5px'},
+            style_header={'fontWeight': 'bold', 'backgroundColor': '#f4f4f4'},
+            style_data_conditional=[
+                {'if': {'filter_query': '{flagged} = "Yes"'}, 'backgroundColor': '#fdecea'}
+            ],
+            style_as_list_view=True,
+        ),
+        className='at-risk-table'
+    )
+
+def create_at_risk_table(students_list, level_of_study, year_of_course, dataset_key):
+    if students_list.empty:
         return html.Div("No at-risk students found for the given criteria.", style={'textAlign': 'center', 'fontFamily': 'sans-serif', 'fontSize': '14px', 'marginTop': '20px'})
 
-def create_pgt_table(df, year_of_course):
-    level_of_study = 'PGT'
-    pgt_students_list = detect_concerning_students(df, level_of_study, year_of_course)
-    
-    if not pgt_students_list.empty:
-        return html.Div(
-            dash_table.DataTable(
-                id='pgt-students-table',
-                data=pgt_students_list.to_dict('records'),
-                columns=[
-                    {'name': 'Student', 'id': 'User'},
-                    {'name': 'Course Code', 'id': 'Course Code'},
-                    {'name': 'Attendance Rate (%)', 'id': '% Attendance'},
-                    {'name': 'Submission Rate (%)', 'id': 'Submission Rate'},
-                ],
-                # Inline styles for the table cells
-                style_cell={
-                    'textAlign': 'center',
-                    'padding': '10px',
-                    'backgroundColor': '#FFF',
-                    'border': 'none',
-                    'font-family': 'sans-serif',
-                    'font-size': '12.5px'
-                },
-                # Inline styles for the table header
-                style_header={
-                    'fontWeight': 'bold',
-                    'backgroundColor': '#f4f4f4',
-                    'fontFamily': 'sans-serif',
-                    'fontSize': '12.5px'
-                },
-                # Conditional styling for odd rows
-                style_data_conditional=[
-                    {'if': {'row_index': 'odd'}, 'backgroundColor': '#f9f9f9'}
-                ],
-                style_as_list_view=True,
-            ),
-            className='at-risk-table'  # Assign the CSS class to the Div
+    if dataset_key is not None:
+        # Only the first page is sent; later pages, sorting and filtering are served by update_at_risk_table
+        data, page_count = query_table(students_list, 0, AT_RISK_PAGE_SIZE)
+        paging = dict(
+            id={'type': 'at-risk-table', 'dataset': dataset_key, 'level': level_of_study, 'year': year_of_course},
+            page_action='custom',
+            sort_action='custom',
+            filter_action='custom',
+            page_count=page_count,
         )
     else:
-        return html.Div("No at-risk students found for the given criteria.", style={'textAlign': 'center', 'fontFamily': 'sans-serif', 'fontSize': '14px', 'marginTop': '20px'})
+        # Without a cached dataset to query, the table pages over its own data in the browser
+        data = students_list.to_dict('records')
+        paging = dict(
+            id=f'{level_of_study.lower()}-year-{year_of_course}-students-table',
+            page_action='native',
+            sort_action='native',
+            filter_action='native',
+        )
 
-def create_concerning_students_section(df):
-    years_of_course = {
-        'UG': range(0, 6), 
-        'PGT': range(1, 3) 
-    }
-    
-    # Prepare containers for UG tables
-    ug_table_containers = {}
-    for year in years_of_course['UG']:
-        graph_id = f'ug-year-{year}-table'
-        ug_table = create_ug_table(df, year) 
-        ug_table_containers[graph_id] = html.Div(ug_table, id=graph_id, style={'display': 'none'})
-    
-    ug_year_of_course_dropdown = dcc.Dropdown(
-        id='ug-year-of-course-dropdown',
-        options=[{'label': 'Year ' + str(year), 'value': year} for year in range(6)],  # Dropdown options corrected
-        value=1,
-        clearable=False,
-        searchable=False,
-        className='grey-dropdown'
-    )
-    
-    # Prepare containers for PGT tables
-    pgt_table_containers = {}
-    for year in years_of_course['PGT']: 
-        graph_id = f'pgt-year-{year}-table'
-        pgt_table = create_pgt_table(df, year) 
-        pgt_table_containers[graph_id] = html.Div(pgt_table, id=graph_id, style={'display': 'none'})
-    
-    pgt_year_of_course_dropdown = dcc.Dropdown(
-        id='pgt-year-of-course-dropdown',
-        options=[{'label': f'Year {year}', 'value': year} for year in range(1, 3)], 
-        value=1,
-        clearable=False,
-        searchable=False,
-        className='grey-dropdown'
+    return html.Div(
+        dash_table.DataTable(
+            data=data,
+            columns=[
+                {'name': 'Student', 'id': 'User'},
+                {'name': 'Course Code', 'id': 'Course Code'},
+                {'name': 'Attendance Rate (%)', 'id': '% Attendance', 'type': 'numeric'},
+                {'name': 'Submission Rate (%)', 'id': 'Submission Rate', 'type': 'numeric'},
+                {'name': 'Severity', 'id': 'Anomaly Score', 'type': 'numeric'},
+            ],
+            page_current=0,
+            page_size=AT_RISK_PAGE_SIZE,
+            sort_mode='single',
+            sort_by=[],
+            filter_query='',
+            # Inline styles for the table cells
+            style_cell={
+                'textAlign': 'center',
+                'padding': '10px',
+                'backgroundColor': '#FFF',
+                'border': 'none',
+                'font-family': 'sans-serif',
+                'font-size': '12.5px'
+            },
+            # Inline styles for the table header
+            style_header={
+                'fontWeight': 'bold',
+                'backgroundColor': '#f4f4f4',
+                'fontFamily': 'sans-serif',
+                'fontSize': '12.5px'
+            },
+            # Conditional styling for odd rows
+            style_data_conditional=[
+                {'if': {'row_index': 'odd'}, 'backgroundColor': '#f9f9f9'}
+            ],
+            style_as_list_view=True,
+            **paging
+        ),
+        className='at-risk-table'  # Assign the CSS class to the Div
     )
+
+def create_cohort_table(df, tables, level_of_study, year_of_course):
+    students_list = tables.get((level_of_study, year_of_course), score_students(df).iloc[:0])
+    return create_at_risk_table(students_list, level_of_study, year_of_course, df.attrs.get('dataset_id'))
+
+@traced('concerning_students_section')
+def create_concerning_students_section(df):
+    dashboard_key = df.attrs.get('dataset_id', '')
+
+    # Score the dataset once and split it into every level and year's table in one pass
+    tables = at_risk_tables(score_students(df))
+
+    # A year dropdown and tables for every level of study in the data; update_table_content shows the selected year
+    level_sections = []
+    for level, years in cohorts(get_cube(df)).items():
+        year = default_year(years)
+        table_containers = [
+            html.Div(
+                create_cohort_table(df, tables, level, table_year),
+                id={'type': 'table-content', 'section': 'at-risk', 'dashboard': dashboard_key, 'level': level, 'year': table_year},
+                style={'display': 'block' if table_year == year else 'none'}
+            )
+            for table_year in years
+        ]
+        year_of_course_dropdown = dcc.Dropdown(
+            id={'type': 'table-year-dropdown', 'section': 'at-risk', 'dashboard': dashboard_key, 'level': level},
+            options=year_options(years),
+            value=year,
+            clearable=False,
+            searchable=False,
+            className='grey-dropdown'
+        )
+        level_sections += [
+            html.Div(LEVEL_NAMES.get(level, level), className='level-label'),
+            year_of_course_dropdown,
+            html.Div(table_containers, className='level-table-container'),
+        ]
     
     at_risk_students_section = html.Div([
     html.Div([
@@ -793,14 +895,8 @@ def create_concerning_students_section(df):
                 'margin-top': '0.5em'
             }), justify="start", align="center"
         ),
-        # UG section
-        html.Div('Undergraduate', className='ug-label'),
-        ug_year_of_course_dropdown,
-        html.Div(list(ug_table_containers.values()), className='ug-table-container'),
-        # PGT section
-        html.Div('Postgraduate', className='pgt-label'),
-        pgt_year_of_course_dropdown,
-        html.Div(list(pgt_table_containers.values()), className='pgt-table-container'),
+        # Section of each level
+        *level_sections,
     ], className='risk-container')
 ])
     
@@ -0,0 +1,86 @@
+import math
+import pandas as pd
+
+# Filter operators understood by DataTable's filter_query, longest first so that
+# 'ge' is not mistaken for 'gt' and so on
+OPERATORS = [
+    ['ge ', '>='],
+    ['le ', '<='],
+    ['lt ', '<'],
+    ['gt ', '>'],
+    ['ne ', '!='],
+    ['eq ', '='],
+    ['contains '],
+    ['datestartswith '],
+]
+
+# Operators that compare values, rather than search the text of a cell
+COMPARISONS = ('eq', 'ne', 'lt', 'le', 'gt', 'ge')
+
+def split_filter_part(filter_part):
+    # Split one "{column} op value" clause into its column name, operator, value (as typed) and
+    # case sensitivity: True or False for an operator prefixed with s or i (e.g. "s<", "icontains"),
+    # None when unprefixed. The operator is only looked for right after the column, so one inside
+    # a quoted value is taken as part of it
+    filter_part = filter_part.strip()
+    if not filter_part.startswith('{') or '}' not in filter_part:
+        return [None] * 4
+    name, rest = filter_part[1:].split('}', 1)
+    rest = rest.lstrip() + ' '
+
+    # No operator starts with s or i, so a leading one is a case prefix
+    case_sensitive = None
+    if rest[0] in ('s', 'i'):
+        case_sensitive, rest = rest[0] == 's', rest[1:]
+
+    for operator_type in OPERATORS:
+        for operator in operator_type:
+            if rest.startswith(operator):
+                value = rest[len(operator):].strip()
+                quote = value[0] if value else ''
+                if quote and value[-1] == quote and len(value) > 1 and quote in ('"', "'", '`'):
+                    value = value[1: -1].replace('\\' + quote, quote)
+                return name, operator_type[0].strip(), value, case_sensitive
+
+    return [None] * 4
+
+def filter_frame(df, filter_query):
+    # Apply every clause of a DataTable filter_query to the frame
+    for filter_part in (filter_query or '').split(' && '):
+        column, operator, value, case_sensitive = split_filter_part(filter_part)
+        if column not in df.columns:
+            continue
+        if operator in COMPARISONS:
+            if pd.api.types.is_numeric_dtype(df[column]):
+                # A value typed into a numeric column that is not a number matches nothing
+                values, value = df[column], pd.to_numeric(value, errors='coerce')
+            else:
+                # Text is compared as typed, ignoring case for an i-prefixed operator
+                values = df[column].astype(str)
+                if case_sensitive is False:
+                    values, value = values.str.lower(), value.lower()
+            try:
+                df = df.loc[getattr(values, operator)(value)]
+            except TypeError:
+                # e.g. ordering a column mixing text and numbers; the clause is ignored
+                continue
+        elif operator == 'contains':
+            # Unprefixed, contains ignores case as before
+            df = df.loc[df[column].astype(str).str.contains(value, case=bool(case_sensitive), regex=False)]
+        elif operator == 'datestartswith':
+            df = df.loc[df[column].astype(str).str.startswith(value)]
+    return df
+
+def query_table(df, page_current, page_size, sort_by=None, filter_query=None):
+    # Filter, sort and slice a frame down to the single page a DataTable asked for
+    df = filter_frame(df, filter_query)
+    if sort_by:
+        df = df.sort_values(
+            [column['column_id'] for column in sort_by],
+            ascending=[column['direction'] == 'asc' for column in sort_by],
+            kind='mergesort'
+        )
+
+    page_count = max(1, math.ceil(len(df) / page_size))
+    start = page_current * page_size
+    return df.iloc[start: start + page_size].to_dict('records'), page_count
@@ -0,0 +1,45 @@
+# Snapshot and budget tests for the fixtures in regression_check.py
+#
+#   python -m pytest                                 every output compared with snapshots/regression.json
+#   DASHBOARD_CHECK_BUDGETS=1 python -m pytest       also the time and memory budgets (machine-dependent)
+#   python regression_check.py --update              rewrite the snapshot after an intended change in output
+import os
+import warnings
+import pandas as pd
+import pytest
+import regression_check
+
+CHECK_BUDGETS = os.environ.get('DASHBOARD_CHECK_BUDGETS', '0').lower() in ('1', 'true', 'yes')
+
+SNAPSHOT = regression_check.load_snapshot()
+
+@pytest.fixture(scope='module')
+def outputs():
+    # preprocess_data's known chained-assignment warnings would drown out the failures
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', pd.errors.SettingWithCopyWarning)
+        return regression_check.snapshot_outputs()
+
+def test_same_outputs(outputs):
+    assert sorted(outputs) == sorted(SNAPSHOT)
+
+@pytest.mark.parametrize('name', sorted(SNAPSHOT))
+def test_snapshot(outputs, name):
+    problems = []
+    regression_check.compare(SNAPSHOT[name], outputs.get(name), name, problems)
+    assert not problems, '\n'.join(problems[:20])
+
+@pytest.fixture(scope='module')
+def budget_functions():
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', pd.errors.SettingWithCopyWarning)
+        return regression_check.budget_functions()[1]
+
+@pytest.mark.skipif(not CHECK_BUDGETS, reason='set DASHBOARD_CHECK_BUDGETS=1 to check the time and memory budgets')
+@pytest.mark.parametrize('name', list(regression_check.BUDGETS))
+def test_budget(budget_functions, name):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', pd.errors.SettingWithCopyWarning)
+        seconds, megabytes, within = regression_check.within_budget(name, budget_functions[name])
+    time_budget, memory_budget = regression_check.BUDGETS[name]
+    assert within, f'{name} took {seconds:.3f} s (budget {time_budget} s) and {megabytes:.1f} MB (budget {memory_budget} MB)'
@@ -0,0 +1,45 @@
+# Tests for the server-side filtering of the at-risk tables
+import pandas as pd
+import pytest
+from table_query import filter_frame, split_filter_part
+
+@pytest.fixture
+def students():
+    return pd.DataFrame({
+        'User': [40001234, 40009876, 51234000, 52000001],
+        'Course Code': ['U010U', 'u020u', 'P010P', 'U010U contains'],
+        '% Attendance': [10.0, 50.0, 90.0, 70.0],
+    })
+
+def rows(df, filter_query):
+    return list(filter_frame(df, filter_query)['User'])
+
+def test_student_code_contains(students):
+    # The Student column has no type, so DataTable filters it with contains and the code as typed
+    assert rows(students, '{User} contains 4000') == [40001234, 40009876, 51234000]
+    assert rows(students, '{User} contains 40001234') == [40001234]
+
+def test_numeric_comparisons(students):
+    assert rows(students, '{% Attendance} < 60') == [40001234, 40009876]
+    assert rows(students, '{% Attendance} ge "70"') == [51234000, 52000001]
+    assert rows(students, '{% Attendance} < abc') == []
+
+@pytest.mark.parametrize('filter_query, expected', [
+    ('{% Attendance} s< 60', [40001234, 40009876]),
+    ('{% Attendance} i>= 70', [51234000, 52000001]),
+    ('{Course Code} s= U010U', [40001234]),
+    ('{Course Code} i= U020U', [40009876]),
+    ('{Course Code} s= U020U', []),
+    ('{Course Code} icontains u0', [40001234, 40009876, 52000001]),
+    ('{Course Code} scontains u0', [40009876]),
+    ('{Course Code} contains u0', [40001234, 40009876, 52000001]),
+])
+def test_prefixed_operators(students, filter_query, expected):
+    assert rows(students, filter_query) == expected
+
+def test_operator_inside_quoted_value(students):
+    assert split_filter_part('{Course Code} = "U010U contains"') == ('Course Code', 'eq', 'U010U contains', None)
+    assert rows(students, '{Course Code} contains "0U contains"') == [52000001]
+
+def test_unknown_clauses_are_ignored(students):
+    assert rows(students, '{Nope} = 1 && {% Attendance} > 60') == [51234000, 52000001]
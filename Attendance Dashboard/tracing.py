@@ -0,0 +1,236 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from cache import get_cache, CACHE_EXPIRE
+
+# Structured trace logs go to their own logger as one JSON object per line
+logger = logging.getLogger('dashboard.trace')
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(os.environ.get('TRACE_LOG_LEVEL', 'INFO'))
+    logger.propagate = False
+
+# Histogram bucket boundaries (in seconds) for stage durations
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# The trace of the upload currently being processed (if any)
+_current_trace = ContextVar('current_trace', default=None)
+
+# In-process metric store, guarded by a single lock
+_lock = threading.Lock()
+_stage_histograms = {}
+_counters = {}
+
+# Key this process publishes its metrics under; the start time tells it apart from an earlier process with the same pid
+_process_key = (os.getpid(), time.time())
+
+# Key of the merged metrics of processes that have exited
+RETIRED_KEY = 'retired'
+
+def _reset_after_fork():
+    # A forked process (e.g. a background callback job) starts with empty metrics, since it publishes
+    # under its own key and what it inherited is already counted in its parent's snapshot
+    global _lock, _process_key
+    _lock = threading.Lock()
+    _stage_histograms.clear()
+    _counters.clear()
+    _process_key = (os.getpid(), time.time())
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _observe_duration(stage, seconds):
+    # Record a duration in the histogram for the given stage
+    with _lock:
+        histogram = _stage_histograms.get(stage)
+        if histogram is None:
+            histogram = _stage_histograms[stage] = {'buckets': [0] * len(DURATION_BUCKETS), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+def _increment(name, labels, value=1):
+    # Increment a counter identified by its name and label values
+    with _lock:
+        key = (name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+@contextmanager
+def trace_stage(stage, **attrs):
+    # Time a block of work; callers can add details such as row counts to the yielded span
+    span = dict(attrs)
+    start = time.perf_counter()
+    try:
+        yield span
+    finally:
+        duration = time.perf_counter() - start
+        _observe_duration(stage, duration)
+        if 'rows' in span:
+            _increment('upload_stage_rows_total', (('stage', stage),), span['rows'])
+        if 'bytes' in span:
+            _increment('upload_stage_bytes_total', (('stage', stage),), span['bytes'])
+
+        trace = _current_trace.get()
+        if trace is not None:
+            span['stage'] = stage
+            span['duration_ms'] = round(duration * 1000, 3)
+            trace['stages'].append(span)
+
+def traced(stage):
+    # Decorator form of trace_stage; the row count is taken from a DataFrame first argument
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_stage(stage) as span:
+                if args and hasattr(args[0], 'shape'):
+                    span['rows'] = int(args[0].shape[0])
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@contextmanager
+def upload_trace(filename, **attrs):
+    # Collect every stage of one upload and write it as a single structured log line
+    trace = {'event': 'upload', 'filename': filename, 'stages': []}
+    trace.update(attrs)
+    token = _current_trace.set(trace)
+    start = time.perf_counter()
+    status = 'ok'
+    try:
+        yield trace
+    except Exception:
+        status = 'error'
+        raise
+    finally:
+        _current_trace.reset(token)
+        duration = time.perf_counter() - start
+        _observe_duration('upload', duration)
+        _increment('uploads_total', (('status', trace.get('status', status)),))
+
+        trace.setdefault('status', status)
+        trace['duration_ms'] = round(duration * 1000, 3)
+        logger.info(json.dumps(trace, default=str))
+        _publish_snapshot()
+
+def mark_failed(error):
+    # Flag the current upload as failed when an error is handled rather than raised
+    trace = _current_trace.get()
+    if trace is not None:
+        trace['status'] = 'error'
+        trace['error'] = str(error)
+
+def _snapshot():
+    # Copy this process's metrics so they can be merged with other processes'
+    with _lock:
+        histograms = {stage: {'buckets': list(h['buckets']), 'sum': h['sum'], 'count': h['count']} for stage, h in _stage_histograms.items()}
+        counters = dict(_counters)
+    return histograms, counters
+
+def _publish_snapshot():
+    # Share this process's metrics with the other workers, once per upload
+    try:
+        get_cache('metrics').set(_process_key, _snapshot(), expire=CACHE_EXPIRE)
+    except Exception:
+        logger.exception('Could not publish metrics snapshot')
+
+def _running(pid):
+    # Signal 0 only checks that the process exists; on Windows os.kill would end it instead, so there
+    # every process is taken to be running and its snapshot is left to expire
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _merge(snapshots):
+    # Sum the histograms and counters of several snapshots
+    histograms, counters = {}, {}
+    for process_histograms, process_counters in snapshots:
+        for stage, h in process_histograms.items():
+            merged = histograms.setdefault(stage, {'buckets': [0] * len(DURATION_BUCKETS), 'sum': 0.0, 'count': 0})
+            merged['buckets'] = [a + b for a, b in zip(merged['buckets'], h['buckets'])]
+            merged['sum'] += h['sum']
+            merged['count'] += h['count']
+        for key, value in process_counters.items():
+            counters[key] = counters.get(key, 0) + value
+    return histograms, counters
+
+def _retire_exited(metrics_cache):
+    # Fold the snapshots of processes that have exited into one retired total, so the totals keep counting
+    # what they did without a snapshot being kept for every process that ever ran
+    for key in list(metrics_cache):
+        # Snapshots published before the start time was part of the key are keyed by the pid alone
+        if key == RETIRED_KEY or _running(key[0] if isinstance(key, tuple) else key):
+            continue
+        with metrics_cache.transact():
+            snapshot = metrics_cache.get(key)
+            if snapshot is None:
+                continue
+            metrics_cache.set(RETIRED_KEY, _merge([metrics_cache.get(RETIRED_KEY, ({}, {})), snapshot]))
+            metrics_cache.delete(key)
+
+def _collect():
+    # Merge the snapshots published by every worker, using the live values for this process
+    snapshots = {}
+    try:
+        metrics_cache = get_cache('metrics')
+        _retire_exited(metrics_cache)
+        for key in metrics_cache:
+            snapshot = metrics_cache.get(key)
+            if snapshot is not None:
+                snapshots[key] = snapshot
+    except Exception:
+        logger.exception('Could not read metrics snapshots')
+    snapshots[_process_key] = _snapshot()
+    return _merge(snapshots.values())
+
+def _format_labels(labels):
+    return ','.join('{}="{}"'.format(name, value) for name, value in labels)
+
+def render_metrics():
+    # Render the metrics of all worker processes in the Prometheus text exposition format
+    histograms, counters = _collect()
+
+    lines = [
+        '# HELP upload_stage_duration_seconds Time spent in each stage of the upload pipeline.',
+        '# TYPE upload_stage_duration_seconds histogram',
+    ]
+    for stage, histogram in sorted(histograms.items()):
+        for bound, count in zip(DURATION_BUCKETS, histogram['buckets']):
+            lines.append('upload_stage_duration_seconds_bucket{{stage="{}",le="{}"}} {}'.format(stage, bound, count))
+        lines.append('upload_stage_duration_seconds_bucket{{stage="{}",le="+Inf"}} {}'.format(stage, histogram['count']))
+        lines.append('upload_stage_duration_seconds_sum{{stage="{}"}} {}'.format(stage, histogram['sum']))
+        lines.append('upload_stage_duration_seconds_count{{stage="{}"}} {}'.format(stage, histogram['count']))
+
+    descriptions = {
+        'uploads_total': 'Uploaded files processed, by outcome.',
+        'upload_stage_rows_total': 'Rows handled by each stage of the upload pipeline.',
+        'upload_stage_bytes_total': 'Payload bytes handled by each stage of the upload pipeline.',
+    }
+    for name, description in descriptions.items():
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} counter'.format(name))
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == name:
+                lines.append('{}{{{}}} {}'.format(name, _format_labels(labels), value))
+
+    return '\n'.join(lines) + '\n'
+
+def register_metrics_endpoint(server):
+    # Expose the metrics on the Flask server underneath the Dash app
+    @server.route('/metrics')
+    def metrics():
+        return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
@@ -1,4 +1,9 @@
+import os
 from dash import dcc, html
+import dash_bootstrap_components as dbc
+
+# How often the list of processed datasets is refreshed in the browser
+DATASET_REFRESH_SECONDS = int(os.environ.get('DASHBOARD_DATASET_REFRESH_SECONDS', '30'))
 
 def upload_layout():
     # Layout for the file upload interface
@@ -10,13 +15,58 @@ def upload_layout():
                 html.A('Select Files')
             ], className='upload-text'),
             className='custom-upload',
+            multiple=True,
             style={'width': '100%', 'padding': '20px', 'borderWidth': '1px', 'borderStyle': 'dashed', 'borderRadius': '5px', 'textAlign': 'center'}
         ),
+        # Show several uploaded files as one combined dashboard instead of one dashboard each
+        dbc.Checklist(
+            id='consolidate-files',
+            options=[{'label': 'Combine uploaded files into one dashboard', 'value': 'combine'}],
+            value=[],
+            switch=True,
+            className='consolidate-switch'
+        ),
+        # Datasets that were already processed, e.g. exports picked up from the watched folder
+        dcc.Dropdown(
+            id='dataset-picker',
+            placeholder='Or open a processed dataset',
+            options=[],
+            className='dataset-picker'
+        ),
+        dcc.Interval(id='dataset-refresh', interval=DATASET_REFRESH_SECONDS * 1000),
+        # Attendance of a course in every recorded term, from the history store
+        html.Details([
+            html.Summary('Trends across terms'),
+            dcc.Dropdown(id='trend-course', placeholder='Choose a course', options=[], className='dataset-picker'),
+            html.Div(id='trend-content')
+        ], className='trend-panel'),
+        # Every recorded row of one student across the processed datasets, and where they were flagged
+        html.Details([
+            html.Summary('Find a student'),
+            dcc.Input(id='student-search', type='text', placeholder='Student code', debounce=True, className='student-search'),
+            html.Div(id='student-results')
+        ], className='trend-panel'),
+        # Progress of the upload currently being processed in the background
+        dbc.Progress(
+            id='upload-progress',
+            value=0,
+            label='',
+            striped=True,
+            animated=True,
+            className='upload-progress',
+            style={'display': 'none'}
+        ),
         dcc.Loading(
             id='loading-upload',
             children=html.Div(id='output-data-upload'),
             type='circle'
         ),
+        dcc.Loading(
+            id='loading-dataset',
+            children=html.Div(id='output-dataset'),
+            type='circle'
+        ),
         html.Div(id='loading-state', style={'display': 'none'}, children="Loading..."),
-        dcc.Store(id='stored-data')
+        dcc.Store(id='stored-data'),
+        dcc.Store(id='session-id', storage_type='session')
     ])
\ No newline at end of file
@@ -0,0 +1,48 @@
+import importlib
+import logging
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Modules that are imported on first use by sections.py, schema.py and ml_model.py
+HEAVY_MODULES = [
+    'pandas',
+    'plotly.graph_objs',
+    'cryptography.fernet',
+    'openpyxl',
+    'sklearn.ensemble',
+    'sklearn.preprocessing',
+    'sklearn.experimental.enable_iterative_imputer',
+    'sklearn.impute',
+    'sklearn.linear_model',
+]
+
+def warm_imports():
+    # Import the heavy modules now so the first upload does not pay for them
+    start = time.perf_counter()
+    for module in HEAVY_MODULES:
+        importlib.import_module(module)
+    logger.info('Pre-warmed %d modules in %.2fs', len(HEAVY_MODULES), time.perf_counter() - start)
+
+def _wait_until_listening(host, port, timeout):
+    # Poll the server's port until it accepts connections
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def prewarm_in_background(host='127.0.0.1', port=8050, timeout=60):
+    # Once the server is listening, import the heavy modules in a daemon thread
+    def run():
+        if _wait_until_listening(host, port, timeout):
+            warm_imports()
+
+    thread = threading.Thread(target=run, name='prewarm', daemon=True)
+    thread.start()
+    return thread
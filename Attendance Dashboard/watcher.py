@@ -0,0 +1,109 @@
+# Watches a folder for Excel exports and processes them like uploads, without a browser
+#
+#   python watcher.py /srv/exports [--workers 2] [--interval 2] [--settle 5] [--once]
+#
+# Every new or changed .xls/.xlsx file goes through the same steps as an upload in the dashboard:
+# it is parsed, aggregated and scored, its sections are cached and an encrypted copy is saved to
+# uploaded_files/. The dataset is then published to the dataset registry, so it appears in the
+# dashboard's "Open a processed dataset" list and opens straight from the cache.
+#   - A file is picked up once its size and modification time have not changed for --settle
+#     seconds, so exports that are still being written (or copied) are left alone.
+#   - At most --workers files are processed at once; the others wait in the folder.
+#   - Files are remembered by path, size and modification time, so a file is processed again only
+#     when it changes. After a restart every file is picked up once more, which the shared cache
+#     makes cheap.
+#   - --once processes the files already in the folder and exits, e.g. from a scheduled job.
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from batch import find_workbooks
+from cache import register_dataset
+from parse_contents import read_dataset, dashboard_sections
+from sections import save_decoded_file
+from tracing import upload_trace
+
+logger = logging.getLogger('dashboard.watcher')
+
+def ingest(path):
+    # Process one export the same way as an upload; runs in a worker process
+    start = time.perf_counter()
+    filename = os.path.basename(path)
+    with open(path, 'rb') as fp:
+        decoded = fp.read()
+
+    with upload_trace(filename, payload_bytes=len(decoded), source='watcher'):
+        df = read_dataset(decoded, filename)
+        dashboard_sections(df)
+        save_decoded_file(filename, decoded)
+        register_dataset(df.attrs['dataset_id'], filename, len(df), source='watched folder', path=os.path.abspath(path))
+
+    return {'file': filename, 'dataset_id': df.attrs['dataset_id'], 'rows': len(df), 'seconds': time.perf_counter() - start}
+
+def file_state(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def watch(directory, workers, interval, settle, once=False):
+    processed = {}  # path -> state when it was last processed
+    pending = {}    # path -> (state, when that state was first seen)
+    running = {}    # future -> (path, state)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # Record the files that have finished
+            for future in [future for future in running if future.done()]:
+                path, state = running.pop(future)
+                processed[path] = state
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error('Failed to process %s: %s', os.path.basename(path), e)
+                    continue
+                logger.info('Processed %s in %.2fs: %s rows, dataset %s', result['file'], result['seconds'], f"{result['rows']:,}", result['dataset_id'])
+
+            # Wait until a new or changed file has stopped changing before it is picked up
+            now = time.monotonic()
+            in_progress = {path for path, _ in running.values()}
+            ready = []
+            present = set(find_workbooks(directory))
+            for path in sorted(present):
+                try:
+                    state = file_state(path)
+                except FileNotFoundError:
+                    continue
+                if processed.get(path) == state or path in in_progress or state[0] == 0:
+                    continue
+                if path not in pending or pending[path][0] != state:
+                    pending[path] = (state, now)
+                elif now - pending[path][1] >= settle:
+                    ready.append((path, state))
+            for path in set(pending) - present:
+                del pending[path]
+
+            # Keep at most `workers` files in flight; the rest stay pending until a worker is free
+            for path, state in ready[:workers - len(running)]:
+                del pending[path]
+                running[executor.submit(ingest, path)] = (path, state)
+                logger.info('Processing %s', os.path.basename(path))
+
+            if once and not running and not pending:
+                return processed
+            time.sleep(interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Process Excel exports dropped into a folder and publish them to the dashboard.')
+    parser.add_argument('directory', help='folder to watch for .xls/.xlsx exports')
+    parser.add_argument('--workers', type=int, default=2, help='files processed at once')
+    parser.add_argument('--interval', type=float, default=2, help='seconds between scans of the folder')
+    parser.add_argument('--settle', type=float, default=5, help='seconds a file must stay unchanged before it is processed')
+    parser.add_argument('--once', action='store_true', help='process the files already in the folder, then exit')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    logger.info('Watching %s with %d workers', os.path.abspath(args.directory), args.workers)
+    try:
+        watch(args.directory, args.workers, args.interval, args.settle, args.once)
+    except KeyboardInterrupt:
+        pass
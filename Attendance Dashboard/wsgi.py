@@ -0,0 +1,12 @@
+# Production entry point: gunicorn -c gunicorn.conf.py wsgi:server
+
+from warmup import warm_imports
+from app import app
+
+# The app defers its heavy imports; load them here so that, with preload_app, the master
+# process imports them once and the forked workers share the pages copy-on-write
+warm_imports()
+
+# WSGI application object
+server = app.server
+application = server